@@ -1,16 +1,14 @@
-import os
+from audit_log import audit_log
 from database import *
-from helper import extract_user_id, is_positive_integer
-from config import questions
-from dotenv import load_dotenv
+from profiles import get_real_name, get_user_profile, get_user_profiles
+from slack_client import get_bot_id
+from config import INTEGRATION_BATCH_MAX_GRANTS, questions
 from config import teams
 
-load_dotenv()
-
 
 def get_bits(client, arguments, user_id, channel_id):
-    if len(arguments) > 2:
-        tag = " ".join(arguments[2:])
+    tag = arguments.get("tag")
+    if tag:
         bits = get_bits_by_user_id_from_history(user_id, tag)
     else:
         bits = get_bits_by_user_id(user_id)
@@ -19,108 +17,78 @@ def get_bits(client, arguments, user_id, channel_id):
         channel=channel_id,
         text=f"You have {bits} bits",
     )
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> printed their bit count",
-    )
+    audit_log.log(client, f"<@{user_id}> printed their bit count")
 
 
-def give_bit(client, arguments, user_id, channel_id):
-    if len(arguments) - 1 < 3:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: Command expects at least three arguments, {len(arguments) - 1} were given",
-        )
-        raise Exception(
-            f"Command expects at least three arguments, {len(arguments) - 1} were given"
-        )
+def require_existing_users(client, user_id, profiles):
+    for mentioned_user, profile in profiles.items():
+        if profile is None:
+            audit_log.log(
+                client,
+                f"<@{user_id}>: Mentioned user, {mentioned_user}, does not exist.",
+            )
+            raise Exception(f"Mentioned user, {mentioned_user}, does not exist.")
+
 
+def give_bit(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can grant bits to others!")
 
-    users = set(arguments[2:-1])
-    amount = int(arguments[-1])
+    rewarded_users = arguments["user_ids"]
+    amount = arguments["amount"]
+    require_existing_users(client, user_id, get_user_profiles(client, rewarded_users))
 
-    if not is_positive_integer(amount):
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: {amount} is not a valid amount; {amount} must be an integer amount > 0",
-        )
-        raise Exception(
-            f"{amount} is not a valid amount; {amount} must be an integer amount > 0"
-        )
-
-    for rewarded_user in users:
-        rewarded_user = extract_user_id(rewarded_user)
-
-        if not client.users_info(user=rewarded_user)["ok"]:
-            client.chat_postMessage(
-                channel=os.environ["BOT_LOGS_CHANNEL"],
-                text=f"<@{user_id}>: Mentioned user, {rewarded_user}, does not exist.",
-            )
-            raise Exception(f"Mentioned user, {rewarded_user}, does not exist.")
-
-        give_bits_to_user(rewarded_user, amount)
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}> gave {amount} bits to <@{rewarded_user}>",
-        )
+    results = give_bits_to_users(rewarded_users, amount, user_id, "give")
+    mentions = ", ".join(f"<@{rewarded_user}>" for rewarded_user in results)
+    audit_log.log(client, f"<@{user_id}> gave {amount} bits to {mentions}")
 
 
 def remove_bit(client, arguments, user_id, channel_id):
-    if len(arguments) - 1 < 3:
-        raise Exception(
-            f"Command expects at least three arguments, {len(arguments) - 1} were given"
-        )
-
     if not user_is_admin(user_id):
         raise Exception("Only admins can remove bits from others!")
 
-    users = set(arguments[2:-1])
-    amount = int(arguments[-1])
+    punished_users = arguments["user_ids"]
+    amount = arguments["amount"]
+    require_existing_users(client, user_id, get_user_profiles(client, punished_users))
 
-    if not is_positive_integer(amount):
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: {amount} is not a valid amount; {amount} must be an integer amount > 0",
-        )
-        raise Exception(
-            f"{amount} is not a valid amount; {amount} must be an integer amount > 0"
-        )
+    results = remove_bits_from_users(punished_users, amount, user_id, "remove")
+    report_removals(client, user_id, amount, results)
 
-    for punished_user in users:
-        punished_user = extract_user_id(punished_user)
-        if not client.users_info(user=punished_user)["ok"]:
-            client.chat_postMessage(
-                channel=os.environ["BOT_LOGS_CHANNEL"],
-                text=f"<@{user_id}>: Mentioned user, {punished_user}, does not exist.",
-            )
-            raise Exception(f"Mentioned user, {punished_user}, does not exist.")
 
-        remove_bits_from_user(punished_user, amount)
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}> removed {amount} bits from <@{punished_user}>",
-        )
+def report_removals(client, user_id, amount, results):
+    removed = [user for user, status in results.items() if status == "removed"]
+    insufficient = [user for user, status in results.items() if status != "removed"]
+
+    if removed:
+        mentions = ", ".join(f"<@{punished_user}>" for punished_user in removed)
+        audit_log.log(client, f"<@{user_id}> removed {amount} bits from {mentions}")
+
+    if insufficient:
+        mentions = ", ".join(f"<@{punished_user}>" for punished_user in insufficient)
+        raise Exception(f"Cannot remove more bits than what the user has: {mentions}")
 
 
 def get_leaderboard(client, arguments, user_id, channel_id):
-    if len(arguments) > 2:
-        tag = " ".join(arguments[2:])
+    tag = arguments.get("tag")
+    if tag:
         users = get_leaderboard_documents_from_history(tag)
     else:
         users = get_leaderboard_documents()
 
+    users = list(users)
+    profiles = get_user_profiles(client, [user["userId"] for user in users])
+
+    client.chat_postMessage(
+        channel=channel_id, text=format_leaderboard(users, profiles)
+    )
+
+    audit_log.log(client, f"<@{user_id}> just printed the leaderboard!")
+
+
+def format_leaderboard(users, profiles):
     user_bit_info = []
     for user in users:
-        user_bit_info.append(
-            (
-                client.users_info(user=user["userId"])["user"].get(
-                    "real_name", "Unknown User"
-                ),
-                user["bits"],
-            )
-        )
+        user_bit_info.append((get_real_name(profiles[user["userId"]]), user["bits"]))
     top_users_string = "🎉 Current Bit Leaders 🎉\n\n"
 
     for index, info in enumerate(user_bit_info):
@@ -142,12 +110,41 @@ def get_leaderboard(client, arguments, user_id, channel_id):
         else:
             top_users_string += f"\t{medal}{info[0]} - {info[1]} Bits\n"
 
-    client.chat_postMessage(channel=channel_id, text=top_users_string)
+    return top_users_string
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> just printed the leaderboard!",
-    )
+
+def get_rank(client, arguments, user_id, channel_id):
+    tag = arguments.get("tag")
+    if tag:
+        rank = get_user_rank_from_history(user_id, tag)
+    else:
+        rank = get_user_rank(user_id)
+
+    if rank is None:
+        text = f"You have no bits recorded for {tag}" if tag else "You have no bits yet"
+    else:
+        text = (
+            f"You are ranked #{rank['rank']} of {rank['total']} with {rank['bits']} bits "
+            f"(ahead of or tied with {rank['percentile']}% of members)"
+        )
+
+    client.chat_postMessage(channel=channel_id, text=text)
+    audit_log.log(client, f"<@{user_id}> printed their rank")
+
+
+def get_history(client, arguments, user_id, channel_id):
+    matrix = get_bit_history_matrix(user_id)
+
+    if not matrix["users"]:
+        text = "You have no bit history yet"
+    else:
+        history = matrix["users"][0]
+        text = "📜 Your Bit History 📜\n\n"
+        for tag, bits, team in zip(matrix["tags"], history["bits"], history["teams"]):
+            text += f"\t{tag} - {bits} {'Bit' if bits == 1 else 'Bits'} ({team})\n"
+
+    client.chat_postMessage(channel=channel_id, text=text)
+    audit_log.log(client, f"<@{user_id}> printed their bit history")
 
 
 def set_team_action_handler(client, team_value, user_id, channel_id):
@@ -155,23 +152,16 @@ def set_team_action_handler(client, team_value, user_id, channel_id):
     client.chat_postMessage(
         channel=channel_id, text=f"You set your team to {team_value}!"
     )
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> set their team to {team_value}!",
-    )
+    audit_log.log(client, f"<@{user_id}> set their team to {team_value}!")
 
 
 def print_team_leaderboard(client, arguments, user_id, channel_id):
-    if len(arguments) > 2:
-        tag = " ".join(arguments[2:])
+    tag = arguments.get("tag")
+    if tag:
         team_leaderboard = get_team_leaderboard_from_history(tag)
     else:
         team_leaderboard = get_team_leaderboard()
 
-    team_leaderboard = sorted(
-        team_leaderboard, key=lambda obj: obj["total_bits"], reverse=True
-    )
-
     top_teams_string = "🎉 Current Team Bit Leaders 🎉\n\n"
     for index, info in enumerate(team_leaderboard):
         medal = ""
@@ -198,14 +188,11 @@ def print_team_leaderboard(client, arguments, user_id, channel_id):
 
     client.chat_postMessage(channel=channel_id, text=top_teams_string)
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> just printed the team leaderboard!",
-    )
+    audit_log.log(client, f"<@{user_id}> just printed the team leaderboard!")
 
 
 def get_help(client, arguments, user_id, channel_id):
-    BOT_ID = client.api_call("auth.test")["user_id"]
+    BOT_ID = get_bot_id(client)
     client.chat_postMessage(
         channel=channel_id,
         text=f"""
@@ -218,6 +205,16 @@ def get_help(client, arguments, user_id, channel_id):
     - <@{BOT_ID}> get-bits <semester tag>
     - I.e., <@{BOT_ID}> get-bits Spring 2024
 
+    *View your rank and percentile:*
+    - <@{BOT_ID}> rank
+
+    *View your rank in a previous semester:*
+    - <@{BOT_ID}> rank <semester tag>
+    - I.e., <@{BOT_ID}> rank Spring 2024
+
+    *View your bits in every previous semester:*
+    - <@{BOT_ID}> history
+
     *Set your team:*
     - <@{BOT_ID}> set-team
 
@@ -266,6 +263,13 @@ def get_help(client, arguments, user_id, channel_id):
     - <@{BOT_ID}> save-bit-history <semester tag> 
     - I.e., <@{BOT_ID}> save-bit-history Spring 2024
 
+    *Close a semester (save bit history, then clear bits and teams):*
+    - <@{BOT_ID}> rollover <semester tag>
+    - I.e., <@{BOT_ID}> rollover Spring 2024
+
+    *Rebuild Leaderboards:*
+    - <@{BOT_ID}> rebuild-leaderboards
+
     *Delete Bit History:*
     - <@{BOT_ID}> delete-bit-history <semester tag> 
     - I.e., <@{BOT_ID}> delete-bit-history Spring 2024
@@ -305,36 +309,28 @@ def promote_user(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can promote users")
 
-    user = extract_user_id(arguments[2])
+    user = arguments["user_id"]
     change_user_role(user, "admin")
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> promoted <@{user}> to admin!",
-    )
+    audit_log.log(client, f"<@{user_id}> promoted <@{user}> to admin!")
 
 
 def demote_user(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can demote users")
 
-    user = extract_user_id(arguments[2])
+    user = arguments["user_id"]
     change_user_role(user, "user")
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> demoted <@{user}> to user!",
-    )
+    audit_log.log(client, f"<@{user_id}> demoted <@{user}> to user!")
 
 
 def clear_bits(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can clear bits")
 
-    set_user_bits_to_zero()
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"], text=f"<@{user_id}> cleared bits!"
-    )
+    set_user_bits_to_zero(user_id, "clear-bits")
+    audit_log.log(client, f"<@{user_id}> cleared bits!")
 
 
 def clear_teams(client, arguments, user_id, channel_id):
@@ -343,22 +339,59 @@ def clear_teams(client, arguments, user_id, channel_id):
 
     set_teams_to_no_team()
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"], text=f"<@{user_id}> cleared all teams!"
-    )
+    audit_log.log(client, f"<@{user_id}> cleared all teams!")
+
+
+def rebuild_leaderboards(client, arguments, user_id, channel_id):
+    if not user_is_admin(user_id):
+        raise Exception("Only admins can rebuild leaderboards")
+
+    drift = rebuild_team_leaderboard()
+
+    if drift:
+        details = ", ".join(
+            f"{team}: {counts['stored']} -> {counts['actual']}"
+            for team, counts in sorted(drift.items())
+        )
+        audit_log.log(
+            client, f"<@{user_id}> rebuilt leaderboards, corrected drift in {details}"
+        )
+    else:
+        audit_log.log(client, f"<@{user_id}> rebuilt leaderboards, no drift found")
 
 
 def save_bit_history(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can save bit history")
 
-    tag = " ".join(arguments[2:])
+    tag = arguments["tag"]
 
-    record_bit_history(tag)
+    recorded = record_bit_history(tag)
+    # Semester boundaries are a natural point to checkpoint the ledger.
+    create_bit_checkpoint()
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> saved bit history for {tag}!",
+    audit_log.log(
+        client, f"<@{user_id}> saved bit history for {tag} ({recorded} users)!"
+    )
+
+
+def rollover(client, arguments, user_id, channel_id):
+    if not user_is_admin(user_id):
+        raise Exception("Only admins can roll over the semester")
+
+    tag = arguments["tag"]
+
+    def report(message):
+        audit_log.log(client, f"<@{user_id}> rollover to {tag}: {message}")
+        audit_log.flush()
+
+    report("started")
+    counts = rollover_semester(tag, user_id, "rollover", report)
+
+    audit_log.log(
+        client,
+        f"<@{user_id}> rolled over {tag}: archived {counts['bits']} bits for "
+        f"{counts['users']} users and cleared {counts['teams']} team assignments!",
     )
 
 
@@ -366,38 +399,123 @@ def delete_bit_history(client, arguments, user_id, channel_id):
     if not user_is_admin(user_id):
         raise Exception("Only admins can delete bit history")
 
-    tag = " ".join(arguments[2:])
+    tag = arguments["tag"]
 
     remove_bit_history_by_tag(tag)
 
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{user_id}> deleted bit history for {tag}!",
-    )
+    audit_log.log(client, f"<@{user_id}> deleted bit history for {tag}!")
+
+
+def is_valid_amount(amount):
+    # Amounts arrive as JSON; "5" or true would otherwise reach $inc.
+    return isinstance(amount, int) and not isinstance(amount, bool) and amount > 0
 
 
 def integration_give_bit(client, integration_name, user_id, amount):
-    if not is_positive_integer(amount):
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{integration_name}>: {amount} is not a valid amount; {amount} must be an integer amount > 0",
+    if not is_valid_amount(amount):
+        audit_log.log(
+            client,
+            f"<@{integration_name}>: {amount} is not a valid amount; {amount} must be an integer amount > 0",
         )
         raise Exception(
             f"{amount} is not a valid amount; {amount} must be an integer amount > 0"
         )
 
-    if not client.users_info(user=user_id)["ok"]:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{integration_name}>: Mentioned user, {user_id}, does not exist.",
+    if get_user_profile(client, user_id) is None:
+        audit_log.log(
+            client, f"<@{integration_name}>: Mentioned user, {user_id}, does not exist."
         )
         raise Exception(f"Mentioned user, {user_id}, does not exist.")
 
-    give_bits_to_user(user_id, amount)
-    client.chat_postMessage(
-        channel=os.environ["BOT_LOGS_CHANNEL"],
-        text=f"<@{integration_name}> gave {amount} bits to <@{user_id}>",
+    give_bits_to_user(user_id, amount, integration_name, "integration")
+    audit_log.log(client, f"<@{integration_name}> gave {amount} bits to <@{user_id}>")
+
+
+def validate_grants_batch(grants):
+    if not isinstance(grants, list) or not grants:
+        raise Exception("grants must be a non-empty list")
+
+    if len(grants) > INTEGRATION_BATCH_MAX_GRANTS:
+        raise Exception(
+            f"A batch can contain at most {INTEGRATION_BATCH_MAX_GRANTS} grants, {len(grants)} were given"
+        )
+
+
+def integration_give_bits_batch(client, integration_name, grants):
+    validate_grants_batch(grants)
+
+    results = []
+    seen_keys = set()
+    for grant in grants:
+        grant = grant if isinstance(grant, dict) else {}
+        user_id = grant.get("user_id")
+        amount = grant.get("amount")
+        key = grant.get("idempotency_key")
+        result = {"idempotency_key": key, "user_id": user_id, "amount": amount}
+
+        if not isinstance(key, str) or not key:
+            result["error"] = "idempotency_key must be a non-empty string"
+        elif key in seen_keys:
+            result["error"] = f"idempotency_key {key} appears more than once"
+        elif not isinstance(user_id, str) or not user_id:
+            result["error"] = "user_id must be a non-empty string"
+        elif not is_valid_amount(amount):
+            result["error"] = (
+                f"{amount} is not a valid amount; {amount} must be an integer amount > 0"
+            )
+
+        if isinstance(key, str):
+            seen_keys.add(key)
+        result["status"] = "invalid" if "error" in result else "pending"
+        results.append(result)
+
+    pending = [result for result in results if result["status"] == "pending"]
+    profiles = get_user_profiles(client, [result["user_id"] for result in pending])
+    for result in pending:
+        if profiles[result["user_id"]] is None:
+            result["status"] = "invalid"
+            result["error"] = f"Mentioned user, {result['user_id']}, does not exist."
+
+    pending = [result for result in results if result["status"] == "pending"]
+    claimed = claim_integration_grant_keys(
+        integration_name,
+        [
+            (result["idempotency_key"], result["user_id"], result["amount"])
+            for result in pending
+        ],
+    )
+    for result, is_new in zip(pending, claimed):
+        if not is_new:
+            result["status"] = "duplicate"
+
+    pending = [result for result in results if result["status"] == "pending"]
+    # Keys of grants that were not applied come back released, so the
+    # integration can retry them; everything else is granted exactly once.
+    failed = apply_integration_grants(
+        integration_name,
+        [
+            (result["idempotency_key"], result["user_id"], result["amount"])
+            for result in pending
+        ],
     )
+    for result in pending:
+        if result["idempotency_key"] in failed:
+            result["status"] = "failed"
+            result["error"] = "The grant could not be applied; retry it"
+        else:
+            result["status"] = "applied"
+    applied = [result for result in pending if result["status"] == "applied"]
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    audit_log.log(
+        client,
+        f"<@{integration_name}> gave {sum(r['amount'] for r in applied)} bits in a batch of {len(results)} grants ({summary})",
+    )
+
+    return results
 
 
 if __name__ == "__main__":
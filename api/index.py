@@ -1,9 +1,12 @@
-import slack
 import os
 from dotenv import load_dotenv
 from flask import Flask, Response, request
 from slackeventsapi import SlackEventAdapter
+import csv
+import io
 import json
+import time
+from datetime import datetime, timezone
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -18,9 +21,35 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from actions import *
-from helper import extract_user_id
-
-client = slack.WebClient(token=os.environ["SLACK_BOT_TOKEN"])
+from audit_log import audit_log
+from command_parser import COMMAND_SCHEMAS, is_command, parse_command
+from dedup import get_dedup_stats, is_duplicate_event
+from config import (
+    APPLY_INDEXES_ON_STARTUP,
+    COMMAND_DISPATCH_MODE,
+    COMMAND_QUEUE_SIZE,
+    COMMAND_WORKERS,
+    LEADERBOARD_PAGE_DEFAULT_SIZE,
+    LEADERBOARD_PAGE_MAX_SIZE,
+    LEDGER_ENTRIES_MAX_PAGE_SIZE,
+    STORAGE_BACKEND,
+    WORKSPACE_DIRECTORY_MAX_PAGES_PER_SYNC,
+    WORKSPACE_DIRECTORY_SYNC_SECONDS,
+)
+from metrics import (
+    Gauge,
+    command_duration,
+    command_errors,
+    integration_rate_limited,
+    render_metrics,
+)
+from profiles import get_profile_cache_stats
+from rate_limit import integration_rate_limiter
+from schema import ensure_indexes
+from slack_client import get_bot_id, get_client
+from slack_scheduler import slack_scheduler
+from worker import CommandWorker
+from workspace_directory import save_workspace_user, sync_workspace_directory
 
 slack_event_adapter = SlackEventAdapter(
     os.environ["SLACK_SIGNING_SECRET"], "/slack/events", app
@@ -32,21 +61,8 @@ valid_channels = [
     os.environ["MAPSCOUT_NOTIFICATIONS_CHANNEL"],
 ]
 
-Action = {
-    "GIVE": "give",
-    "REMOVE": "remove",
-    "LEADERBOARD": "leaderboard",
-    "SET_TEAM": "set-team",
-    "TEAM_LEADERBOARD": "team-leaderboard",
-    "HELP": "help",
-    "PROMOTE": "promote",
-    "DEMOTE": "demote",
-    "CLEAR_TEAMS": "clear-teams",
-    "GET_BITS": "get-bits",
-    "SAVE_BIT_HISTORY": "save-bit-history",
-    "CLEAR_BITS": "clear-bits",
-    "DELETE_BIT_HISTORY": "delete-bit-history",
-}
+# Command names come from the parser's schemas so the two can't drift apart.
+Action = {name.upper().replace("-", "_"): name for name in COMMAND_SCHEMAS}
 ActionNameToAction = {
     Action.get("GIVE"): give_bit,
     Action.get("REMOVE"): remove_bit,
@@ -61,14 +77,71 @@ ActionNameToAction = {
     Action.get("SAVE_BIT_HISTORY"): save_bit_history,
     Action.get("DELETE_BIT_HISTORY"): delete_bit_history,
     Action.get("CLEAR_BITS"): clear_bits,
+    Action.get("REBUILD_LEADERBOARDS"): rebuild_leaderboards,
+    Action.get("RANK"): get_rank,
+    Action.get("HISTORY"): get_history,
+    Action.get("ROLLOVER"): rollover,
 }
+if set(ActionNameToAction) != set(COMMAND_SCHEMAS):
+    raise Exception("Every command in COMMAND_SCHEMAS needs exactly one action")
+
+command_worker = CommandWorker(COMMAND_WORKERS, COMMAND_QUEUE_SIZE)
 
-BOT_ID = client.api_call("auth.test")["user_id"]
+Gauge(
+    "bitbot_command_queue_depth",
+    "Commands waiting for a background worker",
+    lambda: command_worker.stats()["queue_depth"],
+)
+Gauge(
+    "bitbot_audit_log_buffered_lines",
+    "Audit log lines waiting to be flushed",
+    lambda: audit_log.stats()["buffered_lines"],
+)
+Gauge(
+    "bitbot_profile_cache_hits",
+    "Slack profile cache hits since startup",
+    lambda: get_profile_cache_stats()["hits"],
+)
+Gauge(
+    "bitbot_profile_cache_misses",
+    "Slack profile cache misses since startup",
+    lambda: get_profile_cache_stats()["misses"],
+)
+
+
+@app.before_request
+def apply_indexes_on_first_request():
+    # Deferred from import time so cold starts and health checks stay off Mongo.
+    # The SQLite backend creates its tables and indexes when it connects.
+    if (
+        APPLY_INDEXES_ON_STARTUP
+        and STORAGE_BACKEND == "mongo"
+        and request.endpoint not in ("health", "metrics")
+    ):
+        ensure_indexes()
 
 
 @app.route("/health")
 def health():
-    return {"health": os.environ["ENV_TEST"]}
+    return {
+        "health": os.environ["ENV_TEST"],
+        "profile_cache": get_profile_cache_stats(),
+        "commands": command_worker.stats(),
+        "audit_log": audit_log.stats(),
+        "recent_message_ids": get_dedup_stats(),
+        "admin_role_cache": admin_role_cache.stats(),
+        "slack_scheduler": slack_scheduler.stats(),
+    }
+
+
+@app.route("/metrics")
+def metrics():
+    metrics_token = os.getenv("METRICS_TOKEN")
+    auth_token = request.headers.get("Authorization", "").split(" ")[-1]
+    if metrics_token and auth_token != metrics_token:
+        return Response("Unauthorized\n", 401, mimetype="text/plain")
+
+    return Response(render_metrics(), 200, mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/slack/events", methods=["POST"])
@@ -78,6 +151,7 @@ def handle_challenge():
 
 @app.route("/slack/events/interactivity", methods=["POST"])
 def handle_interactivity():
+    client = get_client()
     try:
         message = json.loads(request.form.get("payload"))
         action = message.get("actions")[0].get("action_id")
@@ -91,14 +165,14 @@ def handle_interactivity():
             set_team_action_handler(client, selected_option, user_id, channel_id)
         return {}
     except Exception as e:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: an exception occurred - {e}",
-        )
+        audit_log.log(client, f"<@{user_id}>: an exception occurred - {e}")
+    finally:
+        audit_log.flush()
 
 
 @app.route("/bog/analytics-log", methods=["POST"])
 def handle_analytics_logs():
+    client = get_client()
     message = request.json["message"]
     client.chat_postMessage(
         channel=os.environ["ANALYTICS_LOGS_CHANNEL"], text=f"{message}"
@@ -108,6 +182,7 @@ def handle_analytics_logs():
 
 @app.route("/bog/mapscout", methods=["POST"])
 def handle_mapscount_event():
+    client = get_client()
     email = request.json["email"]
     client.chat_postMessage(
         channel=os.environ["MAPSCOUT_NOTIFICATIONS_CHANNEL"],
@@ -116,8 +191,63 @@ def handle_mapscount_event():
     return {"success": True, "email": email}
 
 
+def is_authorized_integration():
+    auth_token = request.headers.get("Authorization", "")
+    if auth_token:
+        # You can use Bearer <token> or just <token> as the header
+        auth_token = auth_token.split(" ")[-1]
+
+    return auth_token == os.getenv("INTEGRATION_SECRET_TOKEN")
+
+
+def is_authorized_cron():
+    # Vercel cron jobs send Authorization: Bearer $CRON_SECRET; the integration
+    # token is accepted too so the sync can be run by hand.
+    cron_secret = os.getenv("CRON_SECRET")
+    if cron_secret and request.headers.get("Authorization") == f"Bearer {cron_secret}":
+        return True
+
+    return is_authorized_integration()
+
+
+def check_integration_rate_limit(integration_name, cost=1):
+    allowed, retry_after = integration_rate_limiter.acquire(integration_name, cost)
+    if allowed:
+        return None
+
+    integration_rate_limited.inc(integration=integration_name)
+    if retry_after is None:
+        return {
+            "success": False,
+            "message": f"{integration_name}: request needs {cost} tokens, "
+            "which is more than the rate limit allows at once",
+        }, 429
+
+    return (
+        {
+            "success": False,
+            "message": f"{integration_name}: rate limit exceeded, "
+            f"retry in {retry_after} seconds",
+        },
+        429,
+        {"Retry-After": str(retry_after)},
+    )
+
+
+@app.route("/api/integrations/rate-limits")
+def integration_rate_limits():
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    return {"success": True, "buckets": integration_rate_limiter.state()}, 200
+
+
 @app.route("/api/integrations/give-bits", methods=["POST"])
 def integration_give_bits():
+    client = get_client()
     try:
         # this can be anything - just used for logging purposes
         integration_name = request.json["integration_name"]
@@ -126,12 +256,7 @@ def integration_give_bits():
         # user you want to give bits to
         user_id = request.json["user_id"]
 
-        auth_token = request.headers.get("Authorization", "")
-        if auth_token:
-            # You can use Bearer <token> or just <token> as the header
-            auth_token = auth_token.split(" ")[-1]
-
-        if auth_token != os.getenv("INTEGRATION_SECRET_TOKEN"):
+        if not is_authorized_integration():
             return Response(
                 {
                     "success": False,
@@ -140,6 +265,10 @@ def integration_give_bits():
                 401,
             )
 
+        rate_limited = check_integration_rate_limit(integration_name)
+        if rate_limited:
+            return Response(*rate_limited)
+
         integration_give_bit(client, integration_name, user_id, amount)
         return Response(
             {
@@ -149,48 +278,344 @@ def integration_give_bits():
             200,
         )
     except Exception as e:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{integration_name}>: an exception occurred - {e}",
-        )
+        audit_log.log(client, f"<@{integration_name}>: an exception occurred - {e}")
         return Response({"success": False, "message": f"{e}"}, 500)
+    finally:
+        audit_log.flush()
+
+
+@app.route("/api/integrations/give-bits/batch", methods=["POST"])
+def integration_give_bits_batch_route():
+    client = get_client()
+    integration_name = None
+    try:
+        if not is_authorized_integration():
+            return {
+                "success": False,
+                "message": "You are not authorized to access this route",
+            }, 401
+
+        # this can be anything - just used for logging purposes
+        integration_name = request.json["integration_name"]
+        # [{"user_id": ..., "amount": ..., "idempotency_key": ...}, ...]
+        grants = request.json["grants"]
+        # Checked before charging the rate limit, which costs one token per grant.
+        validate_grants_batch(grants)
+
+        rate_limited = check_integration_rate_limit(integration_name, len(grants))
+        if rate_limited:
+            return rate_limited
+
+        results = integration_give_bits_batch(client, integration_name, grants)
+        return {"success": True, "results": results}, 200
+    except Exception as e:
+        audit_log.log(client, f"<@{integration_name}>: an exception occurred - {e}")
+        return {"success": False, "message": f"{e}"}, 500
+    finally:
+        audit_log.flush()
+
+
+def encode_leaderboard_cursor(after):
+    if not after:
+        return None
+
+    return f"{after['position']}:{after['rank']}:{after['bits']}:{after['userId']}"
+
+
+def decode_leaderboard_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        position, rank, bits, user_id = cursor.split(":", 3)
+        return {
+            "position": int(position),
+            "rank": int(rank),
+            "bits": int(bits),
+            "userId": user_id,
+        }
+    except ValueError:
+        raise Exception(f"{cursor} is not a valid leaderboard cursor")
+
+
+@app.route("/api/leaderboard")
+def leaderboard_page():
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    try:
+        tag = request.args.get("tag")
+        limit = request.args.get("limit", LEADERBOARD_PAGE_DEFAULT_SIZE, type=int)
+        if not 0 < limit <= LEADERBOARD_PAGE_MAX_SIZE:
+            raise Exception(f"limit must be between 1 and {LEADERBOARD_PAGE_MAX_SIZE}")
+        after = decode_leaderboard_cursor(request.args.get("cursor"))
+    except Exception as e:
+        return {"success": False, "message": f"{e}"}, 400
+
+    if tag:
+        entries, next_after = get_leaderboard_page_from_history(tag, after, limit)
+    else:
+        entries, next_after = get_leaderboard_page(after, limit)
+
+    return {
+        "success": True,
+        "entries": entries,
+        "next_cursor": encode_leaderboard_cursor(next_after),
+    }, 200
+
+
+@app.route("/api/leaderboard/users/<user_id>")
+def leaderboard_rank(user_id):
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    tag = request.args.get("tag")
+    if tag:
+        rank = get_user_rank_from_history(user_id, tag)
+    else:
+        rank = get_user_rank(user_id)
+
+    if rank is None:
+        return {"success": False, "message": f"{user_id} has no bits recorded"}, 404
+
+    return {"success": True, **rank}, 200
+
+
+def render_bit_history_csv(matrix):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    header = ["userId"]
+    for tag in matrix["tags"]:
+        header.extend([f"{tag} bits", f"{tag} team"])
+    writer.writerow(header)
+
+    for user in matrix["users"]:
+        row = [user["userId"]]
+        for bits, team in zip(user["bits"], user["teams"]):
+            row.extend(["" if bits is None else bits, team or ""])
+        writer.writerow(row)
+
+    return output.getvalue()
+
+
+@app.route("/api/history")
+def bit_history_matrix():
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    # Every user's bits and team per semester tag, or one user's with ?user_id=
+    matrix = get_bit_history_matrix(request.args.get("user_id"))
+
+    if request.args.get("format") == "csv":
+        return Response(
+            render_bit_history_csv(matrix),
+            200,
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=bit-history.csv"},
+        )
+
+    return {"success": True, **matrix}, 200
+
+
+def parse_ledger_time(value):
+    if not value:
+        return datetime.utcnow()
+
+    # Stored times are naive UTC. fromisoformat only accepts a Z suffix from
+    # Python 3.11 on.
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    try:
+        at = datetime.fromisoformat(value)
+    except ValueError:
+        raise Exception(f"{value} is not an ISO 8601 time")
+
+    if at.tzinfo:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    return at
+
+
+@app.route("/api/ledger/entries")
+def ledger_entries():
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    user_id = request.args.get("user_id")
+    limit = request.args.get("limit", 50, type=int)
+    if not user_id or not 0 < limit <= LEDGER_ENTRIES_MAX_PAGE_SIZE:
+        return {
+            "success": False,
+            "message": f"user_id is required and limit must be between 1 and {LEDGER_ENTRIES_MAX_PAGE_SIZE}",
+        }, 400
+
+    return {"success": True, "entries": get_ledger_entries(user_id, limit)}, 200
+
+
+@app.route("/api/ledger/balances")
+def ledger_balances():
+    if not is_authorized_integration():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    # Balances and leaderboard as they stood at ?at= (UTC, default now).
+    try:
+        at = parse_ledger_time(request.args.get("at"))
+        limit = request.args.get("limit", LEADERBOARD_PAGE_DEFAULT_SIZE, type=int)
+        if not 0 < limit <= LEADERBOARD_PAGE_MAX_SIZE:
+            raise Exception(f"limit must be between 1 and {LEADERBOARD_PAGE_MAX_SIZE}")
+    except Exception as e:
+        return {"success": False, "message": f"{e}"}, 400
+
+    if not has_bit_ledger_bootstrap():
+        # Every balance would be missing what was earned before the ledger.
+        return {
+            "success": False,
+            "message": "The bit ledger hasn't been bootstrapped; run "
+            "`python schema.py bootstrap-ledger`",
+        }, 409
+
+    user_id = request.args.get("user_id")
+    if user_id:
+        bits = get_user_balance_at(user_id, at)
+        return {"success": True, "at": at.isoformat(), "userId": user_id, "bits": bits}
+
+    return {
+        "success": True,
+        "at": at.isoformat(),
+        "entries": get_leaderboard_at(at, limit),
+    }, 200
+
+
+@app.route("/api/directory/sync", methods=["GET", "POST"])
+def sync_directory():
+    if not is_authorized_cron():
+        return {
+            "success": False,
+            "message": "You are not authorized to access this route",
+        }, 401
+
+    # Called hourly by the cron in vercel.json. Does nothing until the last
+    # pass is WORKSPACE_DIRECTORY_REFRESH_SECONDS old unless ?force=true, and
+    # a pass that doesn't fit in WORKSPACE_DIRECTORY_SYNC_SECONDS carries on
+    # from the saved cursor on the next call.
+    result = sync_workspace_directory(
+        get_client(),
+        WORKSPACE_DIRECTORY_MAX_PAGES_PER_SYNC,
+        force=request.args.get("force") == "true",
+        time_budget=WORKSPACE_DIRECTORY_SYNC_SECONDS,
+    )
+    return {"success": True, **result}, 200
+
+
+def run_command(action, arguments, user_id, channel_id, timestamp):
+    client = get_client()
+    start = time.perf_counter()
+    try:
+        ActionNameToAction[action](client, arguments, user_id, channel_id)
+
+        client.reactions_add(
+            channel=channel_id,
+            timestamp=timestamp,
+            name="white_check_mark",
+            headers={"x-slack-no-retry": "1"},
+        )
+    except Exception as e:
+        command_errors.inc(command=action)
+        audit_log.log(client, f"<@{user_id}>: an exception occurred - {e}")
+        client.reactions_add(
+            channel=channel_id,
+            timestamp=timestamp,
+            name="x",
+            headers={"x-slack-no-retry": "1"},
+        )
+        raise
+    finally:
+        command_duration.observe(time.perf_counter() - start, command=action)
+        audit_log.flush()
+
+
+def run_command_async(action, arguments, user_id, channel_id, timestamp):
+    import async_engine
+
+    async_engine.run_command(
+        action, ActionNameToAction[action], arguments, user_id, channel_id, timestamp
+    )
+
+
+def dispatch_command(action, arguments, user_id, channel_id, timestamp):
+    args = (action, arguments, user_id, channel_id, timestamp)
+    if COMMAND_DISPATCH_MODE == "async":
+        try:
+            command_worker.execute(action, run_command_async, *args)
+        except Exception:
+            pass
+        return
+
+    if COMMAND_DISPATCH_MODE == "background" and command_worker.submit(
+        action, run_command, *args
+    ):
+        return
+
+    # Inline mode, or the queue is full and we apply backpressure by running
+    # the command on the request thread.
+    try:
+        command_worker.execute(action, run_command, *args)
+    except Exception:
+        pass
+
+
+@slack_event_adapter.on("user_change")
+@slack_event_adapter.on("team_join")
+def workspace_user_changed(payload):
+    user = payload.get("event", {}).get("user")
+    if isinstance(user, dict) and user.get("id"):
+        save_workspace_user(user)
 
 
 @slack_event_adapter.on("app_mention")
 def app_mention(payload):
+    client = get_client()
     try:
         event = payload.get("event", {})
-        client_message_id = event.get("client_msg_id")
+        message_id = event.get("client_msg_id") or payload.get("event_id")
         channel_id = event.get("channel")
         timestamp = event.get("ts")
         user_id = event.get("user")
 
-        if get_message_by_id(client_message_id):
-            return Response(200)
-        else:
-            create_message_id(client_message_id)
-
         if channel_id not in valid_channels:
             return
 
-        text = event.get("text")
-        arguments = text.split(" ")
-        bot_id = extract_user_id(arguments[0])
-        if bot_id != BOT_ID:
+        # Only a mention at the start of the message is a command.
+        if not is_command(event.get("text"), get_bot_id(client)):
             return
 
-        action = arguments[1]
-        if action not in Action.values():
-            raise Exception(f"{action} is not a valid action")
+        # Claim the event before parsing so a redelivered malformed command
+        # isn't rejected (and reacted to) twice.
+        if is_duplicate_event(message_id):
+            return Response(200)
 
-        ActionNameToAction[action](client, arguments, user_id, channel_id)
+        # Malformed commands are rejected here, before any database work or
+        # Slack call the action would make.
+        command = parse_command(event.get("text"), get_bot_id(client))
+        if command is None:
+            return
 
-        client.reactions_add(
-            channel=channel_id,
-            timestamp=timestamp,
-            name="white_check_mark",
-            headers={"x-slack-no-retry": "1"},
-        )
+        action, arguments = command
+        dispatch_command(action, arguments, user_id, channel_id, timestamp)
 
         return Response(
             {
@@ -200,20 +625,19 @@ def app_mention(payload):
             200,
         )
     except Exception as e:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: an exception occurred - {e}",
-        )
+        audit_log.log(client, f"<@{user_id}>: an exception occurred - {e}")
         client.reactions_add(
             channel=channel_id,
             timestamp=timestamp,
             name="x",
             headers={"x-slack-no-retry": "1"},
         )
+        audit_log.flush()
 
 
 @slack_event_adapter.on("message")
 def message_im(payload):
+    client = get_client()
     try:
         event = payload.get("event", {})
         if event.get("channel_type") != "im":
@@ -223,45 +647,36 @@ def message_im(payload):
         user_id = event.get("user")
         channel_id = event.get("channel")
 
-        text = event.get("text")
-        arguments = text.split(" ")
-        bot_id = extract_user_id(arguments[0])
-
-        if user_id == BOT_ID:
+        if user_id == get_bot_id(client):
             return
 
-        if bot_id != BOT_ID:
+        # Messages that aren't commands cost nothing, not even a dedup claim.
+        if not is_command(event.get("text"), get_bot_id(client)):
             return
 
-        client_message_id = event.get("client_msg_id")
-        if get_message_by_id(client_message_id):
+        # Claim the event before parsing so a redelivered malformed command
+        # isn't rejected (and reacted to) twice.
+        message_id = event.get("client_msg_id") or payload.get("event_id")
+        if is_duplicate_event(message_id):
             return Response(200)
-        else:
-            create_message_id(client_message_id)
 
-        action = arguments[1]
-        if action not in Action.values():
-            raise Exception(f"{action} is not a valid action")
-
-        ActionNameToAction[action](client, arguments, user_id, channel_id)
+        # Malformed commands are rejected here, before any database work or
+        # Slack call the action would make.
+        command = parse_command(event.get("text"), get_bot_id(client))
+        if command is None:
+            return
 
-        client.reactions_add(
-            channel=channel_id,
-            timestamp=timestamp,
-            name="white_check_mark",
-            headers={"x-slack-no-retry": "1"},
-        )
+        action, arguments = command
+        dispatch_command(action, arguments, user_id, channel_id, timestamp)
     except Exception as e:
-        client.chat_postMessage(
-            channel=os.environ["BOT_LOGS_CHANNEL"],
-            text=f"<@{user_id}>: an exception occurred - {e}",
-        )
+        audit_log.log(client, f"<@{user_id}>: an exception occurred - {e}")
         client.reactions_add(
             channel=channel_id,
             timestamp=timestamp,
             name="x",
             headers={"x-slack-no-retry": "1"},
         )
+        audit_log.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+import asyncio
+import os
+import time
+
+# Imported only when COMMAND_DISPATCH_MODE is "async"; aiohttp and the async
+# Slack client add noticeably to a cold start.
+import aiohttp
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from actions import format_leaderboard, report_removals, require_existing_users
+from audit_log import audit_log
+from config import ASYNC_MAX_CONCURRENT_IO
+from database import (
+    get_bits_by_user_id,
+    get_bits_by_user_id_from_history,
+    get_leaderboard_documents,
+    get_leaderboard_documents_from_history,
+    give_bits_to_users,
+    remove_bits_from_users,
+    user_is_admin,
+)
+from metrics import (
+    command_duration,
+    command_errors,
+    slack_calls,
+    slack_duration,
+    slack_errors,
+    slack_rate_limited,
+)
+from profiles import get_user_profiles_async
+from slack_client import get_client
+from slack_scheduler import slack_scheduler
+
+
+class InstrumentedAsyncWebClient(AsyncWebClient):
+    def __init__(self, *args, scheduler=slack_scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def api_call(self, api_method, **kwargs):
+        return await self.scheduler.call_async(
+            api_method, kwargs, lambda: self.send_api_call(api_method, **kwargs)
+        )
+
+    async def send_api_call(self, api_method, **kwargs):
+        slack_calls.inc(method=api_method)
+        start = time.perf_counter()
+        try:
+            return await super().api_call(api_method, **kwargs)
+        except SlackApiError as e:
+            slack_errors.inc(method=api_method)
+            if e.response.status_code == 429:
+                slack_rate_limited.inc(method=api_method)
+            raise
+        finally:
+            slack_duration.observe(time.perf_counter() - start, method=api_method)
+
+
+def make_async_client(session):
+    # The aiohttp session belongs to the command's event loop; sharing it keeps
+    # one connection pool for every call made while handling the command.
+    return InstrumentedAsyncWebClient(
+        token=os.environ["SLACK_BOT_TOKEN"],
+        base_url=os.getenv("SLACK_API_URL", WebClient.BASE_URL),
+        session=session,
+    )
+
+
+class AsyncCommandContext:
+    def __init__(self, session, max_concurrent_io=ASYNC_MAX_CONCURRENT_IO):
+        self.client = make_async_client(session)
+        # The audit log and actions without an async version use the
+        # synchronous client from worker threads.
+        self.sync_client = get_client()
+        self.semaphore = asyncio.Semaphore(max_concurrent_io)
+
+    async def database(self, function, *args):
+        # pymongo blocks, so each query runs on a worker thread; this is what
+        # Motor does under the hood.
+        async with self.semaphore:
+            return await asyncio.to_thread(function, *args)
+
+    async def get_user_profiles(self, user_ids):
+        return await get_user_profiles_async(self.client, user_ids, self.semaphore)
+
+
+def load_leaderboard(tag):
+    if tag:
+        return list(get_leaderboard_documents_from_history(tag))
+
+    return list(get_leaderboard_documents())
+
+
+async def get_bits(context, arguments, user_id, channel_id):
+    tag = arguments.get("tag")
+    if tag:
+        bits = await context.database(get_bits_by_user_id_from_history, user_id, tag)
+    else:
+        bits = await context.database(get_bits_by_user_id, user_id)
+
+    await context.client.chat_postMessage(
+        channel=channel_id,
+        text=f"You have {bits} bits",
+    )
+    audit_log.log(context.sync_client, f"<@{user_id}> printed their bit count")
+
+
+async def give_bit(context, arguments, user_id, channel_id):
+    rewarded_users = arguments["user_ids"]
+    amount = arguments["amount"]
+    # Checked first so a non-admin doesn't spend users.info budget; the role is
+    # usually cached.
+    if not await context.database(user_is_admin, user_id):
+        raise Exception("Only admins can grant bits to others!")
+    profiles = await context.get_user_profiles(rewarded_users)
+    require_existing_users(context.sync_client, user_id, profiles)
+
+    results = await context.database(
+        give_bits_to_users, rewarded_users, amount, user_id, "give"
+    )
+    mentions = ", ".join(f"<@{rewarded_user}>" for rewarded_user in results)
+    audit_log.log(context.sync_client, f"<@{user_id}> gave {amount} bits to {mentions}")
+
+
+async def remove_bit(context, arguments, user_id, channel_id):
+    punished_users = arguments["user_ids"]
+    amount = arguments["amount"]
+    # Checked first so a non-admin doesn't spend users.info budget; the role is
+    # usually cached.
+    if not await context.database(user_is_admin, user_id):
+        raise Exception("Only admins can remove bits from others!")
+    profiles = await context.get_user_profiles(punished_users)
+    require_existing_users(context.sync_client, user_id, profiles)
+
+    results = await context.database(
+        remove_bits_from_users, punished_users, amount, user_id, "remove"
+    )
+    report_removals(context.sync_client, user_id, amount, results)
+
+
+async def get_leaderboard(context, arguments, user_id, channel_id):
+    users = await context.database(load_leaderboard, arguments.get("tag"))
+    profiles = await context.get_user_profiles([user["userId"] for user in users])
+
+    await context.client.chat_postMessage(
+        channel=channel_id, text=format_leaderboard(users, profiles)
+    )
+
+    audit_log.log(context.sync_client, f"<@{user_id}> just printed the leaderboard!")
+
+
+# Commands that fan out to several Slack or Mongo calls. Everything else runs
+# its synchronous action on a worker thread.
+AsyncActions = {
+    "give": give_bit,
+    "remove": remove_bit,
+    "leaderboard": get_leaderboard,
+    "get-bits": get_bits,
+}
+
+
+async def run_action(context, action, sync_action, arguments, user_id, channel_id):
+    async_action = AsyncActions.get(action)
+    if async_action is not None:
+        return await async_action(context, arguments, user_id, channel_id)
+
+    return await asyncio.to_thread(
+        sync_action, context.sync_client, arguments, user_id, channel_id
+    )
+
+
+async def finish_command(context, channel_id, timestamp, reaction):
+    # The reaction and the audit log flush don't depend on each other.
+    # reactions_add() would send headers= as a form field, which aiohttp rejects.
+    await asyncio.gather(
+        context.client.api_call(
+            "reactions.add",
+            params={"channel": channel_id, "timestamp": timestamp, "name": reaction},
+            headers={"x-slack-no-retry": "1"},
+        ),
+        asyncio.to_thread(audit_log.flush),
+    )
+
+
+async def run_command_async(
+    action, sync_action, arguments, user_id, channel_id, timestamp
+):
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        context = AsyncCommandContext(session)
+        try:
+            await run_action(
+                context, action, sync_action, arguments, user_id, channel_id
+            )
+            await finish_command(context, channel_id, timestamp, "white_check_mark")
+        except Exception as e:
+            command_errors.inc(command=action)
+            audit_log.log(
+                context.sync_client, f"<@{user_id}>: an exception occurred - {e}"
+            )
+            await finish_command(context, channel_id, timestamp, "x")
+            raise
+        finally:
+            command_duration.observe(time.perf_counter() - start, command=action)
+
+
+def run_command(action, sync_action, arguments, user_id, channel_id, timestamp):
+    return asyncio.run(
+        run_command_async(
+            action, sync_action, arguments, user_id, channel_id, timestamp
+        )
+    )
@@ -0,0 +1,68 @@
+import os
+import threading
+
+from config import AUDIT_LOG_FLUSH_INTERVAL_SECONDS, AUDIT_LOG_MAX_LINES_PER_MESSAGE
+from slack_scheduler import PRIORITY_BACKGROUND, slack_priority
+
+
+class AuditLogSink:
+    def __init__(self, flush_interval, max_lines_per_message):
+        self.flush_interval = flush_interval
+        self.max_lines_per_message = max_lines_per_message
+        self.posted_messages = 0
+        self.logged_lines = 0
+        self.dropped_lines = 0
+        self._client = None
+        self._lines = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def log(self, client, text):
+        with self._lock:
+            self._client = client
+            self._lines.append(text)
+            self.logged_lines += 1
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            client, lines = self._client, self._lines
+            self._lines = []
+
+        if not lines:
+            return
+
+        # Queued replies to users are sent before audit log messages.
+        with self._flush_lock, slack_priority(PRIORITY_BACKGROUND):
+            for start in range(0, len(lines), self.max_lines_per_message):
+                chunk = lines[start : start + self.max_lines_per_message]
+                try:
+                    client.chat_postMessage(
+                        channel=os.environ["BOT_LOGS_CHANNEL"], text="\n".join(chunk)
+                    )
+                    self.posted_messages += 1
+                except Exception:
+                    # Audit logging must never take a command down with it.
+                    self.dropped_lines += len(chunk)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered_lines": len(self._lines),
+                "logged_lines": self.logged_lines,
+                "posted_messages": self.posted_messages,
+                "dropped_lines": self.dropped_lines,
+            }
+
+
+audit_log = AuditLogSink(
+    AUDIT_LOG_FLUSH_INTERVAL_SECONDS, AUDIT_LOG_MAX_LINES_PER_MESSAGE
+)
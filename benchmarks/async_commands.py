@@ -0,0 +1,143 @@
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+from startup import BENCHMARK_ENV, ROOT
+
+ADMIN_WORKSPACE_SIZE = 100
+LABELS = ["give x15", "remove x15", "leaderboard", "get-bits", "help"]
+
+
+class SlowCollection:
+    def __init__(self, collection, latency):
+        self._collection = collection
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def delayed(*args, **kwargs):
+            time.sleep(self._latency)
+            return attribute(*args, **kwargs)
+
+        return delayed
+
+
+class SlowDatabase:
+    def __init__(self, database, latency):
+        self._database = database
+        self._latency = latency
+
+    def __getitem__(self, name):
+        return SlowCollection(self._database[name], self._latency)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+def get_balances(db_client):
+    return {user["userId"]: user["bits"] for user in db_client["users"].find()}
+
+
+def run_once(run, db_client, size, text, seed):
+    from command_parser import parse_command
+    from commands import ADMIN_ID, BOT_ID, CHANNEL_ID, mention, reset_caches
+    from commands import seed_workspace
+
+    seed_workspace(db_client, size, seed)
+    reset_caches()
+    action, arguments = parse_command(f"{mention(BOT_ID)} {text}", BOT_ID)
+
+    start = time.perf_counter()
+    error = None
+    try:
+        run(action, arguments, ADMIN_ID, CHANNEL_ID, "0.0")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return (time.perf_counter() - start) * 1000, get_balances(db_client), error
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare command latency on the sync and async execution paths"
+    )
+    parser.add_argument("--size", type=int, default=ADMIN_WORKSPACE_SIZE)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--slack-latency-ms", type=float, default=20)
+    parser.add_argument("--mongo-latency-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    from fake_slack import FakeSlackServer
+
+    server = FakeSlackServer()
+    server.latency = args.slack_latency_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ.update(BENCHMARK_ENV)
+    os.environ["SLACK_API_URL"] = server.url
+    os.environ["APPLY_INDEXES_ON_STARTUP"] = "false"
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "api"))
+
+    import mongomock
+
+    import async_engine
+    import index
+    import mongo_storage
+    from commands import get_commands
+    from slack_scheduler import slack_scheduler
+
+    db_client = mongomock.MongoClient()[os.environ["MONGO_DB_DATABASE"]]
+    slow_db = SlowDatabase(db_client, args.mongo_latency_ms / 1000)
+    mongo_storage.get_db_client = lambda: slow_db
+
+    # Measure the execution paths, not Slack's rate limits.
+    slack_scheduler.tier_budgets = {tier: (60000, 1000) for tier in range(1, 5)}
+    slack_scheduler.channel_rate = slack_scheduler.channel_burst = 1000
+
+    def run_async(action, arguments, user_id, channel_id, timestamp):
+        async_engine.run_command(
+            action,
+            index.ActionNameToAction[action],
+            arguments,
+            user_id,
+            channel_id,
+            timestamp,
+        )
+
+    commands = dict(get_commands())
+    failures = 0
+    print(f"{'command':<14} {'sync ms':>9} {'async ms':>9} {'speedup':>8}")
+    for label in LABELS:
+        timings = {"sync": [], "async": []}
+        outcomes = {}
+        for seed in range(args.repeat):
+            for name, run in (("sync", index.run_command), ("async", run_async)):
+                elapsed, balances, error = run_once(
+                    run, db_client, args.size, commands[label], seed
+                )
+                timings[name].append(elapsed)
+                outcomes[name] = (balances, error)
+
+        sync_ms = statistics.median(timings["sync"])
+        async_ms = statistics.median(timings["async"])
+        # Both paths must leave the workspace in the same state.
+        matches = outcomes["sync"] == outcomes["async"]
+        failures += not matches
+        print(
+            f"{label:<14} {sync_ms:>9.1f} {async_ms:>9.1f} {sync_ms / async_ms:>7.2f}x"
+            + ("" if matches else "  MISMATCH")
+        )
+
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
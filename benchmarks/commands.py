@@ -0,0 +1,415 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+from startup import BENCHMARK_ENV, ROOT
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+WORKSPACE_SIZES = [100, 1000, 10000]
+BOT_ID = "UBENCHBOT"
+ADMIN_ID = "UBENCHADMIN"
+CHANNEL_ID = BENCHMARK_ENV["GT_BITS_CHANNEL"]
+HISTORY_TAG = "Spring 2024"
+SNAPSHOT_TAG = "Benchmark Snapshot"
+
+# Collection methods that cost one request to the server.
+MONGO_OPERATIONS = {
+    "aggregate",
+    "bulk_write",
+    "count_documents",
+    "create_index",
+    "create_indexes",
+    "delete_many",
+    "delete_one",
+    "distinct",
+    "estimated_document_count",
+    "find",
+    "find_one",
+    "find_one_and_update",
+    "insert_many",
+    "insert_one",
+    "replace_one",
+    "update_many",
+    "update_one",
+}
+
+# Regression thresholds used by --compare.
+WALL_TIME_TOLERANCE = 0.2
+
+
+def user_id_for(index):
+    return f"U{index:08d}"
+
+
+def mention(user_id):
+    return f"<@{user_id}>"
+
+
+def get_commands():
+    recipients = " ".join(mention(user_id_for(index)) for index in range(15))
+    return [
+        ("get-bits", "get-bits"),
+        ("get-bits <tag>", f"get-bits {HISTORY_TAG}"),
+        ("give x1", f"give {mention(user_id_for(1))} 5"),
+        ("give x15", f"give {recipients} 5"),
+        ("remove x1", f"remove {mention(user_id_for(1))} 1"),
+        ("remove x15", f"remove {recipients} 1"),
+        ("leaderboard", "leaderboard"),
+        ("leaderboard <tag>", f"leaderboard {HISTORY_TAG}"),
+        ("set-team", "set-team"),
+        ("team-leaderboard", "team-leaderboard"),
+        ("team-leaderboard <tag>", f"team-leaderboard {HISTORY_TAG}"),
+        ("help", "help"),
+        ("promote", f"promote {mention(user_id_for(2))}"),
+        ("demote", f"demote {mention(user_id_for(2))}"),
+        ("clear-teams", "clear-teams"),
+        ("clear-bits", "clear-bits"),
+        ("save-bit-history", f"save-bit-history {SNAPSHOT_TAG}"),
+        ("delete-bit-history", f"delete-bit-history {HISTORY_TAG}"),
+        ("rebuild-leaderboards", "rebuild-leaderboards"),
+        ("rank", "rank"),
+        ("rank <tag>", f"rank {HISTORY_TAG}"),
+        ("history", "history"),
+        ("rollover", f"rollover {SNAPSHOT_TAG}"),
+    ]
+
+
+class FakeSlackClient:
+    def __init__(self, workspace_user_ids):
+        self.workspace_user_ids = workspace_user_ids
+        self.calls = Counter()
+
+    def users_info(self, user):
+        self.calls["users.info"] += 1
+        if user not in self.workspace_user_ids:
+            return {"ok": False, "error": "user_not_found"}
+
+        return {"ok": True, "user": {"id": user, "real_name": f"Member {user}"}}
+
+    def chat_postMessage(self, **kwargs):
+        self.calls["chat.postMessage"] += 1
+        return {"ok": True, "channel": kwargs.get("channel"), "ts": "0.0"}
+
+    def reactions_add(self, **kwargs):
+        self.calls["reactions.add"] += 1
+        return {"ok": True}
+
+    def api_call(self, api_method, **kwargs):
+        self.calls[api_method] += 1
+        if api_method == "auth.test":
+            return {"ok": True, "user_id": BOT_ID}
+
+        return {"ok": True}
+
+
+class CountingCollection:
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in MONGO_OPERATIONS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._counter["mongo"] += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, database, counter):
+        self._database = database
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class CommandCounter:
+    def __init__(self, counter):
+        self._counter = counter
+
+    def started(self, event):
+        self._counter["mongo"] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def seed_workspace(db_client, size, seed=0):
+    from config import teams
+
+    rng = random.Random(seed)
+    for name in db_client.list_collection_names():
+        db_client[name].drop()
+
+    users = [
+        {
+            "userId": user_id_for(index),
+            "bits": rng.randint(0, 200),
+            "team": rng.choice(teams),
+            "role": "user",
+        }
+        for index in range(size)
+    ]
+    users.append({"userId": ADMIN_ID, "bits": 0, "team": "Exec", "role": "admin"})
+    db_client["users"].insert_many(users)
+    # A synced workspace directory, so name lookups don't call users.info.
+    db_client["workspace_users"].insert_many(
+        [
+            {
+                "_id": user["userId"],
+                "profile": {
+                    "id": user["userId"],
+                    "real_name": f"Member {user['userId']}",
+                    "updated": 1,
+                },
+                "updated": 1,
+            }
+            for user in users
+        ]
+    )
+
+    entries = sorted(
+        ({"userId": u["userId"], "team": u["team"], "bits": u["bits"]} for u in users),
+        key=lambda entry: (-entry["bits"], entry["userId"]),
+    )
+    team_totals = Counter()
+    for entry in entries:
+        team_totals[entry["team"]] += entry["bits"]
+    db_client["team_totals"].insert_many(
+        [{"_id": team, "total_bits": total} for team, total in team_totals.items()]
+    )
+    db_client["bit_history_snapshots"].insert_one(
+        {
+            "_id": HISTORY_TAG,
+            "tag": HISTORY_TAG,
+            "entries": entries,
+            "team_totals": [
+                {"_id": team, "total_bits": total}
+                for team, total in sorted(
+                    team_totals.items(), key=lambda item: (-item[1], item[0])
+                )
+            ],
+            "user_count": len(entries),
+            "createdAt": datetime.utcnow(),
+        }
+    )
+
+    return {user["userId"] for user in users}
+
+
+def reset_caches():
+    import database
+    import dedup
+    import profiles
+
+    profiles.profile_cache.clear()
+    database.admin_role_cache.clear()
+    dedup.recent_message_ids.clear()
+
+
+def run_once(index, db_client, counter, size, label, text, seed):
+    import slack_client
+    from command_parser import parse_command
+
+    workspace = seed_workspace(db_client, size, seed)
+    fake_client = FakeSlackClient(workspace)
+    slack_client.InstrumentedWebClient = lambda **kwargs: fake_client
+    slack_client.get_client.cache_clear()
+    reset_caches()
+
+    counter.clear()
+    start = time.perf_counter()
+    error = None
+    try:
+        if label == "integration give-bits":
+            response = index.app.test_client().post(
+                "/api/integrations/give-bits",
+                json={
+                    "integration_name": "benchmark",
+                    "amount": 5,
+                    "user_id": user_id_for(3),
+                },
+                headers={"Authorization": "Bearer benchmark"},
+            )
+            if response.status_code >= 400:
+                error = f"HTTP {response.status_code}"
+        else:
+            action, arguments = parse_command(f"{mention(BOT_ID)} {text}", BOT_ID)
+            index.run_command(action, arguments, ADMIN_ID, CHANNEL_ID, "0.0")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+
+    return {
+        "wall_ms": elapsed * 1000,
+        "mongo_round_trips": counter["mongo"],
+        "slack_calls": dict(fake_client.calls),
+        "error": error,
+    }
+
+
+def run_benchmarks(args):
+    os.environ.update(BENCHMARK_ENV)
+    os.environ["MONGO_DB_URL"] = args.mongo_url
+    os.environ["INTEGRATION_SECRET_TOKEN"] = "benchmark"
+    os.environ["APPLY_INDEXES_ON_STARTUP"] = "false"
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "api"))
+
+    counter = Counter()
+    if args.in_memory:
+        import mongomock
+        import mongo_storage
+
+        in_memory_db = mongomock.MongoClient()[os.environ["MONGO_DB_DATABASE"]]
+        counting_db = CountingDatabase(in_memory_db, counter)
+        mongo_storage.get_db_client = lambda: counting_db
+        db_client = in_memory_db
+    else:
+        import pymongo.monitoring
+
+        pymongo.monitoring.register(CommandCounter(counter))
+        import mongo_storage
+
+        db_client = mongo_storage.get_db_client()
+
+    import index
+    import schema
+
+    if not args.in_memory:
+        schema.apply_indexes()
+
+    commands = get_commands() + [("integration give-bits", None)]
+    if args.only:
+        commands = [command for command in commands if command[0] in args.only]
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = {}
+        for label, text in commands:
+            runs = [
+                run_once(index, db_client, counter, size, label, text, seed)
+                for seed in range(args.repeat)
+            ]
+            # Counting is deterministic; wall time is summarised over repeats.
+            result = dict(runs[0])
+            result["wall_ms"] = statistics.median(run["wall_ms"] for run in runs)
+            results[str(size)][label] = result
+            print(
+                f"{size:>6} users  {label:<24} {result['wall_ms']:>9.2f} ms  "
+                f"mongo={result['mongo_round_trips']:<4} "
+                f"slack={sum(result['slack_calls'].values()):<4}"
+                + (f"  ERROR {result['error']}" if result["error"] else "")
+            )
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline, current):
+    regressions = []
+    for size, commands in current["results"].items():
+        for label, result in commands.items():
+            previous = baseline["results"].get(size, {}).get(label)
+            if not previous:
+                continue
+
+            if result["mongo_round_trips"] > previous["mongo_round_trips"]:
+                regressions.append(
+                    f"{size} {label}: mongo round trips "
+                    f"{previous['mongo_round_trips']} -> {result['mongo_round_trips']}"
+                )
+
+            slack_before = sum(previous["slack_calls"].values())
+            slack_after = sum(result["slack_calls"].values())
+            if slack_after > slack_before:
+                regressions.append(
+                    f"{size} {label}: slack calls {slack_before} -> {slack_after}"
+                )
+
+            if result["wall_ms"] > previous["wall_ms"] * (1 + WALL_TIME_TOLERANCE):
+                regressions.append(
+                    f"{size} {label}: wall time "
+                    f"{previous['wall_ms']:.2f} -> {result['wall_ms']:.2f} ms"
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every bot command against a fake Slack workspace"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=WORKSPACE_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", help="Command labels to run")
+    parser.add_argument(
+        "--mongo-url",
+        default=os.getenv("BENCHMARK_MONGO_URL", "mongodb://localhost:27017"),
+        help="Local Mongo to benchmark against; its benchmark database is dropped",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Use mongomock instead of a Mongo server (no $merge support)",
+    )
+    parser.add_argument("--output", help="Where to save results as JSON")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    args = parser.parse_args()
+
+    commit = get_commit()
+    current = {
+        "commit": commit,
+        "created_at": datetime.utcnow().isoformat(),
+        "mongo": "mongomock" if args.in_memory else "server",
+        "results": run_benchmarks(args),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(current, results_file, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), current)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
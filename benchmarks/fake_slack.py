@@ -0,0 +1,246 @@
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from startup import ROOT
+
+sys.path.insert(0, ROOT)
+
+from slack_client import InstrumentedWebClient
+from slack_scheduler import PRIORITY_BACKGROUND, SlackScheduler, slack_priority
+
+
+class FakeSlackServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Async clients open many connections at once.
+    request_queue_size = 64
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSlackHandler)
+        self.connections = 0
+        self.requests = Counter()
+        self.messages = []
+        # method -> list of Retry-After values to answer with before succeeding
+        self.rate_limits = {}
+        # Seconds each request takes, to stand in for the round trip to Slack
+        self.latency = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/"
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, Nagle's algorithm
+    # holds the body back on kept-alive connections.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_arguments(self):
+        # slack_sdk's sync client always POSTs; the aiohttp client sends GET
+        # for methods such as users.info.
+        if self.command == "GET":
+            query = self.path.partition("?")[2]
+            return {key: values[0] for key, values in parse_qs(query).items()}
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get_content_type() == "application/json":
+            return json.loads(body or b"{}")
+
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def respond(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1].split("?")[0]
+        arguments = self.read_arguments()
+
+        with self.server.lock:
+            self.server.requests[method] += 1
+            pending = self.server.rate_limits.get(method)
+            retry_after = pending.pop(0) if pending else None
+            if retry_after is None and method == "chat.postMessage":
+                self.server.messages.append(arguments.get("text"))
+
+        time.sleep(self.server.latency)
+        if retry_after is not None:
+            self.respond(
+                429, {"ok": False, "error": "ratelimited"}, {"Retry-After": retry_after}
+            )
+        elif method == "auth.test":
+            self.respond(200, {"ok": True, "user_id": "UFAKEBOT"})
+        elif method == "users.info":
+            user = arguments.get("user")
+            self.respond(200, {"ok": True, "user": {"id": user, "real_name": user}})
+        else:
+            self.respond(200, {"ok": True})
+
+    do_GET = do_POST
+
+
+def make_client(
+    server,
+    tier_budgets=None,
+    channel_rate=100,
+    channel_burst=100,
+    interactive_max_wait=None,
+):
+    scheduler = SlackScheduler(
+        {"users.info": 4},
+        tier_budgets or {3: (6000, 100), 4: (6000, 100)},
+        channel_rate,
+        channel_burst,
+        max_retries=3,
+        max_retry_after=5,
+        interactive_max_wait=interactive_max_wait,
+    )
+    client = InstrumentedWebClient(
+        token="xoxb-fake", base_url=server.url, scheduler=scheduler
+    )
+    return client, scheduler
+
+
+def check_connection_reuse(server):
+    client, _ = make_client(server)
+    before = server.connections
+    for index in range(20):
+        client.users_info(user=f"U{index}")
+
+    opened = server.connections - before
+    return opened == 1, f"20 calls opened {opened} connection(s)"
+
+
+def check_connections_shared_across_threads(server):
+    # Each lookup batch runs on short-lived executor threads; connections must
+    # outlive them rather than pile up per thread.
+    client, _ = make_client(server)
+    before = server.connections
+    for batch in range(5):
+        threads = [
+            threading.Thread(target=client.users_info, kwargs={"user": f"U{index}"})
+            for index in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    opened = server.connections - before
+    client.close_connections()
+    return opened <= 2, f"5 batches of 2 threads opened {opened} connection(s)"
+
+
+def check_retry_after(server):
+    client, scheduler = make_client(server)
+    server.rate_limits["reactions.add"] = ["0.2", "0.2"]
+    start = time.monotonic()
+    client.reactions_add(channel="C1", timestamp="1.0", name="thumbsup")
+    elapsed = time.monotonic() - start
+
+    retried = scheduler.stats()["retried_calls"]
+    return (
+        retried == 2 and elapsed >= 0.4,
+        f"succeeded after {retried} retries in {elapsed:.2f}s",
+    )
+
+
+def check_tier_budget(server):
+    # Two calls up front, then one every half second.
+    client, _ = make_client(server, tier_budgets={4: (120, 2)})
+    start = time.monotonic()
+    for index in range(4):
+        client.users_info(user=f"U{index}")
+    elapsed = time.monotonic() - start
+
+    return elapsed >= 0.9, f"4 calls on a 2 call burst took {elapsed:.2f}s"
+
+
+def check_inline_wait_cap(server):
+    # Inline commands must answer Slack within 3 seconds, so an exhausted
+    # budget fails fast instead of waiting two seconds for a token.
+    client, _ = make_client(server, tier_budgets={4: (30, 1)}, interactive_max_wait=0.2)
+    client.users_info(user="U1")
+    start = time.monotonic()
+    try:
+        client.users_info(user="U2")
+        failed = False
+    except Exception:
+        failed = True
+    elapsed = time.monotonic() - start
+
+    with slack_priority(PRIORITY_BACKGROUND):
+        background_start = time.monotonic()
+        client.users_info(user="U3")
+        background_waited = time.monotonic() - background_start
+
+    return (
+        failed and elapsed < 0.2 and background_waited >= 1.5,
+        f"interactive call gave up after {elapsed:.2f}s, background call waited {background_waited:.2f}s",
+    )
+
+
+def check_priority(server):
+    client, _ = make_client(server, channel_rate=5, channel_burst=1)
+    server.messages.clear()
+    client.chat_postMessage(channel="C1", text="first")
+
+    def post_audit_log():
+        with slack_priority(PRIORITY_BACKGROUND):
+            client.chat_postMessage(channel="C1", text="audit")
+
+    background = threading.Thread(target=post_audit_log)
+    background.start()
+    time.sleep(0.05)
+    client.chat_postMessage(channel="C1", text="reply")
+    background.join()
+
+    return (
+        server.messages == ["first", "reply", "audit"],
+        f"messages sent in order {server.messages}",
+    )
+
+
+def main():
+    server = FakeSlackServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    failures = 0
+    for check in (
+        check_connection_reuse,
+        check_connections_shared_across_threads,
+        check_retry_after,
+        check_tier_budget,
+        check_inline_wait_cap,
+        check_priority,
+    ):
+        passed, detail = check(server)
+        failures += not passed
+        print(f"{'PASS' if passed else 'FAIL'} {check.__name__}: {detail}")
+
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from startup import BENCHMARK_ENV, ROOT
+
+ALICE, BOB, CAROL, DAVE, ERIN = "UALICE", "UBOB", "UCAROL", "UDAVE", "UERIN"
+TAG = "Spring 2024"
+
+
+class Mark:
+    # Stands in for the time recorded by a "mark" step of the same section.
+    def __init__(self, name):
+        self.name = name
+
+
+def profile(user_id, updated):
+    return {
+        "id": user_id,
+        "name": user_id.lower(),
+        "deleted": False,
+        "updated": updated,
+    }
+
+
+# Each section starts from an empty store. A step is (label, function, args);
+# the "mark" function records the current time for later Mark arguments.
+SECTIONS = {
+    "balances": [
+        ("give alice", "give_bits_to_user", (ALICE, 10, "UADMIN", "give")),
+        (
+            "give several",
+            "give_bits_to_users",
+            ([BOB, CAROL, BOB, ALICE], 5, "UADMIN", "give"),
+        ),
+        (
+            "grant batch",
+            "apply_bit_grants",
+            ([(DAVE, 3), (DAVE, 4), (ERIN, 5)], "UADMIN", "integration"),
+        ),
+        ("bits alice", "get_bits_by_user_id", (ALICE,)),
+        ("bits unknown", "get_bits_by_user_id", ("UNOBODY",)),
+        ("remove bob", "remove_bits_from_user", (BOB, 2, "UADMIN", "remove")),
+        ("remove too many", "remove_bits_from_user", (BOB, 100, "UADMIN", "remove")),
+        ("remove unknown", "remove_bits_from_user", ("UNOBODY", 1, "UADMIN", "remove")),
+        (
+            "remove several",
+            "remove_bits_from_users",
+            ([CAROL, DAVE, ERIN, CAROL], 5, "UADMIN", "remove"),
+        ),
+        ("join team", "set_team_by_user_id", (ALICE, "Red")),
+        ("join other team", "set_team_by_user_id", (BOB, "Blue")),
+        ("switch team", "set_team_by_user_id", (ALICE, "Blue")),
+        ("team for new user", "set_team_by_user_id", ("UNEW", "Red")),
+        ("leaderboard", "get_leaderboard_documents", (10,)),
+        ("leaderboard top 2", "get_leaderboard_documents", (2,)),
+        ("page 1", "get_leaderboard_page", (None, 2)),
+        ("rank alice", "get_user_rank", (ALICE,)),
+        ("rank tied", "get_user_rank", (DAVE,)),
+        ("rank unknown", "get_user_rank", ("UNOBODY",)),
+        ("team leaderboard", "get_team_leaderboard", ()),
+        ("rebuild teams", "rebuild_team_leaderboard", ()),
+        ("make admin", "change_user_role", (ALICE, "admin")),
+        ("role alice", "get_user_role", (ALICE,)),
+        ("role new admin", "change_user_role", ("UADMIN2", "admin")),
+        ("role unknown", "get_user_role", ("UNOBODY",)),
+        ("bits of role-only user", "get_bits_by_user_id", ("UADMIN2",)),
+        ("no teams", "set_teams_to_no_team", ()),
+        ("team leaderboard after", "get_team_leaderboard", ()),
+        ("zero bits", "set_user_bits_to_zero", ("UADMIN", "reset")),
+        ("leaderboard after zero", "get_leaderboard_documents", (10,)),
+        ("ledger alice", "get_ledger_entries", (ALICE, 50)),
+        ("ledger bob limited", "get_ledger_entries", (BOB, 3)),
+    ],
+    "pagination": [
+        (
+            "seed",
+            "apply_bit_grants",
+            ([(f"U{index:02d}", index % 4 + 1) for index in range(11)],),
+        ),
+        ("page 1", "get_leaderboard_page", (None, 4)),
+        (
+            "page 2",
+            "get_leaderboard_page",
+            ({"userId": "U10", "bits": 3, "rank": 3, "position": 4}, 4),
+        ),
+        ("empty table", "get_team_leaderboard", ()),
+    ],
+    "history": [
+        ("give", "apply_bit_grants", ([(ALICE, 7), (BOB, 7), (CAROL, 2)],)),
+        ("team", "set_team_by_user_id", (CAROL, "Red")),
+        ("snapshot", "record_bit_history", (TAG,)),
+        ("give after snapshot", "give_bits_to_user", (CAROL, 50)),
+        ("snapshot again", "record_bit_history", (TAG,)),
+        ("give after second snapshot", "give_bits_to_user", (ALICE, 100)),
+        ("bits", "get_bits_by_user_id_from_history", (CAROL, TAG)),
+        ("bits unknown", "get_bits_by_user_id_from_history", ("UNOBODY", TAG)),
+        ("bits unknown tag", "get_bits_by_user_id_from_history", (CAROL, "Nope")),
+        ("leaderboard", "get_leaderboard_documents_from_history", (TAG, 10)),
+        ("leaderboard top 1", "get_leaderboard_documents_from_history", (TAG, 1)),
+        ("page 1", "get_leaderboard_page_from_history", (TAG, None, 2)),
+        (
+            "page 2",
+            "get_leaderboard_page_from_history",
+            (TAG, {"userId": ALICE, "bits": 7, "rank": 2, "position": 2}, 2),
+        ),
+        ("rank", "get_user_rank_from_history", (BOB, TAG)),
+        ("rank unknown", "get_user_rank_from_history", ("UNOBODY", TAG)),
+        ("teams", "get_team_leaderboard_from_history", (TAG,)),
+        ("matrix", "get_bit_history_matrix", ()),
+        ("matrix one user", "get_bit_history_matrix", (CAROL,)),
+        ("remove", "remove_bit_history_by_tag", (TAG,)),
+        ("leaderboard removed", "get_leaderboard_documents_from_history", (TAG, 10)),
+    ],
+    "ledger": [
+        ("legacy balances", "change_user_role", (ALICE, "member")),
+        ("no checkpoint yet", "rebuild_bits_from_ledger", ()),
+        ("not bootstrapped", "has_bit_ledger_bootstrap", ()),
+        ("bootstrap", "bootstrap_bit_ledger", ()),
+        ("bootstrap twice", "bootstrap_bit_ledger", ()),
+        ("mark", "mark", ("after bootstrap",)),
+        ("give", "give_bits_to_users", ([ALICE, BOB], 4)),
+        ("mark", "mark", ("after give",)),
+        ("remove", "remove_bits_from_users", ([ALICE], 1)),
+        ("mark", "mark", ("after remove",)),
+        ("balances after give", "get_balances_at", (Mark("after give"),)),
+        ("balances now", "get_balances_at", (Mark("after remove"),)),
+        ("leaderboard at", "get_leaderboard_at", (Mark("after give"), 10)),
+        ("checkpoint", "create_bit_checkpoint", (Mark("after remove"),)),
+        ("reset", "set_user_bits_to_zero", ()),
+        ("mark", "mark", ("after zero",)),
+        ("give after reset", "give_bits_to_user", (CAROL, 2)),
+        ("mark", "mark", ("after reset",)),
+        ("balances after reset", "get_balances_at", (Mark("after reset"),)),
+        ("balances before reset", "get_balances_at", (Mark("after remove"),)),
+        ("alice after give", "get_user_balance_at", (ALICE, Mark("after give"))),
+        ("alice at checkpoint", "get_user_balance_at", (ALICE, Mark("after remove"))),
+        ("alice after zero", "get_user_balance_at", (ALICE, Mark("after zero"))),
+        ("carol after reset", "get_user_balance_at", (CAROL, Mark("after reset"))),
+        ("nobody", "get_user_balance_at", ("UNOBODY", Mark("after reset"))),
+        ("no drift", "rebuild_bits_from_ledger", ()),
+        ("drift", "set_team_by_user_id", (DAVE, "Red")),
+        ("drift found", "rebuild_bits_from_ledger", ()),
+        ("ledger carol", "get_ledger_entries", (CAROL, 10)),
+    ],
+    "first checkpoint": [
+        ("give", "give_bits_to_user", (ALICE, 5)),
+        # With no bootstrap yet, the checkpoint seeds it from users.bits.
+        ("checkpoint", "create_bit_checkpoint", ()),
+        ("bootstrapped", "has_bit_ledger_bootstrap", ()),
+        ("bootstrap after", "bootstrap_bit_ledger", ()),
+        ("second checkpoint", "create_bit_checkpoint", ()),
+        ("no drift", "rebuild_bits_from_ledger", ()),
+    ],
+    "rollover": [
+        ("give", "apply_bit_grants", ([(ALICE, 3), (BOB, 8)],)),
+        ("team", "set_team_by_user_id", (BOB, "Red")),
+        ("rollover", "rollover_semester", (TAG, "UADMIN", "rollover")),
+        ("rollover twice", "rollover_semester", (TAG, "UADMIN", "rollover")),
+        ("bits", "get_leaderboard_documents", (10,)),
+        ("teams", "get_team_leaderboard", ()),
+        ("history", "get_leaderboard_documents_from_history", (TAG, 10)),
+        ("history teams", "get_team_leaderboard_from_history", (TAG,)),
+        ("ledger", "get_ledger_entries", (BOB, 10)),
+    ],
+    "idempotency": [
+        (
+            "claim",
+            "claim_integration_grant_keys",
+            ("ci", [("a", ALICE, 1), ("b", BOB, 2), ("a", ALICE, 1)]),
+        ),
+        ("mark", "mark", ("after first claim",)),
+        (
+            "claim again",
+            "claim_integration_grant_keys",
+            ("ci", [("b", BOB, 2), ("c", CAROL, 3)]),
+        ),
+        ("mark", "mark", ("after second claim",)),
+        ("other integration", "claim_integration_grant_keys", ("cd", [("a", BOB, 4)])),
+        ("claim none", "claim_integration_grant_keys", ("ci", [])),
+        ("mark", "mark", ("after claims",)),
+        ("pending", "get_pending_integration_grants", (Mark("after claims"),)),
+        (
+            "apply",
+            "apply_integration_grants",
+            ("ci", [("a", ALICE, 1), ("b", BOB, 2)]),
+        ),
+        (
+            "pending after apply",
+            "get_pending_integration_grants",
+            (Mark("after claims"),),
+        ),
+        ("granted", "get_leaderboard_documents", (10,)),
+        ("release", "release_integration_grant_keys", ("ci", ["a", "c"])),
+        (
+            "reclaim",
+            "claim_integration_grant_keys",
+            ("ci", [("a", ALICE, 1), ("b", BOB, 2), ("c", CAROL, 3)]),
+        ),
+        ("message", "claim_message_id", ("C1-1.0",)),
+        ("message again", "claim_message_id", ("C1-1.0",)),
+    ],
+    "directory": [
+        ("empty", "get_directory_profiles", ([ALICE],)),
+        ("no state", "get_directory_sync_state", ()),
+        ("save", "save_directory_profiles", ([profile(ALICE, 1), profile(BOB, 1)],)),
+        ("save older", "save_directory_profiles", ([profile(ALICE, 0)],)),
+        ("save newer", "save_directory_profiles", ([profile(ALICE, 2)],)),
+        ("read", "get_directory_profiles", ([ALICE, BOB, CAROL],)),
+        (
+            "save state",
+            "save_directory_sync_state",
+            (
+                {
+                    "cursor": "abc",
+                    "startedAt": datetime(2024, 5, 1),
+                    "completedAt": None,
+                },
+            ),
+        ),
+        ("state", "get_directory_sync_state", ()),
+    ],
+}
+
+
+# mongomock numbers bulk upserts in order rather than by operation index, so it
+# reports the wrong grants as created here. They still count as differences;
+# only a run against MongoDB (--mongo-url) can pass.
+MONGOMOCK_DIFFERENCES = {("balances", "grant batch"), ("ledger", "give")}
+
+
+def normalize(value):
+    # Times differ between runs, and Mongo returns cursors and documents where
+    # SQLite builds lists and dicts.
+    if isinstance(value, datetime):
+        return "<datetime>"
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) or hasattr(value, "__next__"):
+        return [normalize(item) for item in value]
+    return value
+
+
+class MongoBackend:
+    def __init__(self, mongo_url):
+        import mongo_storage
+        import schema
+
+        self.storage = mongo_storage
+        self.schema = schema
+        if mongo_url:
+            self.name = "mongo"
+            self.db_client = mongo_storage.get_db_client()
+            # Anything mongomock can't run is a real failure here.
+            self.unsupported = ()
+        else:
+            import mongomock
+
+            self.name = "mongomock"
+            self.db_client = mongomock.MongoClient()[os.environ["MONGO_DB_DATABASE"]]
+            mongo_storage.get_db_client = lambda: self.db_client
+            schema.get_db_client = mongo_storage.get_db_client
+            # mongomock has no sessions or hello command; treat it like a
+            # standalone server so the non-transactional paths still run.
+            mongo_storage.supports_transactions = lambda: False
+            schema.supports_transactions = mongo_storage.supports_transactions
+            self.unsupported = (NotImplementedError, mongomock.OperationFailure)
+
+    def reset(self):
+        for collection_name in self.db_client.list_collection_names():
+            self.db_client.drop_collection(collection_name)
+        self.schema.apply_indexes()
+
+
+class SQLiteBackend:
+    name = "sqlite"
+    unsupported = ()
+
+    def __init__(self):
+        import sqlite_storage
+
+        self.storage = sqlite_storage
+
+    def reset(self):
+        connection = self.storage.get_connection()
+        tables = [
+            row["name"]
+            for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+        connection.execute("PRAGMA foreign_keys=OFF")
+        for table in tables:
+            connection.execute(f"DELETE FROM {table}")
+        connection.execute("PRAGMA foreign_keys=ON")
+
+
+def run_section(backend, steps):
+    marks = {}
+    outcomes = []
+    for label, function_name, args in steps:
+        if function_name == "mark":
+            # Mongo keeps milliseconds, and the ledger treats writes in the
+            # same millisecond as a checkpoint or reset as already applied.
+            # Marks keep the writes on either side of them apart.
+            time.sleep(0.005)
+            marks[args[0]] = datetime.utcnow()
+            time.sleep(0.005)
+            continue
+
+        args = [marks[arg.name] if isinstance(arg, Mark) else arg for arg in args]
+        try:
+            result = getattr(backend.storage, function_name)(*args)
+            outcomes.append((label, "ok", normalize(result)))
+        except backend.unsupported as e:
+            # Later steps depend on this one, so the rest of the section can't
+            # be compared.
+            outcomes.append((label, "skipped", f"{type(e).__name__}: {e}"))
+            break
+        except Exception as e:
+            outcomes.append((label, "error", str(e)))
+
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the Mongo and SQLite storage backends agree"
+    )
+    parser.add_argument(
+        "--mongo-url",
+        help="Local Mongo to compare against instead of mongomock; "
+        "its benchmark database is dropped",
+    )
+    parser.add_argument("--only", nargs="+", choices=list(SECTIONS))
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bitbot-conformance-")
+    os.environ.update(BENCHMARK_ENV)
+    os.environ["SQLITE_DATABASE_PATH"] = os.path.join(directory, "bitbot.sqlite3")
+    if args.mongo_url:
+        os.environ["MONGO_DB_URL"] = args.mongo_url
+    sys.path.insert(0, ROOT)
+
+    reference = MongoBackend(args.mongo_url)
+    candidate = SQLiteBackend()
+
+    counts = {"match": 0, "mismatch": 0, "skipped": 0}
+    for section, steps in SECTIONS.items():
+        if args.only and section not in args.only:
+            continue
+
+        results = {}
+        for backend in (reference, candidate):
+            backend.reset()
+            results[backend.name] = run_section(backend, steps)
+
+        expected = results[reference.name]
+        actual = results["sqlite"]
+        for index, (label, status, value) in enumerate(expected):
+            if status == "skipped":
+                skipped = len(actual) - index
+                counts["skipped"] += skipped
+                print(f"{section}: {skipped} steps skipped from {label!r} ({value})")
+                break
+
+            if actual[index] == (label, status, value):
+                counts["match"] += 1
+                if args.verbose:
+                    print(f"{section}: {label}: {status} {value}")
+                continue
+
+            counts["mismatch"] += 1
+            known = reference.name == "mongomock" and (
+                (section, label) in MONGOMOCK_DIFFERENCES
+            )
+            print(f"{section}: {label}: MISMATCH{' (mongomock bug)' if known else ''}")
+            print(f"  {reference.name}: {status} {value}")
+            print(f"  sqlite: {actual[index][1]} {actual[index][2]}")
+
+    print(
+        f"{counts['match']} steps match, {counts['mismatch']} differ, "
+        f"{counts['skipped']} skipped on {reference.name}"
+    )
+    # A skipped step was never compared, so it fails the run like a mismatch.
+    return 1 if counts["mismatch"] or counts["skipped"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
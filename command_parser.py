@@ -0,0 +1,126 @@
+import re
+
+# One token per whitespace-separated word: a user mention (optionally with
+# Slack's |label suffix), a bare integer, or any other word.
+TOKEN_PATTERN = re.compile(
+    r"<@(?P<mention>\w+)(?:\|[^>]*)?>(?!\S)|(?P<integer>\d+)(?!\S)|(?P<word>\S+)"
+)
+
+# The arguments each action accepts, in order:
+#   user_ids      one or more user mentions
+#   user_id       exactly one user mention
+#   amount        an integer > 0
+#   tag           the rest of the text, required
+#   optional_tag  the rest of the text, if any
+COMMAND_SCHEMAS = {
+    "give": ("user_ids", "amount"),
+    "remove": ("user_ids", "amount"),
+    "leaderboard": ("optional_tag",),
+    "set-team": (),
+    "team-leaderboard": ("optional_tag",),
+    "help": (),
+    "promote": ("user_id",),
+    "demote": ("user_id",),
+    "clear-teams": (),
+    "get-bits": ("optional_tag",),
+    "save-bit-history": ("tag",),
+    "clear-bits": (),
+    "delete-bit-history": ("tag",),
+    "rebuild-leaderboards": (),
+    "rank": ("optional_tag",),
+    "history": (),
+    "rollover": ("tag",),
+}
+
+ARGUMENT_USAGE = {
+    "user_ids": "<tag users>",
+    "user_id": "<tag the user>",
+    "amount": "<amount>",
+    "tag": "<semester tag>",
+    "optional_tag": "[semester tag]",
+}
+
+
+def tokenize(text):
+    return [
+        (match.lastgroup, match.group(match.lastgroup), match.group(0))
+        for match in TOKEN_PATTERN.finditer(text or "")
+    ]
+
+
+def get_usage(action):
+    return " ".join([action] + [ARGUMENT_USAGE[a] for a in COMMAND_SCHEMAS[action]])
+
+
+def parse_arguments(action, tokens):
+    usage = get_usage(action)
+    arguments = {}
+    position = 0
+
+    for name in COMMAND_SCHEMAS[action]:
+        remaining = tokens[position:]
+
+        if name in ("user_ids", "user_id"):
+            user_ids = []
+            for kind, value, raw in remaining:
+                if kind != "mention" or (name == "user_id" and user_ids):
+                    break
+                if value not in user_ids:
+                    user_ids.append(value)
+                position += 1
+            if name == "user_ids" and len(tokens) - position > 1:
+                # Only the final amount may follow the mentions.
+                raise Exception(
+                    f"Expected a user mention, got {tokens[position][2]}. Usage: {usage}"
+                )
+            if not user_ids:
+                found = remaining[0][2] if remaining else "nothing"
+                raise Exception(f"Expected a user mention, got {found}. Usage: {usage}")
+            arguments[name] = user_ids if name == "user_ids" else user_ids[0]
+
+        elif name == "amount":
+            if not remaining:
+                raise Exception(f"Expected an amount. Usage: {usage}")
+            kind, value, raw = remaining[0]
+            if kind != "integer" or int(value) <= 0:
+                raise Exception(
+                    f"{raw} is not a valid amount; {raw} must be an integer amount > 0"
+                )
+            arguments[name] = int(value)
+            position += 1
+
+        elif name in ("tag", "optional_tag"):
+            if not remaining and name == "tag":
+                raise Exception(f"Expected a semester tag. Usage: {usage}")
+            arguments["tag"] = " ".join(raw for kind, value, raw in remaining) or None
+            position = len(tokens)
+
+    if position < len(tokens):
+        raise Exception(f"Unexpected argument {tokens[position][2]}. Usage: {usage}")
+
+    return arguments
+
+
+def is_addressed_to(tokens, bot_id):
+    return bool(tokens) and tokens[0][0] == "mention" and tokens[0][1] == bot_id
+
+
+def is_command(text, bot_id):
+    return is_addressed_to(tokenize(text), bot_id)
+
+
+def parse_command(text, bot_id):
+    # Returns None for messages that are not addressed to the bot, raises on
+    # malformed commands and otherwise returns (action, arguments).
+    tokens = tokenize(text)
+    if not is_addressed_to(tokens, bot_id):
+        return None
+
+    if len(tokens) < 2:
+        raise Exception("Missing command; try help")
+
+    action = tokens[1][2]
+    if action not in COMMAND_SCHEMAS:
+        raise Exception(f"{action} is not a valid action")
+
+    return action, parse_arguments(action, tokens[2:])
@@ -1,3 +1,6 @@
+import json
+import os
+
 teams = [
     "GT Scheduler",
     "Brain Exercise Initiative",
@@ -20,3 +23,104 @@ teams = [
 ]
 
 questions = {"TEAM": "What is your team?"}
+
+USER_PROFILE_CACHE_SIZE = 2000
+USER_PROFILE_CACHE_TTL_SECONDS = 15 * 60
+USER_PROFILE_MAX_CONCURRENT_LOOKUPS = 8
+
+# "inline" runs commands inside the Slack event request (required on serverless
+# hosts that freeze the process after responding); "background" acknowledges
+# the event immediately and runs the command on the worker pool; "async" runs
+# inline but overlaps a command's Slack and Mongo calls on an event loop.
+COMMAND_DISPATCH_MODE = os.getenv("COMMAND_DISPATCH_MODE", "inline")
+COMMAND_WORKERS = int(os.getenv("COMMAND_WORKERS", "4"))
+COMMAND_QUEUE_SIZE = int(os.getenv("COMMAND_QUEUE_SIZE", "100"))
+ASYNC_MAX_CONCURRENT_IO = int(os.getenv("ASYNC_MAX_CONCURRENT_IO", "16"))
+
+AUDIT_LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL", "2"))
+AUDIT_LOG_MAX_LINES_PER_MESSAGE = 50
+
+# Slack retries a delivery for at most a few minutes; anything older than this
+# can safely be forgotten by the deduplication store.
+MESSAGE_ID_TTL_SECONDS = 24 * 60 * 60
+RECENT_MESSAGE_ID_CACHE_SIZE = 5000
+RECENT_MESSAGE_ID_CACHE_TTL_SECONDS = 15 * 60
+
+APPLY_INDEXES_ON_STARTUP = os.getenv("APPLY_INDEXES_ON_STARTUP", "true") == "true"
+
+ADMIN_ROLE_CACHE_SIZE = 1000
+ADMIN_ROLE_CACHE_TTL_SECONDS = 60
+
+INTEGRATION_BATCH_MAX_GRANTS = 500
+# Ledger checkpoints only cover entries at least this old, so writes still in
+# flight when a checkpoint is taken land in the ledger tail instead of being
+# skipped.
+LEDGER_CHECKPOINT_LAG_SECONDS = 60
+LEDGER_ENTRIES_MAX_PAGE_SIZE = 500
+
+LEADERBOARD_PAGE_DEFAULT_SIZE = 10
+LEADERBOARD_PAGE_MAX_SIZE = 100
+# How long a batch grant's idempotency key is remembered; retries after this
+# window are applied again.
+INTEGRATION_GRANT_KEY_TTL_SECONDS = 30 * 24 * 60 * 60
+# A batch grant whose claim is still pending after this long belongs to a
+# request that died before granting it; `schema.py recover-grants` finishes it.
+INTEGRATION_GRANT_RECOVERY_SECONDS = 10 * 60
+
+# Token buckets for the integrations routes, keyed by integration_name. "rate"
+# is tokens refilled per second and "burst" the bucket size; a single grant
+# costs one token and a batch costs one per grant. "default" covers any
+# integration without its own entry.
+INTEGRATION_RATE_LIMITS = json.loads(
+    os.getenv("INTEGRATION_RATE_LIMITS", '{"default": {"rate": 5, "burst": 500}}')
+)
+# "memory" keeps buckets per process; "mongo" shares them between processes.
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+
+# Outbound Slack budgets, from https://api.slack.com/docs/rate-limits. Tiers are
+# (calls per minute, burst); methods not listed here are treated as tier 3.
+SLACK_TIER_BUDGETS = {1: (1, 1), 2: (20, 5), 3: (50, 10), 4: (100, 20)}
+SLACK_METHOD_TIERS = {
+    "auth.test": 4,
+    "chat.postEphemeral": 4,
+    "conversations.open": 3,
+    "reactions.add": 3,
+    "users.info": 4,
+    "users.list": 2,
+}
+# chat.postMessage is limited per channel rather than per workspace.
+SLACK_CHANNEL_MESSAGES_PER_SECOND = 1
+SLACK_CHANNEL_MESSAGE_BURST = 3
+SLACK_MAX_RETRIES = 3
+# A Retry-After longer than this is surfaced as an error instead of waited out.
+SLACK_MAX_RETRY_AFTER_SECONDS = 10
+# Slack retries an event that isn't acknowledged within 3 seconds. When commands
+# run inline, interactive calls give up rather than wait longer than this for a
+# budget or a Retry-After.
+SLACK_INLINE_MAX_WAIT_SECONDS = 1
+# Kept-alive connections to Slack held open while idle, per host.
+SLACK_MAX_IDLE_CONNECTIONS = 8
+
+# The workspace directory mirrors users.list so existence checks and names
+# don't need a users.info call per mentioned user.
+WORKSPACE_DIRECTORY_PAGE_SIZE = 200
+WORKSPACE_DIRECTORY_REFRESH_SECONDS = int(
+    os.getenv("WORKSPACE_DIRECTORY_REFRESH_SECONDS", str(6 * 60 * 60))
+)
+# users.list is Tier 2, so a large workspace is synced over several runs.
+WORKSPACE_DIRECTORY_MAX_PAGES_PER_SYNC = int(
+    os.getenv("WORKSPACE_DIRECTORY_MAX_PAGES_PER_SYNC", "5")
+)
+# A run stops starting pages once the next one might end after this many
+# seconds, well inside the serverless function limit; the next run resumes from
+# the saved cursor.
+WORKSPACE_DIRECTORY_SYNC_SECONDS = float(
+    os.getenv("WORKSPACE_DIRECTORY_SYNC_SECONDS", "5")
+)
+
+# "mongo" talks to the cluster at MONGO_DB_URL; "sqlite" keeps everything in a
+# local file, for single-node deployments, tests and benchmarks.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_DATABASE_PATH = os.getenv("SQLITE_DATABASE_PATH", "bitbot.sqlite3")
+# How long a write waits for another connection's write to finish.
+SQLITE_BUSY_TIMEOUT_SECONDS = 5
@@ -0,0 +1,36 @@
+from flask import has_request_context, request
+
+from cache import TTLCache
+from config import RECENT_MESSAGE_ID_CACHE_SIZE, RECENT_MESSAGE_ID_CACHE_TTL_SECONDS
+from database import claim_message_id
+
+recent_message_ids = TTLCache(
+    RECENT_MESSAGE_ID_CACHE_SIZE, RECENT_MESSAGE_ID_CACHE_TTL_SECONDS
+)
+
+
+def is_timeout_retry():
+    if not has_request_context():
+        return False
+
+    # Slack only retries with reason http_timeout when the first delivery reached
+    # us and is still being handled; other reasons may mean it never arrived.
+    return (
+        request.headers.get("X-Slack-Retry-Num") is not None
+        and request.headers.get("X-Slack-Retry-Reason") == "http_timeout"
+    )
+
+
+def is_duplicate_event(message_id):
+    if is_timeout_retry():
+        return True
+
+    if recent_message_ids.get(message_id):
+        return True
+
+    recent_message_ids.set(message_id, True)
+    return not claim_message_id(message_id)
+
+
+def get_dedup_stats():
+    return recent_message_ids.stats()
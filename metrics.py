@@ -0,0 +1,221 @@
+import functools
+import threading
+import time
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def label_values(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        lines.extend(self.render_samples())
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render_samples(self):
+        with self._lock:
+            values = dict(self._values)
+
+        return [
+            f"{self.name}{format_labels(self.label_names, key)} {value}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def render_samples(self):
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            state = self._values.setdefault(
+                key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def render_samples(self):
+        with self._lock:
+            values = {
+                key: dict(state, buckets=list(state["buckets"]))
+                for key, state in self._values.items()
+            }
+
+        lines = []
+        for key, state in sorted(values.items()):
+            for bound, count in zip(self.buckets, state["buckets"]):
+                labels = format_labels(self.label_names, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.label_names, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {state['count']}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {state['sum']}")
+            lines.append(f"{self.name}_count{labels} {state['count']}")
+
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+command_duration = Histogram(
+    "bitbot_command_duration_seconds", "Time spent executing a command", ["command"]
+)
+command_errors = Counter(
+    "bitbot_command_errors_total", "Commands that raised an exception", ["command"]
+)
+database_duration = Histogram(
+    "bitbot_database_function_duration_seconds",
+    "Time spent in storage backend functions",
+    ["function"],
+)
+database_errors = Counter(
+    "bitbot_database_function_errors_total",
+    "Storage backend functions that raised an exception",
+    ["function"],
+)
+mongo_operations = Counter(
+    "bitbot_mongo_operations_total", "Commands sent to MongoDB", ["operation"]
+)
+mongo_failures = Counter(
+    "bitbot_mongo_operation_failures_total",
+    "MongoDB commands that failed",
+    ["operation"],
+)
+mongo_duration = Histogram(
+    "bitbot_mongo_operation_duration_seconds",
+    "MongoDB command round trip time",
+    ["operation"],
+)
+slack_calls = Counter("bitbot_slack_api_calls_total", "Slack Web API calls", ["method"])
+slack_errors = Counter(
+    "bitbot_slack_api_errors_total", "Slack Web API calls that failed", ["method"]
+)
+slack_rate_limited = Counter(
+    "bitbot_slack_api_rate_limited_total",
+    "Slack Web API calls rejected with HTTP 429",
+    ["method"],
+)
+slack_duration = Histogram(
+    "bitbot_slack_api_duration_seconds", "Slack Web API call time", ["method"]
+)
+slack_retries = Counter(
+    "bitbot_slack_api_retries_total",
+    "Slack Web API calls retried after HTTP 429",
+    ["method"],
+)
+slack_budget_wait = Histogram(
+    "bitbot_slack_budget_wait_seconds",
+    "Time outbound Slack calls spent waiting for their rate budget",
+    ["budget"],
+)
+integration_rate_limited = Counter(
+    "bitbot_integration_rate_limited_total",
+    "Integration requests rejected by the rate limiter",
+    ["integration"],
+)
+
+
+def timed_function(function, histogram, errors, label):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            errors.inc(**{label: function.__name__})
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start, **{label: function.__name__})
+
+    return wrapper
+
+
+def instrument_functions(module, names):
+    # Only the named entry points are timed; helpers and the calls they make
+    # to each other inside the module are not counted again.
+    return {
+        name: timed_function(
+            getattr(module, name), database_duration, database_errors, "function"
+        )
+        for name in names
+    }
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        mongo_operations.inc(operation=event.command_name)
+
+    def succeeded(self, event):
+        mongo_duration.observe(
+            event.duration_micros / 1_000_000, operation=event.command_name
+        )
+
+    def failed(self, event):
+        mongo_failures.inc(operation=event.command_name)
+        mongo_duration.observe(
+            event.duration_micros / 1_000_000, operation=event.command_name
+        )
@@ -0,0 +1,1260 @@
+import os
+import pymongo
+from bson import ObjectId
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pymongo import DeleteMany, DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from config import LEDGER_CHECKPOINT_LAG_SECONDS
+from metrics import MongoCommandMetrics
+from storage_common import (
+    build_bit_history_matrix,
+    build_leaderboard,
+    build_ledger_entry,
+    build_rank,
+    rank_page,
+)
+
+
+@lru_cache(maxsize=None)
+def get_db_client():
+    # Created on first use rather than at import so cold starts that never touch
+    # Mongo (health checks, retries) skip client setup and SRV resolution.
+    mongo_client = pymongo.MongoClient(
+        os.environ["MONGO_DB_URL"], event_listeners=[MongoCommandMetrics()]
+    )
+    return mongo_client[os.environ["MONGO_DB_DATABASE"]]
+
+
+def get_bits_by_user_id(user_id):
+    db_client = get_db_client()
+
+    users_collection = db_client["users"]
+    bit_query = {"userId": user_id}
+
+    user = users_collection.find_one(bit_query)
+    if user:
+        return user.get("bits", 0)
+    else:
+        return 0
+
+
+def get_bits_by_user_id_from_history(user_id, tag):
+    db_client = get_db_client()
+    snapshots_collection = db_client["bit_history_snapshots"]
+    bit_history_collection = db_client["bit_history"]
+
+    snapshot = snapshots_collection.find_one(
+        {"_id": tag}, {"entries": {"$elemMatch": {"userId": user_id}}}
+    )
+    if snapshot:
+        entries = snapshot.get("entries", [])
+        return entries[0].get("bits", 0) if entries else 0
+
+    # Tags recorded before compact snapshots still live as per-user rows.
+    bit_query = {"userId": user_id, "tag": tag}
+
+    user = bit_history_collection.find_one(bit_query)
+    if user:
+        return user.get("bits", 0)
+    else:
+        return 0
+
+
+def append_ledger_entries(entries, session=None):
+    # Append-only record of every balance change; users.bits is the running
+    # total of it and can be rebuilt from it with rebuild_bits_from_ledger.
+    if entries:
+        get_db_client()["bit_ledger"].insert_many(
+            entries, ordered=False, session=session
+        )
+
+
+def give_bits_to_user(user_id, amount, actor=None, source=None):
+    db_client = get_db_client()
+
+    users_collection = db_client["users"]
+    user_query = {"userId": user_id}
+    update_query = {"$inc": {"bits": amount}, "$setOnInsert": {"team": "No Team"}}
+
+    user = users_collection.find_one_and_update(
+        user_query,
+        update_query,
+        projection={"team": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    update_team_totals({user.get("team", "No Team"): amount})
+    append_ledger_entries(
+        [build_ledger_entry(user_id, amount, "grant", actor, source, datetime.utcnow())]
+    )
+
+
+def give_bits_to_users(user_ids, amount, actor=None, source=None):
+    user_ids = list(dict.fromkeys(user_ids))
+    statuses = apply_bit_grants(
+        [(user_id, amount) for user_id in user_ids], actor, source
+    )
+
+    return dict(zip(user_ids, statuses))
+
+
+def apply_bit_grants(grants, actor=None, source=None):
+    statuses = write_bit_grants(grants, actor, source)
+    if "failed" in statuses:
+        raise Exception(
+            f"{statuses.count('failed')} of {len(grants)} grants could not be applied"
+        )
+
+    return statuses
+
+
+def write_bit_grants(grants, actor=None, source=None, session=None):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    if not grants:
+        return []
+
+    requests = [
+        UpdateOne(
+            {"userId": user_id},
+            {"$inc": {"bits": amount}, "$setOnInsert": {"team": "No Team"}},
+            upsert=True,
+        )
+        for user_id, amount in grants
+    ]
+    failed = set()
+    try:
+        result = users_collection.bulk_write(requests, ordered=False, session=session)
+        created = set(result.upserted_ids)
+    except BulkWriteError as e:
+        if session is not None:
+            # The transaction is aborted, so none of the grants were applied.
+            raise
+        # Unordered, so every request without an error was applied and still
+        # needs its team total and ledger entry.
+        failed = {error["index"] for error in e.details["writeErrors"]}
+        created = {upserted["index"] for upserted in e.details.get("upserted", [])}
+    applied = [grant for index, grant in enumerate(grants) if index not in failed]
+
+    amounts_by_user = {}
+    for user_id, amount in applied:
+        amounts_by_user[user_id] = amounts_by_user.get(user_id, 0) + amount
+
+    team_deltas = {}
+    for user in users_collection.find(
+        {"userId": {"$in": list(amounts_by_user)}},
+        {"userId": 1, "team": 1},
+        session=session,
+    ):
+        team = user.get("team", "No Team")
+        team_deltas[team] = team_deltas.get(team, 0) + amounts_by_user[user["userId"]]
+    update_team_totals(team_deltas, session)
+
+    created_at = datetime.utcnow()
+    append_ledger_entries(
+        [
+            build_ledger_entry(user_id, amount, "grant", actor, source, created_at)
+            for user_id, amount in applied
+        ],
+        session,
+    )
+
+    return [
+        "failed" if index in failed else "created" if index in created else "updated"
+        for index in range(len(grants))
+    ]
+
+
+# Unique indexes that some write relies on, once they have been seen to exist.
+verified_indexes = set()
+
+
+def require_index(collection_name, index_name):
+    if (collection_name, index_name) in verified_indexes:
+        return
+
+    if index_name not in get_db_client()[collection_name].index_information():
+        raise Exception(
+            f"{collection_name} has no {index_name} index; run `python schema.py "
+            "dedupe --apply` and `python schema.py apply` first"
+        )
+    verified_indexes.add((collection_name, index_name))
+
+
+def claim_integration_grant_keys(integration_name, claims):
+    # Each claim is (idempotency_key, user_id, amount). The grant is stored with
+    # its key and stays "pending" until apply_integration_grants lands it, so a
+    # request that dies in between can be finished by `schema.py recover-grants`.
+    db_client = get_db_client()
+    integration_grants_collection = db_client["integration_grants"]
+
+    if not claims:
+        return []
+
+    # Without the unique index every claim "succeeds", and a retried batch
+    # would be granted again.
+    require_index("integration_grants", "integration_idempotency_key_unique")
+
+    created_at = datetime.utcnow()
+    documents = [
+        {
+            "integrationName": integration_name,
+            "idempotencyKey": key,
+            "userId": user_id,
+            "amount": amount,
+            "status": "pending",
+            "createdAt": created_at,
+        }
+        for key, user_id, amount in claims
+    ]
+
+    duplicates = set()
+    try:
+        integration_grants_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            # Keys inserted alongside the failure would otherwise report
+            # "duplicate" on every retry without ever being granted.
+            failed = {error["index"] for error in errors}
+            release_integration_grant_keys(
+                integration_name,
+                [
+                    key
+                    for index, (key, _, _) in enumerate(claims)
+                    if index not in failed
+                ],
+            )
+            raise
+        duplicates = {error["index"] for error in errors}
+
+    return [index not in duplicates for index in range(len(claims))]
+
+
+def apply_integration_grants(integration_name, claims, source="integration-batch"):
+    # Grants claimed keys and marks their claims applied. With transactions the
+    # two commit together, so a claim left pending was never granted. Returns
+    # the keys whose grants were not applied; those claims are released so the
+    # integration can retry them.
+    db_client = get_db_client()
+    integration_grants_collection = db_client["integration_grants"]
+    grants = [(user_id, amount) for _, user_id, amount in claims]
+
+    def run(session=None):
+        statuses = write_bit_grants(grants, integration_name, source, session)
+        applied = [
+            key for (key, _, _), status in zip(claims, statuses) if status != "failed"
+        ]
+        integration_grants_collection.update_many(
+            {"integrationName": integration_name, "idempotencyKey": {"$in": applied}},
+            {"$set": {"status": "applied"}},
+            session=session,
+        )
+        return [
+            key for (key, _, _), status in zip(claims, statuses) if status == "failed"
+        ]
+
+    if not claims:
+        return []
+
+    if supports_transactions():
+        try:
+            with db_client.client.start_session() as session:
+                failed = session.with_transaction(run)
+        except BulkWriteError:
+            # The transaction aborted, so nothing was applied.
+            failed = [key for key, _, _ in claims]
+    else:
+        # Without a transaction the users $inc may already have landed before
+        # the team totals or ledger write failed; any error leaves the claims
+        # pending.
+        failed = run()
+
+    # Any other error leaves the claims pending rather than risk a double grant.
+    if failed:
+        release_integration_grant_keys(integration_name, failed)
+
+    return failed
+
+
+def get_pending_integration_grants(cutoff):
+    db_client = get_db_client()
+    integration_grants_collection = db_client["integration_grants"]
+
+    return list(
+        integration_grants_collection.find(
+            {"status": "pending", "createdAt": {"$lt": cutoff}},
+            {"_id": 0, "status": 0},
+        ).sort(
+            [("createdAt", pymongo.ASCENDING), ("idempotencyKey", pymongo.ASCENDING)]
+        )
+    )
+
+
+def release_integration_grant_keys(integration_name, idempotency_keys):
+    db_client = get_db_client()
+    integration_grants_collection = db_client["integration_grants"]
+
+    integration_grants_collection.delete_many(
+        {
+            "integrationName": integration_name,
+            "idempotencyKey": {"$in": list(idempotency_keys)},
+        }
+    )
+
+
+def remove_bits_from_users(user_ids, amount, actor=None, source=None):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+
+    # Tag each successful decrement so the users it applied to (and their teams)
+    # can be read back in one query instead of one per user. BulkWriteResult
+    # only reports totals, not which guarded updates matched. The tags are a
+    # set, so a concurrent removal adding its own can't hide this one's.
+    mutation_id = ObjectId()
+    requests = [
+        UpdateOne(
+            {"userId": user_id, "bits": {"$gte": amount}},
+            {"$inc": {"bits": -amount}, "$addToSet": {"mutationIds": mutation_id}},
+        )
+        for user_id in user_ids
+    ]
+    users_collection.bulk_write(requests, ordered=False)
+
+    removed = {}
+    for user in users_collection.find(
+        {"userId": {"$in": user_ids}, "mutationIds": mutation_id},
+        {"userId": 1, "team": 1},
+    ):
+        removed[user["userId"]] = user.get("team", "No Team")
+    if removed:
+        # The tag is only needed for the read above; don't leave it behind.
+        users_collection.update_many(
+            {"userId": {"$in": list(removed)}},
+            {"$pull": {"mutationIds": mutation_id}},
+        )
+
+    team_deltas = {}
+    for team in removed.values():
+        team_deltas[team] = team_deltas.get(team, 0) - amount
+    update_team_totals(team_deltas)
+
+    created_at = datetime.utcnow()
+    append_ledger_entries(
+        [
+            build_ledger_entry(user_id, -amount, "removal", actor, source, created_at)
+            for user_id in removed
+        ]
+    )
+
+    return {
+        user_id: "removed" if user_id in removed else "insufficient"
+        for user_id in user_ids
+    }
+
+
+def get_bit_history_snapshot_pipeline(tag, created_at="$$NOW"):
+    # One document per tag: every member pre-sorted by bits plus precomputed team
+    # totals, so historical reads are a single document fetch. Works over both
+    # users and legacy bit_history rows, which share the userId/team/bits shape.
+    return [
+        {
+            "$facet": {
+                "entries": [
+                    {"$sort": {"bits": -1, "userId": 1}},
+                    {
+                        "$project": {
+                            "_id": 0,
+                            "userId": 1,
+                            "team": {"$ifNull": ["$team", "No Team"]},
+                            "bits": {"$ifNull": ["$bits", 0]},
+                        }
+                    },
+                ],
+                "team_totals": [
+                    {
+                        "$group": {
+                            "_id": {"$ifNull": ["$team", "No Team"]},
+                            "total_bits": {"$sum": "$bits"},
+                        }
+                    },
+                    {"$sort": {"total_bits": -1, "_id": 1}},
+                ],
+            }
+        },
+        {
+            "$project": {
+                "_id": {"$literal": tag},
+                "tag": {"$literal": tag},
+                "entries": 1,
+                "team_totals": 1,
+                "user_count": {"$size": "$entries"},
+                "createdAt": created_at,
+            }
+        },
+    ]
+
+
+def record_bit_history(tag):
+    db_client = get_db_client()
+
+    users_collection = db_client["users"]
+    snapshots_collection = db_client["bit_history_snapshots"]
+
+    pipeline = get_bit_history_snapshot_pipeline(tag)
+    pipeline.append(
+        {
+            "$merge": {
+                "into": snapshots_collection.name,
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        }
+    )
+    # Keyed by tag, so re-running a snapshot for the same tag replaces it.
+    users_collection.aggregate(pipeline)
+
+    snapshot = snapshots_collection.find_one({"_id": tag}, {"user_count": 1})
+    return snapshot["user_count"] if snapshot else 0
+
+
+def migrate_bit_history_to_snapshots(delete_legacy=False):
+    db_client = get_db_client()
+
+    bit_history_collection = db_client["bit_history"]
+    snapshots_collection = db_client["bit_history_snapshots"]
+
+    migrated = {}
+    for tag in bit_history_collection.distinct("tag"):
+        oldest_row = bit_history_collection.find_one(
+            {"tag": tag}, {"_id": 1}, sort=[("_id", pymongo.ASCENDING)]
+        )
+        pipeline = [{"$match": {"tag": tag}}]
+        pipeline.extend(
+            get_bit_history_snapshot_pipeline(
+                tag, {"$literal": oldest_row["_id"].generation_time}
+            )
+        )
+        pipeline.append(
+            {
+                "$merge": {
+                    "into": snapshots_collection.name,
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }
+            }
+        )
+        bit_history_collection.aggregate(pipeline)
+
+        snapshot = snapshots_collection.find_one({"_id": tag}, {"user_count": 1})
+        migrated[tag] = snapshot["user_count"]
+
+        if delete_legacy:
+            bit_history_collection.delete_many({"tag": tag})
+
+    return migrated
+
+
+def get_bit_history_rows_pipeline(user_id=None):
+    # One row per (user, tag) across snapshots and legacy bit_history rows.
+    # With a user_id both sides are narrowed by index before anything is read.
+    if user_id:
+        snapshot_match = [{"$match": {"entries.userId": user_id}}]
+        entries = {
+            "$filter": {
+                "input": "$entries",
+                "cond": {"$eq": ["$$this.userId", user_id]},
+            }
+        }
+        legacy_match = {"userId": user_id}
+    else:
+        snapshot_match = []
+        entries = "$entries"
+        legacy_match = {}
+
+    return snapshot_match + [
+        {"$project": {"_id": 0, "tag": 1, "createdAt": 1, "entries": entries}},
+        {"$unwind": "$entries"},
+        {
+            "$project": {
+                "tag": 1,
+                "createdAt": 1,
+                "userId": "$entries.userId",
+                "bits": "$entries.bits",
+                "team": "$entries.team",
+                "source": {"$literal": 0},
+            }
+        },
+        {
+            "$unionWith": {
+                "coll": "bit_history",
+                "pipeline": [
+                    {"$match": legacy_match},
+                    {
+                        "$project": {
+                            "_id": 0,
+                            "tag": 1,
+                            "userId": 1,
+                            "bits": {"$ifNull": ["$bits", 0]},
+                            "team": {"$ifNull": ["$team", "No Team"]},
+                            "createdAt": {"$toDate": "$_id"},
+                            "source": {"$literal": 1},
+                        }
+                    },
+                ],
+            }
+        },
+        # Tags migrated without --delete-legacy exist in both; the snapshot wins.
+        {"$sort": {"source": 1}},
+        {
+            "$group": {
+                "_id": {"userId": "$userId", "tag": "$tag"},
+                "bits": {"$first": "$bits"},
+                "team": {"$first": "$team"},
+                "createdAt": {"$min": "$createdAt"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "userId": "$_id.userId",
+                "tag": "$_id.tag",
+                "bits": 1,
+                "team": 1,
+                "createdAt": 1,
+            }
+        },
+    ]
+
+
+def get_bit_history_matrix(user_id=None):
+    db_client = get_db_client()
+    snapshots_collection = db_client["bit_history_snapshots"]
+
+    rows = list(
+        snapshots_collection.aggregate(
+            get_bit_history_rows_pipeline(user_id), allowDiskUse=True
+        )
+    )
+
+    return build_bit_history_matrix(rows)
+
+
+def remove_bit_history_by_tag(tag):
+    db_client = get_db_client()
+    bit_history_collection = db_client["bit_history"]
+
+    db_client["bit_history_snapshots"].delete_one({"_id": tag})
+    bit_history_collection.delete_many({"tag": tag})
+
+
+def remove_bits_from_user(user_id, amount, actor=None, source=None):
+    db_client = get_db_client()
+
+    users_collection = db_client["users"]
+
+    user_query = {"userId": user_id, "bits": {"$gte": amount}}
+    update_query = {"$inc": {"bits": -amount}}
+
+    user = users_collection.find_one_and_update(
+        user_query, update_query, projection={"team": 1}
+    )
+    if user:
+        update_team_totals({user.get("team", "No Team"): -amount})
+        append_ledger_entries(
+            [
+                build_ledger_entry(
+                    user_id, -amount, "removal", actor, source, datetime.utcnow()
+                )
+            ]
+        )
+        return
+
+    # Only the failure path pays for a second read, to pick the right message.
+    if not users_collection.find_one({"userId": user_id}, {"_id": 1}):
+        raise Exception("Cannot remove bits from a user that has no bits")
+
+    raise Exception("Cannot remove more bits than what the user has")
+
+
+def get_leaderboard_documents(limit=10):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    query = {}
+    sort_by_field_query = [("bits", pymongo.DESCENDING), ("userId", pymongo.ASCENDING)]
+    # Only fields from the (bits, userId) index, so the read is served entirely
+    # from the index without fetching user documents.
+    projection = {"_id": 0, "userId": 1, "bits": 1}
+
+    return (
+        users_collection.find(query, projection).sort(sort_by_field_query).limit(limit)
+    )
+
+
+def get_leaderboard_documents_from_history(tag, limit=10):
+    db_client = get_db_client()
+    snapshots_collection = db_client["bit_history_snapshots"]
+    bit_history_collection = db_client["bit_history"]
+
+    snapshot = snapshots_collection.find_one(
+        {"_id": tag}, {"entries": {"$slice": limit}, "team_totals": 0}
+    )
+    if snapshot:
+        return snapshot.get("entries", [])
+
+    sort_by_field_query = [("bits", pymongo.DESCENDING)]
+
+    return (
+        bit_history_collection.find({"tag": tag}).sort(sort_by_field_query).limit(limit)
+    )
+
+
+def get_latest_bit_checkpoint(at, projection=None):
+    return get_db_client()["bit_checkpoints"].find_one(
+        {"createdAt": {"$lte": at}},
+        projection,
+        sort=[("createdAt", pymongo.DESCENDING)],
+    )
+
+
+def get_balances_at(at):
+    # Balances at any moment are the latest checkpoint before it plus the tail
+    # of the ledger up to it, restarting from zero at the last reset.
+    db_client = get_db_client()
+    ledger_collection = db_client["bit_ledger"]
+
+    checkpoint = get_latest_bit_checkpoint(at)
+    start = checkpoint["createdAt"] if checkpoint else datetime.min
+    balances = (
+        {balance["userId"]: balance["bits"] for balance in checkpoint["balances"]}
+        if checkpoint
+        else {}
+    )
+
+    reset = ledger_collection.find_one(
+        {"kind": "reset", "createdAt": {"$gt": start, "$lte": at}},
+        sort=[("createdAt", pymongo.DESCENDING)],
+    )
+    if reset:
+        start = reset["createdAt"]
+        balances = {}
+
+    pipeline = [
+        {
+            "$match": {
+                "createdAt": {"$gt": start, "$lte": at},
+                "kind": {"$ne": "reset"},
+            }
+        },
+        {"$group": {"_id": "$userId", "delta": {"$sum": "$delta"}}},
+    ]
+    for row in ledger_collection.aggregate(pipeline):
+        balances[row["_id"]] = balances.get(row["_id"], 0) + row["delta"]
+
+    return balances
+
+
+def get_user_balance_at(user_id, at):
+    # get_balances_at for one user: only their checkpoint entry and their
+    # ledger entries (through the userId_createdAt index) are read.
+    db_client = get_db_client()
+    ledger_collection = db_client["bit_ledger"]
+
+    checkpoint = get_latest_bit_checkpoint(
+        at, {"createdAt": 1, "balances": {"$elemMatch": {"userId": user_id}}}
+    )
+    start = checkpoint["createdAt"] if checkpoint else datetime.min
+    balances = checkpoint.get("balances", []) if checkpoint else []
+    bits = balances[0]["bits"] if balances else 0
+
+    reset = ledger_collection.find_one(
+        {"kind": "reset", "createdAt": {"$gt": start, "$lte": at}},
+        sort=[("createdAt", pymongo.DESCENDING)],
+    )
+    if reset:
+        start = reset["createdAt"]
+        bits = 0
+
+    pipeline = [
+        {"$match": {"userId": user_id, "createdAt": {"$gt": start, "$lte": at}}},
+        {"$group": {"_id": None, "delta": {"$sum": "$delta"}}},
+    ]
+    for row in ledger_collection.aggregate(pipeline):
+        bits += row["delta"]
+
+    return bits
+
+
+def get_leaderboard_at(at, limit=10):
+    return build_leaderboard(get_balances_at(at), limit)
+
+
+def get_ledger_entries(user_id, limit=50):
+    db_client = get_db_client()
+    ledger_collection = db_client["bit_ledger"]
+
+    # Resets apply to everyone, so they belong in every user's trail.
+    query = {"$or": [{"userId": user_id}, {"kind": "reset"}]}
+    sort_by_field_query = [
+        ("createdAt", pymongo.DESCENDING),
+        ("_id", pymongo.DESCENDING),
+    ]
+
+    return list(
+        ledger_collection.find(query, {"_id": 0}).sort(sort_by_field_query).limit(limit)
+    )
+
+
+def has_bit_ledger_bootstrap():
+    # Balances from before the ledger only exist in the bootstrap checkpoint;
+    # without it every balance the ledger reports is missing them.
+    db_client = get_db_client()
+    return bool(db_client["bit_checkpoints"].find_one({"bootstrap": True}, {"_id": 1}))
+
+
+def create_bit_checkpoint(cutoff=None):
+    # Checkpoints are built from the ledger rather than users.bits, so they
+    # agree with get_balances_at. The cutoff trails the clock a little so
+    # writes still in flight are not skipped over.
+    db_client = get_db_client()
+    checkpoints_collection = db_client["bit_checkpoints"]
+
+    if not has_bit_ledger_bootstrap():
+        # A checkpoint from the ledger alone would drop every pre-ledger
+        # balance, so the first one is seeded from users.bits instead.
+        return bootstrap_bit_ledger()
+
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(seconds=LEDGER_CHECKPOINT_LAG_SECONDS)
+
+    if not get_latest_bit_checkpoint(cutoff, {"_id": 1}):
+        # The cutoff is before the bootstrap; there is nothing to add.
+        return 0
+
+    balances = get_balances_at(cutoff)
+    checkpoint = {
+        "createdAt": cutoff,
+        "balances": [
+            {"userId": user_id, "bits": bits}
+            for user_id, bits in sorted(balances.items())
+            if bits
+        ],
+    }
+    checkpoints_collection.insert_one(checkpoint)
+
+    return len(checkpoint["balances"])
+
+
+def bootstrap_bit_ledger():
+    # Balances from before the ledger existed only live in users.bits; seed
+    # the first checkpoint from them so the ledger tail can build on top.
+    db_client = get_db_client()
+    checkpoints_collection = db_client["bit_checkpoints"]
+    users_collection = db_client["users"]
+
+    if has_bit_ledger_bootstrap():
+        raise Exception("The bit ledger has already been bootstrapped")
+
+    balances = [
+        {"userId": user["userId"], "bits": user["bits"]}
+        for user in users_collection.find(
+            {"bits": {"$ne": 0}}, {"_id": 0, "userId": 1, "bits": 1}
+        )
+    ]
+    checkpoints_collection.insert_one(
+        {"createdAt": datetime.utcnow(), "balances": balances, "bootstrap": True}
+    )
+
+    return len(balances)
+
+
+def rebuild_bits_from_ledger(apply=False):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    if not has_bit_ledger_bootstrap():
+        raise Exception("Run bootstrap-ledger before rebuilding bits from the ledger")
+
+    balances = get_balances_at(datetime.utcnow())
+
+    drift = {}
+    for user in users_collection.find({}, {"_id": 0, "userId": 1, "bits": 1}):
+        actual = balances.pop(user["userId"], 0)
+        if user.get("bits", 0) != actual:
+            drift[user["userId"]] = {"stored": user.get("bits", 0), "actual": actual}
+    for user_id, actual in balances.items():
+        if actual:
+            drift[user_id] = {"stored": None, "actual": actual}
+
+    if apply and drift:
+        users_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"userId": user_id},
+                    {
+                        "$set": {"bits": counts["actual"]},
+                        "$setOnInsert": {"team": "No Team"},
+                    },
+                    upsert=True,
+                )
+                for user_id, counts in drift.items()
+            ],
+            ordered=False,
+        )
+        rebuild_team_leaderboard()
+
+    return drift
+
+
+def get_user_rank(user_id):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    user = users_collection.find_one({"userId": user_id}, {"_id": 0, "bits": 1})
+    if not user:
+        return None
+
+    bits = user.get("bits", 0)
+    # Both counts are answered from the (bits, userId) index and collection
+    # metadata, so they stay cheap however many users there are.
+    ahead = users_collection.count_documents({"bits": {"$gt": bits}})
+    # The estimate comes from metadata that can lag recent inserts; the user and
+    # everyone ahead of them certainly exist, which keeps the percentile in range.
+    total = max(users_collection.estimated_document_count(), ahead + 1)
+
+    return build_rank(user_id, bits, ahead, total)
+
+
+def get_user_rank_from_history(user_id, tag):
+    db_client = get_db_client()
+    snapshots_collection = db_client["bit_history_snapshots"]
+    bit_history_collection = db_client["bit_history"]
+
+    # Snapshot entries are stored sorted by bits, so the first entry with the
+    # user's bits is exactly how many members are ahead of them.
+    pipeline = [
+        {"$match": {"_id": tag}},
+        {
+            "$project": {
+                "_id": 0,
+                "bits": "$entries.bits",
+                "total": {"$size": "$entries"},
+                "position": {"$indexOfArray": ["$entries.userId", user_id]},
+            }
+        },
+        {
+            "$project": {
+                "bits": "$bits",
+                "total": 1,
+                "user_bits": {
+                    "$cond": [
+                        {"$lt": ["$position", 0]},
+                        None,
+                        {"$arrayElemAt": ["$bits", "$position"]},
+                    ]
+                },
+            }
+        },
+        {
+            "$project": {
+                "total": 1,
+                "user_bits": 1,
+                "ahead": {"$indexOfArray": ["$bits", "$user_bits"]},
+            }
+        },
+    ]
+    snapshots = list(snapshots_collection.aggregate(pipeline))
+    if snapshots:
+        snapshot = snapshots[0]
+        if snapshot["user_bits"] is None:
+            return None
+        return build_rank(
+            user_id, snapshot["user_bits"], snapshot["ahead"], snapshot["total"]
+        )
+
+    user = bit_history_collection.find_one({"userId": user_id, "tag": tag})
+    if not user:
+        return None
+
+    bits = user.get("bits", 0)
+    ahead = bit_history_collection.count_documents({"tag": tag, "bits": {"$gt": bits}})
+    total = bit_history_collection.count_documents({"tag": tag})
+
+    return build_rank(user_id, bits, ahead, total)
+
+
+def get_seek_query(after):
+    # Everything strictly after the last entry in (bits desc, userId asc) order.
+    if not after:
+        return {}
+
+    return {
+        "$or": [
+            {"bits": {"$lt": after["bits"]}},
+            {"bits": after["bits"], "userId": {"$gt": after["userId"]}},
+        ]
+    }
+
+
+def get_leaderboard_page(after=None, limit=10):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    sort_by_field_query = [("bits", pymongo.DESCENDING), ("userId", pymongo.ASCENDING)]
+    projection = {"_id": 0, "userId": 1, "bits": 1}
+
+    entries = list(
+        users_collection.find(get_seek_query(after), projection)
+        .sort(sort_by_field_query)
+        .limit(limit + 1)
+    )
+
+    return rank_page(entries, after, limit)
+
+
+def get_leaderboard_page_from_history(tag, after=None, limit=10):
+    db_client = get_db_client()
+    snapshots_collection = db_client["bit_history_snapshots"]
+    bit_history_collection = db_client["bit_history"]
+
+    offset = after["position"] if after else 0
+    snapshot = snapshots_collection.find_one(
+        {"_id": tag}, {"entries": {"$slice": [offset, limit + 1]}, "team_totals": 0}
+    )
+    if snapshot:
+        return rank_page(snapshot.get("entries", []), after, limit)
+
+    query = {"tag": tag, **get_seek_query(after)}
+    sort_by_field_query = [("bits", pymongo.DESCENDING), ("userId", pymongo.ASCENDING)]
+    entries = list(
+        bit_history_collection.find(query, {"_id": 0, "userId": 1, "bits": 1})
+        .sort(sort_by_field_query)
+        .limit(limit + 1)
+    )
+
+    return rank_page(entries, after, limit)
+
+
+def get_team_leaderboard_from_history(tag):
+    db_client = get_db_client()
+
+    snapshots_collection = db_client["bit_history_snapshots"]
+    bit_history_collection = db_client["bit_history"]
+
+    snapshot = snapshots_collection.find_one({"_id": tag}, {"team_totals": 1})
+    if snapshot:
+        return snapshot.get("team_totals", [])
+
+    pipeline = [
+        {"$match": {"tag": tag}},
+        {"$group": {"_id": "$team", "total_bits": {"$sum": "$bits"}}},
+        {"$sort": {"total_bits": -1, "_id": 1}},
+    ]
+
+    result = bit_history_collection.aggregate(pipeline)
+    aggregated_data = list(result)
+    return aggregated_data
+
+
+def get_user_role(user_id):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    user_query = {"userId": user_id}
+    pre_existing_user = users_collection.find_one(user_query, {"role": 1})
+
+    return pre_existing_user.get("role") if pre_existing_user else None
+
+
+def set_user_bits_to_zero(actor=None, source=None):
+    db_client = get_db_client()
+
+    users_collection = db_client["users"]
+    # Taken before the reset, as in rollover_semester: a grant that lands while
+    # update_many runs is then after the reset in the ledger, as it is in the
+    # live balances, instead of being wiped from history.
+    now = datetime.utcnow()
+    users_collection.update_many({}, {"$set": {"bits": 0}})
+    db_client["team_totals"].update_many({}, {"$set": {"total_bits": 0}})
+    # A single entry with no user stands for "every balance is zero from here".
+    append_ledger_entries([build_ledger_entry(None, 0, "reset", actor, source, now)])
+
+
+def set_team_by_user_id(user_id, team):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    user_query = {"userId": user_id}
+    update_query = {"$set": {"team": team}, "$setOnInsert": {"bits": 0}}
+
+    previous = users_collection.find_one_and_update(
+        user_query, update_query, projection={"bits": 1, "team": 1}, upsert=True
+    )
+    if previous and previous.get("team") != team and previous.get("bits"):
+        update_team_totals(
+            {previous.get("team", "No Team"): -previous["bits"], team: previous["bits"]}
+        )
+
+
+def get_team_leaderboard():
+    db_client = get_db_client()
+    team_totals_collection = db_client["team_totals"]
+
+    sort_by_field_query = [
+        ("total_bits", pymongo.DESCENDING),
+        ("_id", pymongo.ASCENDING),
+    ]
+    team_leaderboard = list(team_totals_collection.find({}).sort(sort_by_field_query))
+    if not team_leaderboard:
+        # First read after deploying materialized totals, or an empty workspace.
+        rebuild_team_leaderboard()
+        team_leaderboard = list(
+            team_totals_collection.find({}).sort(sort_by_field_query)
+        )
+
+    return team_leaderboard
+
+
+def update_team_totals(team_deltas, session=None):
+    db_client = get_db_client()
+    team_totals_collection = db_client["team_totals"]
+
+    requests = [
+        UpdateOne({"_id": team}, {"$inc": {"total_bits": delta}}, upsert=True)
+        for team, delta in team_deltas.items()
+        if delta
+    ]
+    if requests:
+        team_totals_collection.bulk_write(requests, ordered=False, session=session)
+
+
+def rebuild_team_leaderboard():
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+    team_totals_collection = db_client["team_totals"]
+
+    pipeline = [{"$group": {"_id": "$team", "total_bits": {"$sum": "$bits"}}}]
+    actual = {
+        team["_id"]: team["total_bits"] for team in users_collection.aggregate(pipeline)
+    }
+    stored = {
+        team["_id"]: team["total_bits"] for team in team_totals_collection.find({})
+    }
+
+    drift = {
+        team: {"stored": stored.get(team), "actual": actual.get(team)}
+        for team in set(actual) | set(stored)
+        if stored.get(team) != actual.get(team)
+    }
+
+    requests = [
+        ReplaceOne({"_id": team}, {"total_bits": total_bits}, upsert=True)
+        for team, total_bits in actual.items()
+    ]
+    requests.extend(DeleteOne({"_id": team}) for team in set(stored) - set(actual))
+    if requests:
+        team_totals_collection.bulk_write(requests, ordered=False)
+
+    return drift
+
+
+def change_user_role(user_id, role):
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+
+    user_query = {"userId": user_id}
+    update_query = {
+        "$set": {"role": role},
+        "$setOnInsert": {"bits": 0, "team": "No Team"},
+    }
+
+    users_collection.update_one(user_query, update_query, upsert=True)
+
+
+def claim_message_id(message_id):
+    db_client = get_db_client()
+    messages_collection = db_client["messages"]
+
+    try:
+        result = messages_collection.update_one(
+            {"messageId": message_id},
+            {"$setOnInsert": {"createdAt": datetime.utcnow()}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race against another delivery of the same event.
+        return False
+
+    return result.upserted_id is not None
+
+
+def set_teams_to_no_team():
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+    team_totals_collection = db_client["team_totals"]
+
+    update_query = {"$set": {"team": "No Team"}}
+    users_collection.update_many({}, update_query)
+
+    # Every team's bits now belong to "No Team"; there are only a handful of
+    # team documents, so fold them client-side.
+    total_bits = sum(
+        team["total_bits"]
+        for team in team_totals_collection.find({}, {"total_bits": 1})
+    )
+    team_totals_collection.bulk_write(
+        [
+            DeleteMany({"_id": {"$ne": "No Team"}}),
+            ReplaceOne({"_id": "No Team"}, {"total_bits": total_bits}, upsert=True),
+        ]
+    )
+
+
+@lru_cache(maxsize=None)
+def supports_transactions():
+    # Standalone servers reject transactions; replica set members and mongos
+    # (every Atlas deployment is one or the other) accept them.
+    hello = get_db_client().command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+def rollover_semester(tag, actor=None, source=None, progress=None):
+    # Snapshot, reset bits and reset teams in the same number of round trips
+    # whatever the workspace size. $merge can't run in a transaction, so the
+    # snapshot is built server-side and written back with insert_one.
+    #
+    # The reset is a single update_many inside the transaction, so it has to
+    # finish within MongoDB's transactionLifetimeLimitSeconds (60 s by default);
+    # past that the transaction aborts and nothing is rolled over. That bounds
+    # the workspace size this can handle to what one update_many rewrites in
+    # well under a minute.
+    db_client = get_db_client()
+    users_collection = db_client["users"]
+    snapshots_collection = db_client["bit_history_snapshots"]
+    team_totals_collection = db_client["team_totals"]
+    progress = progress or (lambda message: None)
+
+    if db_client["bit_history"].find_one({"tag": tag}, {"_id": 1}):
+        raise Exception(f"Bit history for {tag} already exists")
+
+    # with_transaction may run the callback more than once, so progress is
+    # reported only after the commit, for the attempt that committed.
+    messages = []
+
+    def run(session=None):
+        messages.clear()
+        now = datetime.utcnow()
+        pipeline = get_bit_history_snapshot_pipeline(tag, now)
+        snapshot = next(users_collection.aggregate(pipeline, session=session))
+        try:
+            # Keyed by tag, so a second rollover can't overwrite a semester
+            # with the zeroed balances left by the first.
+            snapshots_collection.insert_one(snapshot, session=session)
+        except DuplicateKeyError:
+            raise Exception(f"Bit history for {tag} already exists")
+        messages.append(f"saved a snapshot of {snapshot['user_count']} users")
+
+        users_collection.update_many(
+            {}, {"$set": {"bits": 0, "team": "No Team"}}, session=session
+        )
+        team_totals_collection.bulk_write(
+            [
+                DeleteMany({"_id": {"$ne": "No Team"}}),
+                ReplaceOne({"_id": "No Team"}, {"total_bits": 0}, upsert=True),
+            ],
+            session=session,
+        )
+        append_ledger_entries(
+            [build_ledger_entry(None, 0, "reset", actor, source, now)], session
+        )
+        messages.append("reset every balance and team")
+
+        entries = snapshot["entries"]
+        return {
+            "users": snapshot["user_count"],
+            "bits": sum(entry["bits"] for entry in entries),
+            "teams": sum(1 for entry in entries if entry["team"] != "No Team"),
+        }
+
+    if not supports_transactions():
+        counts = run()
+    else:
+        with db_client.client.start_session() as session:
+            counts = session.with_transaction(run)
+
+    for message in messages:
+        progress(message)
+
+    return counts
+
+
+def get_directory_profiles(user_ids):
+    db_client = get_db_client()
+    directory_collection = db_client["workspace_users"]
+
+    documents = directory_collection.find(
+        {"_id": {"$in": list(user_ids)}}, {"profile": 1}
+    )
+    return {document["_id"]: document["profile"] for document in documents}
+
+
+def save_directory_profiles(profiles):
+    if not profiles:
+        return 0
+
+    db_client = get_db_client()
+    directory_collection = db_client["workspace_users"]
+
+    # Only profiles Slack has edited since they were stored are written. A
+    # stored profile is replaced only if it is still the version read here, so
+    # a concurrent writer with a newer profile wins.
+    stored = {
+        document["_id"]: document["updated"]
+        for document in directory_collection.find(
+            {"_id": {"$in": [profile["id"] for profile in profiles]}}, {"updated": 1}
+        )
+    }
+    now = datetime.utcnow()
+    operations = []
+    for profile in profiles:
+        updated = profile.get("updated", 0)
+        if profile["id"] in stored and updated <= stored[profile["id"]]:
+            continue
+
+        document = {"profile": profile, "updated": updated, "syncedAt": now}
+        if profile["id"] in stored:
+            query = {"_id": profile["id"], "updated": stored[profile["id"]]}
+            operations.append(ReplaceOne(query, document))
+        else:
+            operations.append(ReplaceOne({"_id": profile["id"]}, document, upsert=True))
+
+    if operations:
+        try:
+            directory_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Lost an insert race for a user another writer just stored.
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    return len(operations)
+
+
+def get_directory_sync_state():
+    db_client = get_db_client()
+    state_collection = db_client["workspace_directory_state"]
+
+    return state_collection.find_one({"_id": "users.list"}) or {}
+
+
+def save_directory_sync_state(state):
+    db_client = get_db_client()
+    state_collection = db_client["workspace_directory_state"]
+
+    state_collection.replace_one({"_id": "users.list"}, state, upsert=True)
@@ -0,0 +1,123 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+from config import (
+    USER_PROFILE_CACHE_SIZE,
+    USER_PROFILE_CACHE_TTL_SECONDS,
+    USER_PROFILE_MAX_CONCURRENT_LOOKUPS,
+)
+from database import get_directory_profiles, save_directory_profiles
+
+# The fields of a Slack user object kept in the workspace directory.
+DIRECTORY_PROFILE_FIELDS = ("id", "name", "real_name", "deleted", "is_bot", "updated")
+
+profile_cache = TTLCache(USER_PROFILE_CACHE_SIZE, USER_PROFILE_CACHE_TTL_SECONDS)
+
+
+def fetch_user_profile(client, user_id):
+    response = client.users_info(user=user_id)
+    if not response["ok"]:
+        return None
+
+    profile = response["user"]
+    profile_cache.set(user_id, profile)
+    return profile
+
+
+def to_directory_profile(user):
+    profile = {
+        field: user[field] for field in DIRECTORY_PROFILE_FIELDS if field in user
+    }
+    if "real_name" not in profile and user.get("profile", {}).get("real_name"):
+        profile["real_name"] = user["profile"]["real_name"]
+
+    return profile
+
+
+def get_cached_profiles(user_ids):
+    # Returns every profile found in the cache or, in one query for all the
+    # cache misses, the workspace directory; plus the users found in neither.
+    profiles = {}
+    misses = []
+    for user_id in dict.fromkeys(user_ids):
+        profile = profile_cache.get(user_id)
+        if profile is None:
+            misses.append(user_id)
+        profiles[user_id] = profile
+
+    if misses:
+        found = get_directory_profiles(misses)
+        for user_id, profile in found.items():
+            profile_cache.set(user_id, profile)
+        profiles.update(found)
+        misses = [user_id for user_id in misses if user_id not in found]
+
+    return profiles, misses
+
+
+def save_fetched_profiles(profiles):
+    # Users fetched live are added to the directory so other instances don't
+    # have to fetch them again before the next sync.
+    save_directory_profiles([to_directory_profile(p) for p in profiles if p])
+
+
+def get_user_profile(client, user_id):
+    return get_user_profiles(client, [user_id])[user_id]
+
+
+def get_user_profiles(client, user_ids):
+    profiles, misses = get_cached_profiles(user_ids)
+
+    if len(misses) == 1:
+        profiles[misses[0]] = fetch_user_profile(client, misses[0])
+    elif misses:
+        workers = min(USER_PROFILE_MAX_CONCURRENT_LOOKUPS, len(misses))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = executor.map(
+                lambda user: fetch_user_profile(client, user), misses
+            )
+            profiles.update(zip(misses, fetched))
+
+    if misses:
+        save_fetched_profiles(profiles[user_id] for user_id in misses)
+
+    return profiles
+
+
+async def fetch_user_profile_async(client, user_id):
+    response = await client.users_info(user=user_id)
+    if not response["ok"]:
+        return None
+
+    profile = response["user"]
+    profile_cache.set(user_id, profile)
+    return profile
+
+
+async def get_user_profiles_async(client, user_ids, semaphore=None):
+    semaphore = semaphore or asyncio.Semaphore(USER_PROFILE_MAX_CONCURRENT_LOOKUPS)
+
+    async def fetch(user_id):
+        async with semaphore:
+            return await fetch_user_profile_async(client, user_id)
+
+    profiles, misses = await asyncio.to_thread(get_cached_profiles, user_ids)
+
+    if misses:
+        fetched = await asyncio.gather(*(fetch(user_id) for user_id in misses))
+        profiles.update(zip(misses, fetched))
+        await asyncio.to_thread(save_fetched_profiles, fetched)
+
+    return profiles
+
+
+def get_real_name(profile):
+    if not profile:
+        return "Unknown User"
+
+    return profile.get("real_name", "Unknown User")
+
+
+def get_profile_cache_stats():
+    return profile_cache.stats()
@@ -0,0 +1,154 @@
+import math
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from config import INTEGRATION_RATE_LIMITS, RATE_LIMIT_STORE
+
+
+def refill(tokens, updated_at, rate, burst, now):
+    return min(burst, tokens + max(0.0, now - updated_at) * rate)
+
+
+class InMemoryBucketStore:
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated_at, rate, burst, now)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, max(now, updated_at))
+
+            return allowed, tokens
+
+    def buckets(self):
+        with self._lock:
+            return dict(self._buckets)
+
+
+class MongoBucketStore:
+    # Shares buckets between worker processes. Each take is a single atomic
+    # pipeline update, so concurrent requests cannot spend the same tokens.
+    def __init__(self, collection_name="rate_limit_buckets"):
+        self.collection_name = collection_name
+
+    def get_collection(self):
+        from mongo_storage import get_db_client
+
+        return get_db_client()[self.collection_name]
+
+    def take(self, key, rate, burst, cost, now):
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updatedAt", now]}]}]}
+        pipeline = [
+            {
+                "$set": {
+                    "tokens": {
+                        "$min": [
+                            burst,
+                            {
+                                "$add": [
+                                    {"$ifNull": ["$tokens", burst]},
+                                    {"$multiply": [elapsed, rate]},
+                                ]
+                            },
+                        ]
+                    },
+                    "updatedAt": {"$max": [now, {"$ifNull": ["$updatedAt", now]}]},
+                }
+            },
+            {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+            {
+                "$set": {
+                    "tokens": {
+                        "$cond": [
+                            "$allowed",
+                            {"$subtract": ["$tokens", cost]},
+                            "$tokens",
+                        ]
+                    }
+                }
+            },
+        ]
+        bucket = self.get_collection().find_one_and_update(
+            {"_id": key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+        )
+
+        return bucket["allowed"], bucket["tokens"]
+
+    def buckets(self):
+        return {
+            bucket["_id"]: (bucket["tokens"], bucket["updatedAt"])
+            for bucket in self.get_collection().find({})
+        }
+
+
+def validate_limits(limits):
+    if not isinstance(limits, dict) or "default" not in limits:
+        raise Exception("Rate limits must include a default entry")
+
+    for key, limit in limits.items():
+        for field in ("rate", "burst"):
+            value = limit.get(field) if isinstance(limit, dict) else None
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise Exception(f"Rate limit {key} needs a numeric {field}")
+            if value <= 0:
+                raise Exception(f"Rate limit {key} needs a {field} above 0")
+
+
+class TokenBucketLimiter:
+    def __init__(self, store, limits):
+        # Checked up front so a bad config fails at startup, not on a request.
+        validate_limits(limits)
+        self.store = store
+        self.limits = limits
+
+    def get_limit(self, key):
+        limit = self.limits.get(key, self.limits["default"])
+        return limit["rate"], limit["burst"]
+
+    def acquire(self, key, cost=1):
+        rate, burst = self.get_limit(key)
+        if cost > burst:
+            # Could never succeed, so there is no point telling the caller to wait.
+            return False, None
+
+        allowed, tokens = self.store.take(key, rate, burst, cost, time.time())
+        if allowed:
+            return True, 0
+
+        return False, math.ceil((cost - tokens) / rate)
+
+    def state(self):
+        now = time.time()
+        state = {}
+        for key, (tokens, updated_at) in self.store.buckets().items():
+            rate, burst = self.get_limit(key)
+            state[key] = {
+                "tokens": refill(tokens, updated_at, rate, burst, now),
+                "rate": rate,
+                "burst": burst,
+            }
+
+        return state
+
+
+def get_bucket_store(name):
+    if name == "mongo":
+        return MongoBucketStore()
+
+    if name == "memory":
+        return InMemoryBucketStore()
+
+    raise Exception(f"{name} is not a valid rate limit store")
+
+
+integration_rate_limiter = TokenBucketLimiter(
+    get_bucket_store(RATE_LIMIT_STORE), INTEGRATION_RATE_LIMITS
+)
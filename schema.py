@@ -0,0 +1,574 @@
+import sys
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import pymongo
+from dotenv import load_dotenv
+from pymongo import IndexModel
+
+from config import (
+    INTEGRATION_GRANT_KEY_TTL_SECONDS,
+    INTEGRATION_GRANT_RECOVERY_SECONDS,
+    MESSAGE_ID_TTL_SECONDS,
+    STORAGE_BACKEND,
+)
+from database import (
+    apply_integration_grants,
+    bootstrap_bit_ledger,
+    create_bit_checkpoint,
+    get_pending_integration_grants,
+    rebuild_bits_from_ledger,
+    rebuild_team_leaderboard,
+)
+from mongo_storage import (
+    get_db_client,
+    migrate_bit_history_to_snapshots,
+    supports_transactions,
+)
+
+ASCENDING = pymongo.ASCENDING
+DESCENDING = pymongo.DESCENDING
+
+INDEXES = {
+    "users": [
+        IndexModel([("userId", ASCENDING)], name="userId_unique", unique=True),
+        IndexModel([("bits", DESCENDING), ("userId", ASCENDING)], name="bits_desc"),
+    ],
+    "bit_history": [
+        # Legacy per-user rows, read for tags recorded before compact snapshots.
+        IndexModel(
+            [("userId", ASCENDING), ("tag", ASCENDING)],
+            name="userId_tag_unique",
+            unique=True,
+        ),
+        IndexModel([("tag", ASCENDING), ("bits", DESCENDING)], name="tag_bits_desc"),
+    ],
+    "bit_history_snapshots": [
+        # Multikey index over every member of every snapshot, for per-user
+        # history across semesters.
+        IndexModel([("entries.userId", ASCENDING)], name="entries_userId"),
+    ],
+    "bit_ledger": [
+        IndexModel(
+            [("userId", ASCENDING), ("createdAt", DESCENDING)],
+            name="userId_createdAt",
+        ),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt"),
+        IndexModel(
+            [("kind", ASCENDING), ("createdAt", DESCENDING)], name="kind_createdAt"
+        ),
+    ],
+    "bit_checkpoints": [
+        IndexModel([("createdAt", DESCENDING)], name="createdAt_desc"),
+        IndexModel([("bootstrap", ASCENDING)], name="bootstrap", sparse=True),
+    ],
+    "team_totals": [
+        IndexModel([("total_bits", DESCENDING)], name="total_bits_desc"),
+    ],
+    "integration_grants": [
+        IndexModel(
+            [("integrationName", ASCENDING), ("idempotencyKey", ASCENDING)],
+            name="integration_idempotency_key_unique",
+            unique=True,
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("createdAt", ASCENDING)],
+            name="status_createdAt",
+        ),
+        IndexModel(
+            [("createdAt", ASCENDING)],
+            name="createdAt_ttl",
+            expireAfterSeconds=INTEGRATION_GRANT_KEY_TTL_SECONDS,
+        ),
+    ],
+    "messages": [
+        IndexModel([("messageId", ASCENDING)], name="messageId_unique", unique=True),
+        IndexModel(
+            [("createdAt", ASCENDING)],
+            name="createdAt_ttl",
+            expireAfterSeconds=MESSAGE_ID_TTL_SECONDS,
+        ),
+    ],
+}
+
+SAMPLE_USER_ID = "U00000000"
+SAMPLE_TAG = "Spring 2024"
+SAMPLE_TIME = datetime(2024, 5, 1)
+
+# Every filtered query mongo_storage.py issues, with representative arguments.
+QUERIES = [
+    ("get_bits_by_user_id", "users", "find", {"filter": {"userId": SAMPLE_USER_ID}}),
+    (
+        "get_bits_by_user_id_from_history (legacy rows)",
+        "bit_history",
+        "find",
+        {"filter": {"userId": SAMPLE_USER_ID, "tag": SAMPLE_TAG}},
+    ),
+    ("give_bits_to_user", "users", "find", {"filter": {"userId": SAMPLE_USER_ID}}),
+    (
+        "give_bits_to_users",
+        "users",
+        "find",
+        {"filter": {"userId": SAMPLE_USER_ID}},
+    ),
+    (
+        "remove_bits_from_users",
+        "users",
+        "find",
+        {"filter": {"userId": SAMPLE_USER_ID, "bits": {"$gte": 1}}},
+    ),
+    (
+        "remove_bit_history_by_tag",
+        "bit_history",
+        "find",
+        {"filter": {"tag": SAMPLE_TAG}},
+    ),
+    (
+        "get_leaderboard_documents",
+        "users",
+        "find",
+        {
+            "filter": {},
+            "projection": {"_id": 0, "userId": 1, "bits": 1},
+            "sort": [("bits", DESCENDING), ("userId", ASCENDING)],
+            "limit": 10,
+        },
+    ),
+    (
+        "get_user_rank",
+        "users",
+        "find",
+        {"filter": {"bits": {"$gt": 10}}, "projection": {"_id": 0, "bits": 1}},
+    ),
+    (
+        "get_user_rank_from_history (legacy rows)",
+        "bit_history",
+        "find",
+        {"filter": {"tag": SAMPLE_TAG, "bits": {"$gt": 10}}},
+    ),
+    (
+        "get_leaderboard_page",
+        "users",
+        "find",
+        {
+            "filter": {
+                "$or": [
+                    {"bits": {"$lt": 10}},
+                    {"bits": 10, "userId": {"$gt": SAMPLE_USER_ID}},
+                ]
+            },
+            "projection": {"_id": 0, "userId": 1, "bits": 1},
+            "sort": [("bits", DESCENDING), ("userId", ASCENDING)],
+            "limit": 11,
+        },
+    ),
+    (
+        "get_leaderboard_documents_from_history (legacy rows)",
+        "bit_history",
+        "find",
+        {"filter": {"tag": SAMPLE_TAG}, "sort": [("bits", DESCENDING)], "limit": 10},
+    ),
+    (
+        "get_team_leaderboard_from_history (legacy rows)",
+        "bit_history",
+        "aggregate",
+        {
+            "pipeline": [
+                {"$match": {"tag": SAMPLE_TAG}},
+                {"$group": {"_id": "$team", "total_bits": {"$sum": "$bits"}}},
+                {"$sort": {"total_bits": -1}},
+            ]
+        },
+    ),
+    (
+        "get_team_leaderboard",
+        "team_totals",
+        "find",
+        {"filter": {}, "sort": [("total_bits", DESCENDING)]},
+    ),
+    (
+        "bit history snapshot reads",
+        "bit_history_snapshots",
+        "find",
+        {"filter": {"_id": SAMPLE_TAG}},
+    ),
+    (
+        "get_bit_history_matrix",
+        "bit_history_snapshots",
+        "find",
+        {"filter": {"entries.userId": SAMPLE_USER_ID}},
+    ),
+    (
+        "get_bit_history_matrix (legacy rows)",
+        "bit_history",
+        "find",
+        {"filter": {"userId": SAMPLE_USER_ID}},
+    ),
+    (
+        "get_latest_bit_checkpoint",
+        "bit_checkpoints",
+        "find",
+        {
+            "filter": {"createdAt": {"$lte": SAMPLE_TIME}},
+            "sort": [("createdAt", DESCENDING)],
+            "limit": 1,
+        },
+    ),
+    (
+        "has_bit_ledger_bootstrap",
+        "bit_checkpoints",
+        "find",
+        {"filter": {"bootstrap": True}, "projection": {"_id": 1}, "limit": 1},
+    ),
+    (
+        "get_balances_at (last reset)",
+        "bit_ledger",
+        "find",
+        {
+            "filter": {"kind": "reset", "createdAt": {"$lte": SAMPLE_TIME}},
+            "sort": [("createdAt", DESCENDING)],
+            "limit": 1,
+        },
+    ),
+    (
+        "get_balances_at (ledger tail)",
+        "bit_ledger",
+        "aggregate",
+        {
+            "pipeline": [
+                {
+                    "$match": {
+                        "createdAt": {"$gt": SAMPLE_TIME, "$lte": SAMPLE_TIME},
+                        "kind": {"$ne": "reset"},
+                    }
+                },
+                {"$group": {"_id": "$userId", "delta": {"$sum": "$delta"}}},
+            ]
+        },
+    ),
+    (
+        "get_user_balance_at (ledger tail)",
+        "bit_ledger",
+        "aggregate",
+        {
+            "pipeline": [
+                {
+                    "$match": {
+                        "userId": SAMPLE_USER_ID,
+                        "createdAt": {"$gt": SAMPLE_TIME, "$lte": SAMPLE_TIME},
+                    }
+                },
+                {"$group": {"_id": None, "delta": {"$sum": "$delta"}}},
+            ]
+        },
+    ),
+    (
+        "get_ledger_entries",
+        "bit_ledger",
+        "find",
+        {
+            "filter": {"$or": [{"userId": SAMPLE_USER_ID}, {"kind": "reset"}]},
+            "sort": [("createdAt", DESCENDING)],
+            "limit": 50,
+        },
+    ),
+    ("user_is_admin", "users", "find", {"filter": {"userId": SAMPLE_USER_ID}}),
+    ("set_team_by_user_id", "users", "find", {"filter": {"userId": SAMPLE_USER_ID}}),
+    ("change_user_role", "users", "find", {"filter": {"userId": SAMPLE_USER_ID}}),
+    (
+        "release_integration_grant_keys",
+        "integration_grants",
+        "find",
+        {
+            "filter": {
+                "integrationName": "sample",
+                "idempotencyKey": {"$in": ["sample"]},
+            }
+        },
+    ),
+    (
+        "get_pending_integration_grants",
+        "integration_grants",
+        "find",
+        {
+            "filter": {"status": "pending", "createdAt": {"$lt": SAMPLE_TIME}},
+            "sort": [("createdAt", ASCENDING)],
+        },
+    ),
+    ("claim_message_id", "messages", "find", {"filter": {"messageId": "sample"}}),
+    (
+        "get_directory_profiles",
+        "workspace_users",
+        "find",
+        {"filter": {"_id": {"$in": [SAMPLE_USER_ID]}}},
+    ),
+]
+
+# Queries that touch every document by design, so a collection scan is expected.
+FULL_SCANS = [
+    "record_bit_history",
+    "get_bit_history_matrix (all users)",
+    "bootstrap_bit_ledger",
+    "rebuild_bits_from_ledger",
+    "rebuild_team_leaderboard",
+    "set_user_bits_to_zero",
+    "set_teams_to_no_team",
+    "rollover_semester",
+]
+
+
+def apply_indexes():
+    # Each collection is built on its own, so a unique index that fails on bad
+    # legacy data doesn't leave every collection after it without indexes.
+    db_client = get_db_client()
+
+    created = {}
+    failed = {}
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created[collection_name] = db_client[collection_name].create_indexes(
+                indexes
+            )
+        except Exception as e:
+            failed[collection_name] = e
+
+    return created, failed
+
+
+@lru_cache(maxsize=None)
+def ensure_indexes():
+    # Attempted once per process. A build that fails (say, duplicate rows under a
+    # new unique index) is logged rather than retried on every request; run
+    # `python schema.py dedupe --apply`, then `python schema.py apply`.
+    try:
+        created, failed = apply_indexes()
+    except Exception as e:
+        print(f"Applying indexes failed: {e}", file=sys.stderr)
+        return None
+
+    for collection_name, e in failed.items():
+        print(f"Applying {collection_name} indexes failed: {e}", file=sys.stderr)
+    return created
+
+
+# Keys that the unique indexes above require to be distinct. Legacy data from
+# before those indexes can repeat them.
+UNIQUE_KEYS = {
+    "users": ["userId"],
+    "bit_history": ["userId", "tag"],
+    "messages": ["messageId"],
+}
+
+
+def find_duplicates(collection_name, keys):
+    db_client = get_db_client()
+
+    pipeline = [
+        {
+            "$group": {
+                "_id": {key: f"${key}" for key in keys},
+                "ids": {"$push": "$_id"},
+                "bits": {"$sum": "$bits"},
+                "roles": {"$addToSet": "$role"},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    return list(db_client[collection_name].aggregate(pipeline, allowDiskUse=True))
+
+
+def dedupe_legacy_data(apply=False):
+    # Duplicate users and bit_history rows each hold part of a balance, so they
+    # are merged into the oldest document with the bits summed (and the admin
+    # role kept). Rows missing a key can't be looked up at all and are removed,
+    # as are repeated message ids.
+    if STORAGE_BACKEND != "mongo":
+        raise Exception("Only the Mongo backend can hold duplicate rows")
+
+    db_client = get_db_client()
+
+    counts = {}
+    for collection_name, keys in UNIQUE_KEYS.items():
+        collection = db_client[collection_name]
+        groups = find_duplicates(collection_name, keys)
+        removed = 0
+        for group in groups:
+            ids = sorted(group["ids"])
+            keep, extra = ids[0], ids[1:]
+            if any(group["_id"].get(key) is None for key in keys):
+                keep, extra = None, ids
+            elif collection_name != "messages" and apply:
+                update = {"bits": group["bits"]}
+                if "admin" in group["roles"]:
+                    update["role"] = "admin"
+                collection.update_one({"_id": keep}, {"$set": update})
+
+            if apply:
+                collection.delete_many({"_id": {"$in": extra}})
+            removed += len(extra)
+
+        counts[collection_name] = {"groups": len(groups), "removed": removed}
+
+    if apply and counts["users"]["groups"]:
+        rebuild_team_leaderboard()
+
+    return counts
+
+
+def explain_query(collection_name, kind, spec):
+    db_client = get_db_client()
+    collection = db_client[collection_name]
+
+    if kind == "aggregate":
+        return db_client.command(
+            "aggregate", collection_name, pipeline=spec["pipeline"], explain=True
+        )
+
+    cursor = collection.find(spec["filter"], spec.get("projection"))
+    if spec.get("sort"):
+        cursor = cursor.sort(spec["sort"])
+    if spec.get("limit"):
+        cursor = cursor.limit(spec["limit"])
+
+    return cursor.explain()
+
+
+def find_winning_stages(explain_output, in_winning_plan=False):
+    stages = []
+    if isinstance(explain_output, dict):
+        if in_winning_plan and "stage" in explain_output:
+            stages.append(explain_output["stage"])
+
+        for key, value in explain_output.items():
+            if key == "rejectedPlans":
+                continue
+            stages.extend(
+                find_winning_stages(value, in_winning_plan or key == "winningPlan")
+            )
+    elif isinstance(explain_output, list):
+        for value in explain_output:
+            stages.extend(find_winning_stages(value, in_winning_plan))
+
+    return stages
+
+
+def recover_integration_grants(apply=False):
+    cutoff = datetime.utcnow() - timedelta(seconds=INTEGRATION_GRANT_RECOVERY_SECONDS)
+    pending = get_pending_integration_grants(cutoff)
+    if not apply or not pending:
+        return pending, []
+
+    # Without transactions a pending claim may already have been granted, so
+    # applying it again could grant it twice.
+    if STORAGE_BACKEND == "mongo" and not supports_transactions():
+        raise Exception(
+            "This Mongo deployment doesn't support transactions; check the ledger "
+            "before granting pending claims by hand"
+        )
+
+    claims_by_integration = {}
+    for claim in pending:
+        claims_by_integration.setdefault(claim["integrationName"], []).append(
+            (claim["idempotencyKey"], claim["userId"], claim["amount"])
+        )
+    # Grants that still fail are released, so the integration's next retry of
+    # those keys applies them.
+    released = []
+    for integration_name, claims in claims_by_integration.items():
+        failed = apply_integration_grants(
+            integration_name, claims, "integration-recovery"
+        )
+        released.extend((integration_name, key) for key in failed)
+
+    return pending, released
+
+
+def check_query_plans():
+    failures = []
+    for name, collection_name, kind, spec in QUERIES:
+        stages = find_winning_stages(explain_query(collection_name, kind, spec))
+        if "COLLSCAN" in stages:
+            failures.append(name)
+
+    return failures
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "apply"
+
+    if command == "apply":
+        created, failed = apply_indexes()
+        for collection_name, names in created.items():
+            print(f"{collection_name}: {', '.join(names)}")
+        for collection_name, e in failed.items():
+            print(f"{collection_name}: FAILED {e}")
+        return 1 if failed else 0
+
+    if command == "dedupe":
+        apply = "--apply" in argv
+        for collection_name, counts in dedupe_legacy_data(apply=apply).items():
+            print(
+                f"{collection_name}: {counts['groups']} duplicated keys, "
+                f"{counts['removed']} documents {'removed' if apply else 'to remove'}"
+            )
+        return 0
+
+    if command == "migrate-history":
+        migrated = migrate_bit_history_to_snapshots(
+            delete_legacy="--delete-legacy" in argv
+        )
+        for tag, user_count in migrated.items():
+            print(f"{tag}: {user_count} users")
+        return 0
+
+    if command == "bootstrap-ledger":
+        print(f"Seeded the first ledger checkpoint with {bootstrap_bit_ledger()} users")
+        return 0
+
+    if command == "checkpoint-ledger":
+        print(f"Checkpointed {create_bit_checkpoint()} balances")
+        return 0
+
+    if command == "rebuild-bits":
+        apply = "--apply" in argv
+        drift = rebuild_bits_from_ledger(apply=apply)
+        for user_id, counts in sorted(drift.items()):
+            print(f"{user_id}: {counts['stored']} -> {counts['actual']}")
+        print(f"{len(drift)} users {'corrected' if apply else 'drifted'}")
+        return 0
+
+    if command == "recover-grants":
+        apply = "--apply" in argv
+        pending, released = recover_integration_grants(apply=apply)
+        for claim in pending:
+            print(
+                f"{claim['integrationName']} {claim['idempotencyKey']}: "
+                f"{claim['amount']} bits to {claim['userId']}"
+                + (
+                    " (released)"
+                    if (claim["integrationName"], claim["idempotencyKey"]) in released
+                    else ""
+                )
+            )
+        print(f"{len(pending)} pending grants {'applied' if apply else 'found'}")
+        return 1 if released else 0
+
+    if command == "check":
+        failures = check_query_plans()
+        for name in failures:
+            print(f"COLLSCAN: {name}")
+        print(f"{len(QUERIES) - len(failures)}/{len(QUERIES)} queries use an index")
+        return 1 if failures else 0
+
+    print(
+        f"Unknown command {command}; expected 'apply', 'check', 'dedupe', "
+        "'migrate-history', 'bootstrap-ledger', 'checkpoint-ledger', 'rebuild-bits' "
+        "or 'recover-grants'"
+    )
+    return 2
+
+
+if __name__ == "__main__":
+    load_dotenv("./api/.env")
+    sys.exit(main(sys.argv))
@@ -0,0 +1,143 @@
+import http.client
+import os
+import threading
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.version import __version__ as slack_sdk_version
+
+from config import SLACK_MAX_IDLE_CONNECTIONS
+from metrics import slack_calls, slack_duration, slack_errors, slack_rate_limited
+from slack_scheduler import slack_scheduler
+
+# Errors that mean a kept-alive connection was closed by the server while idle.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+# The release _perform_urllib_http_request_internal was written against; keep
+# in step with requirements.txt.
+PINNED_SLACK_SDK_VERSION = "3.21.3"
+
+
+class InstrumentedWebClient(WebClient):
+    def __init__(self, *args, scheduler=slack_scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.opened_connections = 0
+        # Idle kept-alive connections shared by every thread, keyed by host.
+        # Connections are checked out for one request at a time, so nothing is
+        # left open when short-lived worker threads exit.
+        self._idle_connections = {}
+        self._connections_lock = threading.Lock()
+
+    def api_call(self, api_method, **kwargs):
+        return self.scheduler.call(
+            api_method, kwargs, lambda: self.send_api_call(api_method, **kwargs)
+        )
+
+    def send_api_call(self, api_method, **kwargs):
+        slack_calls.inc(method=api_method)
+        start = time.perf_counter()
+        try:
+            return super().api_call(api_method, **kwargs)
+        except SlackApiError as e:
+            slack_errors.inc(method=api_method)
+            if e.response.status_code == 429:
+                slack_rate_limited.inc(method=api_method)
+            raise
+        finally:
+            slack_duration.observe(time.perf_counter() - start, method=api_method)
+
+    def checkout_connection(self, scheme, netloc):
+        with self._connections_lock:
+            idle = self._idle_connections.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+            self.opened_connections += 1
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                netloc, timeout=self.timeout, context=self.ssl
+            )
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def checkin_connection(self, scheme, netloc, connection):
+        with self._connections_lock:
+            idle = self._idle_connections.setdefault((scheme, netloc), [])
+            if len(idle) < SLACK_MAX_IDLE_CONNECTIONS:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def close_connections(self):
+        with self._connections_lock:
+            idle, self._idle_connections = self._idle_connections, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        # slack_sdk opens a new connection (and TLS handshake) for every call
+        # and has no public transport hook, so this overrides the private method
+        # it sends through. Its shape is only known for the pinned release;
+        # anything else, and proxied requests, go through slack_sdk unchanged.
+        parts = urlsplit(url)
+        if (
+            slack_sdk_version != PINNED_SLACK_SDK_VERSION
+            or self.proxy is not None
+            or parts.scheme not in ("http", "https")
+        ):
+            return super()._perform_urllib_http_request_internal(url, req)
+
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            connection = self.checkout_connection(parts.scheme, parts.netloc)
+            reused = connection.sock is not None
+            try:
+                # Whatever slack_sdk built; for this client that is always POST.
+                connection.request(
+                    req.get_method(), path, body=req.data, headers=req.headers
+                )
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not reused or attempt:
+                    raise
+            except Exception:
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.checkin_connection(parts.scheme, parts.netloc, connection)
+
+        if response.headers.get_content_type() != "application/gzip":
+            body = body.decode(response.headers.get_content_charset() or "utf-8")
+
+        return {"status": response.status, "headers": response.headers, "body": body}
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    return InstrumentedWebClient(
+        token=os.environ["SLACK_BOT_TOKEN"],
+        base_url=os.getenv("SLACK_API_URL", WebClient.BASE_URL),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_bot_id(client):
+    # The bot's identity never changes for a token, so auth.test is called at
+    # most once per client instead of at import and again on every `help`.
+    return client.api_call("auth.test")["user_id"]
@@ -0,0 +1,229 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from slack_sdk.errors import SlackApiError
+
+from config import (
+    COMMAND_DISPATCH_MODE,
+    SLACK_CHANNEL_MESSAGE_BURST,
+    SLACK_CHANNEL_MESSAGES_PER_SECOND,
+    SLACK_INLINE_MAX_WAIT_SECONDS,
+    SLACK_MAX_RETRIES,
+    SLACK_MAX_RETRY_AFTER_SECONDS,
+    SLACK_METHOD_TIERS,
+    SLACK_TIER_BUDGETS,
+)
+from metrics import slack_budget_wait, slack_retries
+from rate_limit import InMemoryBucketStore
+
+# Lower numbers go first when calls are queued on the same budget.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+PER_CHANNEL_METHODS = {"chat.postMessage"}
+
+_local = threading.local()
+
+
+@contextmanager
+def slack_priority(priority):
+    previous = getattr(_local, "priority", PRIORITY_INTERACTIVE)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def get_priority():
+    return getattr(_local, "priority", PRIORITY_INTERACTIVE)
+
+
+def get_call_channel(kwargs):
+    for arguments in (kwargs.get("json"), kwargs.get("params"), kwargs.get("data")):
+        if arguments and arguments.get("channel"):
+            return arguments["channel"]
+
+    return None
+
+
+def get_retry_after(error):
+    headers = {k.lower(): v for k, v in (error.response.headers or {}).items()}
+    try:
+        return float(headers.get("retry-after", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class SlackScheduler:
+    def __init__(
+        self,
+        method_tiers,
+        tier_budgets,
+        channel_rate,
+        channel_burst,
+        max_retries,
+        max_retry_after,
+        interactive_max_wait=None,
+    ):
+        self.method_tiers = method_tiers
+        self.tier_budgets = tier_budgets
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.interactive_max_wait = interactive_max_wait
+        self.buckets = InMemoryBucketStore()
+        self.throttled_calls = 0
+        self.retried_calls = 0
+        self._waiting = Counter()
+        self._blocked_until = {}
+        self._condition = threading.Condition()
+
+    def get_budget(self, api_method, kwargs):
+        if api_method in PER_CHANNEL_METHODS:
+            channel = get_call_channel(kwargs)
+            return (
+                f"{api_method}:{channel}",
+                self.channel_rate,
+                self.channel_burst,
+            )
+
+        per_minute, burst = self.tier_budgets[self.method_tiers.get(api_method, 3)]
+        return api_method, per_minute / 60, burst
+
+    def is_outranked(self, key, priority):
+        return any(
+            count
+            for (waiting_key, waiting_priority), count in self._waiting.items()
+            if waiting_key == key and waiting_priority < priority
+        )
+
+    def get_deadline(self, priority):
+        # Interactive calls may be holding up a Slack event that has to be
+        # acknowledged quickly; background calls can wait as long as it takes.
+        if priority != PRIORITY_INTERACTIVE or self.interactive_max_wait is None:
+            return None
+
+        return time.monotonic() + self.interactive_max_wait
+
+    def acquire(self, key, rate, burst, priority, deadline=None):
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[(key, priority)] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._blocked_until.get(key, 0) - now
+                    if wait <= 0 and not self.is_outranked(key, priority):
+                        allowed, tokens = self.buckets.take(key, rate, burst, 1, now)
+                        if allowed:
+                            break
+                        wait = (1 - tokens) / rate
+
+                    if deadline is not None and now + max(wait, 0) > deadline:
+                        raise Exception(
+                            f"Slack's {key.split(':')[0]} budget is exhausted; try again shortly"
+                        )
+
+                    # Outranked callers have no deadline; they are woken when
+                    # the higher priority call ahead of them gets its token.
+                    self._condition.wait(timeout=wait if wait > 0 else None)
+            finally:
+                self._waiting[(key, priority)] -= 1
+                if not self._waiting[(key, priority)]:
+                    del self._waiting[(key, priority)]
+                self._condition.notify_all()
+
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.throttled_calls += 1
+
+        slack_budget_wait.observe(waited, budget=key.split(":")[0])
+
+    def block(self, key, seconds):
+        with self._condition:
+            until = time.monotonic() + seconds
+            self._blocked_until[key] = max(self._blocked_until.get(key, 0), until)
+            self._condition.notify_all()
+
+    def get_retry_delay(self, error, attempt, deadline=None):
+        # Seconds to wait before retrying a failed call, or None to give up.
+        if error.response.status_code != 429 or attempt == self.max_retries:
+            return None
+
+        retry_after = get_retry_after(error)
+        if retry_after > self.max_retry_after:
+            return None
+        if deadline is not None and time.monotonic() + retry_after > deadline:
+            return None
+
+        return retry_after
+
+    def record_retry(self, key, api_method, retry_after):
+        # Slack's Retry-After covers every caller of this budget, not just the
+        # one that hit it.
+        self.block(key, retry_after)
+        with self._condition:
+            self.retried_calls += 1
+        slack_retries.inc(method=api_method)
+
+    def call(self, api_method, kwargs, send):
+        key, rate, burst = self.get_budget(api_method, kwargs)
+        priority = get_priority()
+        deadline = self.get_deadline(priority)
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire(key, rate, burst, priority, deadline)
+            try:
+                return send()
+            except SlackApiError as e:
+                retry_after = self.get_retry_delay(e, attempt, deadline)
+                if retry_after is None:
+                    raise
+                self.record_retry(key, api_method, retry_after)
+
+    async def call_async(self, api_method, kwargs, send):
+        # Same budgets as call(), so sync and async clients share them. Waiting
+        # for a token happens off the event loop.
+        key, rate, burst = self.get_budget(api_method, kwargs)
+        priority = get_priority()
+        deadline = self.get_deadline(priority)
+
+        for attempt in range(self.max_retries + 1):
+            await asyncio.to_thread(self.acquire, key, rate, burst, priority, deadline)
+            try:
+                return await send()
+            except SlackApiError as e:
+                retry_after = self.get_retry_delay(e, attempt, deadline)
+                if retry_after is None:
+                    raise
+                self.record_retry(key, api_method, retry_after)
+
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            return {
+                "waiting_calls": sum(self._waiting.values()),
+                "throttled_calls": self.throttled_calls,
+                "retried_calls": self.retried_calls,
+                "blocked": {
+                    key: round(until - now, 3)
+                    for key, until in self._blocked_until.items()
+                    if until > now
+                },
+            }
+
+
+slack_scheduler = SlackScheduler(
+    SLACK_METHOD_TIERS,
+    SLACK_TIER_BUDGETS,
+    SLACK_CHANNEL_MESSAGES_PER_SECOND,
+    SLACK_CHANNEL_MESSAGE_BURST,
+    SLACK_MAX_RETRIES,
+    SLACK_MAX_RETRY_AFTER_SECONDS,
+    SLACK_INLINE_MAX_WAIT_SECONDS if COMMAND_DISPATCH_MODE == "inline" else None,
+)
@@ -0,0 +1,1058 @@
+import atexit
+import json
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from config import (
+    INTEGRATION_GRANT_KEY_TTL_SECONDS,
+    LEDGER_CHECKPOINT_LAG_SECONDS,
+    MESSAGE_ID_TTL_SECONDS,
+    SQLITE_BUSY_TIMEOUT_SECONDS,
+    SQLITE_DATABASE_PATH,
+)
+from storage_common import (
+    build_bit_history_matrix,
+    build_leaderboard,
+    build_ledger_entry,
+    build_rank,
+    rank_page,
+)
+
+# Mirrors the Mongo collections. Snapshots are split into entry and team total
+# rows; an entry's position is its place in (bits desc, userId asc) order.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    userId TEXT PRIMARY KEY,
+    bits INTEGER NOT NULL DEFAULT 0,
+    team TEXT NOT NULL DEFAULT 'No Team',
+    role TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_bits_desc ON users (bits DESC, userId);
+
+CREATE TABLE IF NOT EXISTS team_totals (
+    team TEXT PRIMARY KEY,
+    total_bits INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS bit_history_snapshots (
+    tag TEXT PRIMARY KEY,
+    user_count INTEGER NOT NULL,
+    createdAt TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS bit_history_entries (
+    tag TEXT NOT NULL REFERENCES bit_history_snapshots (tag) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    userId TEXT NOT NULL,
+    team TEXT NOT NULL,
+    bits INTEGER NOT NULL,
+    PRIMARY KEY (tag, position)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS bit_history_entries_userId_tag
+    ON bit_history_entries (userId, tag);
+CREATE INDEX IF NOT EXISTS bit_history_entries_tag_bits
+    ON bit_history_entries (tag, bits);
+CREATE TABLE IF NOT EXISTS bit_history_team_totals (
+    tag TEXT NOT NULL REFERENCES bit_history_snapshots (tag) ON DELETE CASCADE,
+    team TEXT NOT NULL,
+    total_bits INTEGER NOT NULL,
+    PRIMARY KEY (tag, team)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS bit_ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    userId TEXT,
+    delta INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    actor TEXT,
+    source TEXT,
+    createdAt TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bit_ledger_userId_createdAt
+    ON bit_ledger (userId, createdAt DESC);
+CREATE INDEX IF NOT EXISTS bit_ledger_createdAt ON bit_ledger (createdAt);
+CREATE INDEX IF NOT EXISTS bit_ledger_kind_createdAt
+    ON bit_ledger (kind, createdAt DESC);
+
+CREATE TABLE IF NOT EXISTS bit_checkpoints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    createdAt TEXT NOT NULL,
+    bootstrap INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS bit_checkpoints_createdAt_desc
+    ON bit_checkpoints (createdAt DESC);
+CREATE TABLE IF NOT EXISTS bit_checkpoint_balances (
+    checkpointId INTEGER NOT NULL REFERENCES bit_checkpoints (id) ON DELETE CASCADE,
+    userId TEXT NOT NULL,
+    bits INTEGER NOT NULL,
+    PRIMARY KEY (checkpointId, userId)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS integration_grants (
+    integrationName TEXT NOT NULL,
+    idempotencyKey TEXT NOT NULL,
+    userId TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    createdAt TEXT NOT NULL,
+    PRIMARY KEY (integrationName, idempotencyKey)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS integration_grants_createdAt
+    ON integration_grants (createdAt);
+CREATE INDEX IF NOT EXISTS integration_grants_status_createdAt
+    ON integration_grants (status, createdAt);
+
+CREATE TABLE IF NOT EXISTS messages (
+    messageId TEXT PRIMARY KEY,
+    createdAt TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_createdAt ON messages (createdAt);
+
+CREATE TABLE IF NOT EXISTS workspace_users (
+    userId TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    updated INTEGER NOT NULL,
+    syncedAt TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS workspace_directory_state (
+    id TEXT PRIMARY KEY,
+    cursor TEXT,
+    startedAt TEXT,
+    completedAt TEXT
+) WITHOUT ROWID;
+"""
+
+_local = threading.local()
+_connections = weakref.WeakSet()
+_schema_lock = threading.Lock()
+_schema_created = False
+
+
+class Connection(sqlite3.Connection):
+    # Closed as soon as the thread that opened it exits and drops it.
+    def __del__(self):
+        self.close()
+
+
+def create_schema(connection):
+    # Once per process rather than once per thread.
+    global _schema_created
+    with _schema_lock:
+        if not _schema_created:
+            connection.executescript(SCHEMA)
+            columns = [
+                row["name"]
+                for row in connection.execute("PRAGMA table_info(bit_checkpoints)")
+            ]
+            if "bootstrap" not in columns:
+                # Files created before the bootstrap checkpoint was marked.
+                connection.execute(
+                    "ALTER TABLE bit_checkpoints "
+                    "ADD COLUMN bootstrap INTEGER NOT NULL DEFAULT 0"
+                )
+            _schema_created = True
+
+
+def get_connection():
+    # sqlite3 connections can't be shared between threads; WAL mode lets each
+    # thread's connection read while another one writes.
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(
+            SQLITE_DATABASE_PATH,
+            timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+            isolation_level=None,
+            check_same_thread=False,
+            factory=Connection,
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        create_schema(connection)
+        _local.connection = connection
+        _connections.add(connection)
+
+    return connection
+
+
+@atexit.register
+def close_connections():
+    # Connections of threads that are still alive, so the WAL is checkpointed
+    # and removed on a clean shutdown.
+    for connection in list(_connections):
+        connection.close()
+    _local.__dict__.pop("connection", None)
+
+
+@contextmanager
+def transaction():
+    # Nested calls join the outer transaction.
+    connection = get_connection()
+    if connection.in_transaction:
+        yield connection
+        return
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def to_timestamp(value):
+    # Fixed width naive UTC, so timestamps compare correctly as text.
+    if value and value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="microseconds") if value else None
+
+
+def from_timestamp(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def placeholders(values):
+    return ", ".join("?" for _ in values)
+
+
+def get_bits_by_user_id(user_id):
+    row = (
+        get_connection()
+        .execute("SELECT bits FROM users WHERE userId = ?", (user_id,))
+        .fetchone()
+    )
+    return row["bits"] if row else 0
+
+
+def get_bits_by_user_id_from_history(user_id, tag):
+    row = (
+        get_connection()
+        .execute(
+            "SELECT bits FROM bit_history_entries WHERE userId = ? AND tag = ?",
+            (user_id, tag),
+        )
+        .fetchone()
+    )
+    return row["bits"] if row else 0
+
+
+def append_ledger_entries(connection, entries):
+    connection.executemany(
+        "INSERT INTO bit_ledger (userId, delta, kind, actor, source, createdAt) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                entry["userId"],
+                entry["delta"],
+                entry["kind"],
+                entry["actor"],
+                entry["source"],
+                to_timestamp(entry["createdAt"]),
+            )
+            for entry in entries
+        ],
+    )
+
+
+def update_team_totals(connection, team_deltas):
+    connection.executemany(
+        "INSERT INTO team_totals (team, total_bits) VALUES (?, ?) "
+        "ON CONFLICT (team) DO UPDATE SET total_bits = total_bits + excluded.total_bits",
+        [(team, delta) for team, delta in team_deltas.items() if delta],
+    )
+
+
+def give_bits_to_user(user_id, amount, actor=None, source=None):
+    with transaction() as connection:
+        user = connection.execute(
+            "INSERT INTO users (userId, bits) VALUES (?, ?) "
+            "ON CONFLICT (userId) DO UPDATE SET bits = bits + excluded.bits "
+            "RETURNING team",
+            (user_id, amount),
+        ).fetchone()
+        update_team_totals(connection, {user["team"]: amount})
+        append_ledger_entries(
+            connection,
+            [
+                build_ledger_entry(
+                    user_id, amount, "grant", actor, source, datetime.utcnow()
+                )
+            ],
+        )
+
+
+def give_bits_to_users(user_ids, amount, actor=None, source=None):
+    user_ids = list(dict.fromkeys(user_ids))
+    statuses = apply_bit_grants(
+        [(user_id, amount) for user_id in user_ids], actor, source
+    )
+
+    return dict(zip(user_ids, statuses))
+
+
+def apply_bit_grants(grants, actor=None, source=None):
+    if not grants:
+        return []
+
+    amounts_by_user = {}
+    for user_id, amount in grants:
+        amounts_by_user[user_id] = amounts_by_user.get(user_id, 0) + amount
+
+    with transaction() as connection:
+        existing = {
+            row["userId"]
+            for row in connection.execute(
+                f"SELECT userId FROM users WHERE userId IN ({placeholders(amounts_by_user)})",
+                list(amounts_by_user),
+            )
+        }
+        # Only a user's first grant in the batch creates them.
+        statuses = []
+        for user_id, amount in grants:
+            statuses.append("updated" if user_id in existing else "created")
+            existing.add(user_id)
+
+        team_deltas = {}
+        for user_id, amount in amounts_by_user.items():
+            user = connection.execute(
+                "INSERT INTO users (userId, bits) VALUES (?, ?) "
+                "ON CONFLICT (userId) DO UPDATE SET bits = bits + excluded.bits "
+                "RETURNING team",
+                (user_id, amount),
+            ).fetchone()
+            team_deltas[user["team"]] = team_deltas.get(user["team"], 0) + amount
+        update_team_totals(connection, team_deltas)
+
+        created_at = datetime.utcnow()
+        append_ledger_entries(
+            connection,
+            [
+                build_ledger_entry(user_id, amount, "grant", actor, source, created_at)
+                for user_id, amount in grants
+            ],
+        )
+
+    return statuses
+
+
+def remove_bits_from_user(user_id, amount, actor=None, source=None):
+    with transaction() as connection:
+        user = connection.execute(
+            "UPDATE users SET bits = bits - ? WHERE userId = ? AND bits >= ? "
+            "RETURNING team",
+            (amount, user_id, amount),
+        ).fetchone()
+        if user:
+            update_team_totals(connection, {user["team"]: -amount})
+            append_ledger_entries(
+                connection,
+                [
+                    build_ledger_entry(
+                        user_id, -amount, "removal", actor, source, datetime.utcnow()
+                    )
+                ],
+            )
+            return
+
+        exists = connection.execute(
+            "SELECT 1 FROM users WHERE userId = ?", (user_id,)
+        ).fetchone()
+
+    if not exists:
+        raise Exception("Cannot remove bits from a user that has no bits")
+
+    raise Exception("Cannot remove more bits than what the user has")
+
+
+def remove_bits_from_users(user_ids, amount, actor=None, source=None):
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+
+    removed = {}
+    with transaction() as connection:
+        for user_id in user_ids:
+            user = connection.execute(
+                "UPDATE users SET bits = bits - ? WHERE userId = ? AND bits >= ? "
+                "RETURNING team",
+                (amount, user_id, amount),
+            ).fetchone()
+            if user:
+                removed[user_id] = user["team"]
+
+        team_deltas = {}
+        for team in removed.values():
+            team_deltas[team] = team_deltas.get(team, 0) - amount
+        update_team_totals(connection, team_deltas)
+
+        created_at = datetime.utcnow()
+        append_ledger_entries(
+            connection,
+            [
+                build_ledger_entry(
+                    user_id, -amount, "removal", actor, source, created_at
+                )
+                for user_id in removed
+            ],
+        )
+
+    return {
+        user_id: "removed" if user_id in removed else "insufficient"
+        for user_id in user_ids
+    }
+
+
+def claim_integration_grant_keys(integration_name, claims):
+    # Each claim is (idempotency_key, user_id, amount) and stays "pending" until
+    # apply_integration_grants lands it.
+    if not claims:
+        return []
+
+    now = datetime.utcnow()
+    expired = now - timedelta(seconds=INTEGRATION_GRANT_KEY_TTL_SECONDS)
+    claimed = []
+    with transaction() as connection:
+        # Stands in for the Mongo TTL index.
+        connection.execute(
+            "DELETE FROM integration_grants WHERE createdAt < ?",
+            (to_timestamp(expired),),
+        )
+        for key, user_id, amount in claims:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO integration_grants (integrationName, "
+                "idempotencyKey, userId, amount, status, createdAt) "
+                "VALUES (?, ?, ?, ?, 'pending', ?)",
+                (integration_name, key, user_id, amount, to_timestamp(now)),
+            )
+            claimed.append(cursor.rowcount == 1)
+
+    return claimed
+
+
+def apply_integration_grants(integration_name, claims, source="integration-batch"):
+    # The grants and their claims commit in one transaction, so a claim left
+    # pending was never granted.
+    keys = [key for key, _, _ in claims]
+    if not claims:
+        return []
+
+    try:
+        with transaction() as connection:
+            apply_bit_grants(
+                [(user_id, amount) for _, user_id, amount in claims],
+                integration_name,
+                source,
+            )
+            connection.execute(
+                "UPDATE integration_grants SET status = 'applied' "
+                f"WHERE integrationName = ? AND idempotencyKey IN ({placeholders(keys)})",
+                [integration_name, *keys],
+            )
+    except Exception:
+        # Rolled back, so the integration can retry every key.
+        release_integration_grant_keys(integration_name, keys)
+        raise
+
+    return []
+
+
+def get_pending_integration_grants(cutoff):
+    rows = get_connection().execute(
+        "SELECT integrationName, idempotencyKey, userId, amount, createdAt "
+        "FROM integration_grants WHERE status = 'pending' AND createdAt < ? "
+        "ORDER BY createdAt, idempotencyKey",
+        (to_timestamp(cutoff),),
+    )
+    return [
+        {**row, "createdAt": from_timestamp(row["createdAt"])}
+        for row in map(dict, rows)
+    ]
+
+
+def release_integration_grant_keys(integration_name, idempotency_keys):
+    idempotency_keys = list(idempotency_keys)
+    with transaction() as connection:
+        connection.execute(
+            "DELETE FROM integration_grants WHERE integrationName = ? "
+            f"AND idempotencyKey IN ({placeholders(idempotency_keys)})",
+            [integration_name, *idempotency_keys],
+        )
+
+
+def insert_bit_history_snapshot(connection, tag, created_at):
+    connection.execute(
+        "INSERT INTO bit_history_snapshots (tag, user_count, createdAt) "
+        "SELECT ?, COUNT(*), ? FROM users",
+        (tag, to_timestamp(created_at)),
+    )
+    connection.execute(
+        "INSERT INTO bit_history_entries (tag, position, userId, team, bits) "
+        "SELECT ?, ROW_NUMBER() OVER (ORDER BY bits DESC, userId) - 1, "
+        "userId, team, bits FROM users",
+        (tag,),
+    )
+    connection.execute(
+        "INSERT INTO bit_history_team_totals (tag, team, total_bits) "
+        "SELECT ?, team, SUM(bits) FROM users GROUP BY team",
+        (tag,),
+    )
+
+    return connection.execute(
+        "SELECT user_count FROM bit_history_snapshots WHERE tag = ?", (tag,)
+    ).fetchone()["user_count"]
+
+
+def record_bit_history(tag):
+    # Re-running a snapshot for the same tag replaces it.
+    with transaction() as connection:
+        connection.execute("DELETE FROM bit_history_snapshots WHERE tag = ?", (tag,))
+        return insert_bit_history_snapshot(connection, tag, datetime.utcnow())
+
+
+def remove_bit_history_by_tag(tag):
+    with transaction() as connection:
+        connection.execute("DELETE FROM bit_history_snapshots WHERE tag = ?", (tag,))
+
+
+def rollover_semester(tag, actor=None, source=None, progress=None):
+    progress = progress or (lambda message: None)
+    # Reported after the commit, so nothing is posted for a rollback and the
+    # write lock isn't held while Slack is called.
+    messages = []
+
+    with transaction() as connection:
+        if connection.execute(
+            "SELECT 1 FROM bit_history_snapshots WHERE tag = ?", (tag,)
+        ).fetchone():
+            raise Exception(f"Bit history for {tag} already exists")
+
+        now = datetime.utcnow()
+        user_count = insert_bit_history_snapshot(connection, tag, now)
+        messages.append(f"saved a snapshot of {user_count} users")
+
+        counts = connection.execute(
+            "SELECT COUNT(*) AS users, COALESCE(SUM(bits), 0) AS bits, "
+            "COALESCE(SUM(team != 'No Team'), 0) AS teams FROM users"
+        ).fetchone()
+        connection.execute("UPDATE users SET bits = 0, team = 'No Team'")
+        connection.execute("DELETE FROM team_totals WHERE team != 'No Team'")
+        connection.execute(
+            "INSERT INTO team_totals (team, total_bits) VALUES ('No Team', 0) "
+            "ON CONFLICT (team) DO UPDATE SET total_bits = 0"
+        )
+        append_ledger_entries(
+            connection, [build_ledger_entry(None, 0, "reset", actor, source, now)]
+        )
+        messages.append("reset every balance and team")
+
+    for message in messages:
+        progress(message)
+
+    return {"users": counts["users"], "bits": counts["bits"], "teams": counts["teams"]}
+
+
+def get_bit_history_matrix(user_id=None):
+    query = (
+        "SELECT entries.userId, entries.tag, entries.bits, entries.team, "
+        "snapshots.createdAt FROM bit_history_entries AS entries "
+        "JOIN bit_history_snapshots AS snapshots USING (tag)"
+    )
+    arguments = ()
+    if user_id:
+        query += " WHERE entries.userId = ?"
+        arguments = (user_id,)
+
+    rows = [
+        {**row, "createdAt": from_timestamp(row["createdAt"])}
+        for row in map(dict, get_connection().execute(query, arguments))
+    ]
+    return build_bit_history_matrix(rows)
+
+
+def get_leaderboard_documents(limit=10):
+    # Served entirely from the (bits, userId) index.
+    return [
+        dict(row)
+        for row in get_connection().execute(
+            "SELECT userId, bits FROM users ORDER BY bits DESC, userId LIMIT ?",
+            (limit,),
+        )
+    ]
+
+
+def get_leaderboard_documents_from_history(tag, limit=10):
+    return [
+        dict(row)
+        for row in get_connection().execute(
+            "SELECT userId, team, bits FROM bit_history_entries WHERE tag = ? "
+            "ORDER BY position LIMIT ?",
+            (tag, limit),
+        )
+    ]
+
+
+def get_leaderboard_page(after=None, limit=10):
+    query = "SELECT userId, bits FROM users"
+    arguments = []
+    if after:
+        # Everything strictly after the last entry in (bits desc, userId asc).
+        query += " WHERE bits < ? OR (bits = ? AND userId > ?)"
+        arguments = [after["bits"], after["bits"], after["userId"]]
+    query += " ORDER BY bits DESC, userId LIMIT ?"
+    arguments.append(limit + 1)
+
+    entries = [dict(row) for row in get_connection().execute(query, arguments)]
+    return rank_page(entries, after, limit)
+
+
+def get_leaderboard_page_from_history(tag, after=None, limit=10):
+    offset = after["position"] if after else 0
+    entries = [
+        dict(row)
+        for row in get_connection().execute(
+            "SELECT userId, bits FROM bit_history_entries "
+            "WHERE tag = ? AND position >= ? ORDER BY position LIMIT ?",
+            (tag, offset, limit + 1),
+        )
+    ]
+    return rank_page(entries, after, limit)
+
+
+def get_user_rank(user_id):
+    connection = get_connection()
+    user = connection.execute(
+        "SELECT bits FROM users WHERE userId = ?", (user_id,)
+    ).fetchone()
+    if not user:
+        return None
+
+    ahead, total = connection.execute(
+        "SELECT (SELECT COUNT(*) FROM users WHERE bits > ?), "
+        "(SELECT COUNT(*) FROM users)",
+        (user["bits"],),
+    ).fetchone()
+    return build_rank(user_id, user["bits"], ahead, total)
+
+
+def get_user_rank_from_history(user_id, tag):
+    connection = get_connection()
+    entry = connection.execute(
+        "SELECT entries.bits, snapshots.user_count FROM bit_history_entries AS entries "
+        "JOIN bit_history_snapshots AS snapshots USING (tag) "
+        "WHERE entries.userId = ? AND entries.tag = ?",
+        (user_id, tag),
+    ).fetchone()
+    if not entry:
+        return None
+
+    ahead = connection.execute(
+        "SELECT COUNT(*) FROM bit_history_entries WHERE tag = ? AND bits > ?",
+        (tag, entry["bits"]),
+    ).fetchone()[0]
+    return build_rank(user_id, entry["bits"], ahead, entry["user_count"])
+
+
+def get_team_leaderboard():
+    query = (
+        "SELECT team AS _id, total_bits FROM team_totals "
+        "ORDER BY total_bits DESC, team"
+    )
+    team_leaderboard = [dict(row) for row in get_connection().execute(query)]
+    if not team_leaderboard:
+        # An empty workspace, or totals that were never built.
+        rebuild_team_leaderboard()
+        team_leaderboard = [dict(row) for row in get_connection().execute(query)]
+
+    return team_leaderboard
+
+
+def get_team_leaderboard_from_history(tag):
+    return [
+        dict(row)
+        for row in get_connection().execute(
+            "SELECT team AS _id, total_bits FROM bit_history_team_totals "
+            "WHERE tag = ? ORDER BY total_bits DESC, team",
+            (tag,),
+        )
+    ]
+
+
+def rebuild_team_leaderboard():
+    with transaction() as connection:
+        actual = dict(
+            connection.execute("SELECT team, SUM(bits) FROM users GROUP BY team")
+        )
+        stored = dict(connection.execute("SELECT team, total_bits FROM team_totals"))
+
+        drift = {
+            team: {"stored": stored.get(team), "actual": actual.get(team)}
+            for team in set(actual) | set(stored)
+            if stored.get(team) != actual.get(team)
+        }
+
+        connection.execute("DELETE FROM team_totals")
+        connection.executemany(
+            "INSERT INTO team_totals (team, total_bits) VALUES (?, ?)",
+            actual.items(),
+        )
+
+    return drift
+
+
+def set_team_by_user_id(user_id, team):
+    with transaction() as connection:
+        previous = connection.execute(
+            "SELECT bits, team FROM users WHERE userId = ?", (user_id,)
+        ).fetchone()
+        connection.execute(
+            "INSERT INTO users (userId, team) VALUES (?, ?) "
+            "ON CONFLICT (userId) DO UPDATE SET team = excluded.team",
+            (user_id, team),
+        )
+        if previous and previous["team"] != team and previous["bits"]:
+            update_team_totals(
+                connection,
+                {previous["team"]: -previous["bits"], team: previous["bits"]},
+            )
+
+
+def set_teams_to_no_team():
+    with transaction() as connection:
+        connection.execute("UPDATE users SET team = 'No Team'")
+        # Every team's bits now belong to "No Team".
+        connection.execute(
+            "INSERT INTO team_totals (team, total_bits) "
+            "SELECT 'No Team', COALESCE(SUM(total_bits), 0) FROM team_totals WHERE true "
+            "ON CONFLICT (team) DO UPDATE SET total_bits = excluded.total_bits"
+        )
+        connection.execute("DELETE FROM team_totals WHERE team != 'No Team'")
+
+
+def set_user_bits_to_zero(actor=None, source=None):
+    # Taken before the reset, as in rollover_semester.
+    now = datetime.utcnow()
+    with transaction() as connection:
+        connection.execute("UPDATE users SET bits = 0")
+        connection.execute("UPDATE team_totals SET total_bits = 0")
+        # A single entry with no user stands for "every balance is zero from here".
+        append_ledger_entries(
+            connection, [build_ledger_entry(None, 0, "reset", actor, source, now)]
+        )
+
+
+def get_user_role(user_id):
+    row = (
+        get_connection()
+        .execute("SELECT role FROM users WHERE userId = ?", (user_id,))
+        .fetchone()
+    )
+    return row["role"] if row else None
+
+
+def change_user_role(user_id, role):
+    with transaction() as connection:
+        connection.execute(
+            "INSERT INTO users (userId, role) VALUES (?, ?) "
+            "ON CONFLICT (userId) DO UPDATE SET role = excluded.role",
+            (user_id, role),
+        )
+
+
+def get_balances_at(at):
+    # Balances at any moment are the latest checkpoint before it plus the tail
+    # of the ledger up to it, restarting from zero at the last reset.
+    connection = get_connection()
+    at = to_timestamp(at)
+
+    checkpoint = connection.execute(
+        "SELECT id, createdAt FROM bit_checkpoints WHERE createdAt <= ? "
+        "ORDER BY createdAt DESC LIMIT 1",
+        (at,),
+    ).fetchone()
+    start = checkpoint["createdAt"] if checkpoint else to_timestamp(datetime.min)
+    balances = (
+        dict(
+            connection.execute(
+                "SELECT userId, bits FROM bit_checkpoint_balances WHERE checkpointId = ?",
+                (checkpoint["id"],),
+            )
+        )
+        if checkpoint
+        else {}
+    )
+
+    reset = connection.execute(
+        "SELECT createdAt FROM bit_ledger WHERE kind = 'reset' "
+        "AND createdAt > ? AND createdAt <= ? ORDER BY createdAt DESC LIMIT 1",
+        (start, at),
+    ).fetchone()
+    if reset:
+        start = reset["createdAt"]
+        balances = {}
+
+    for user_id, delta in connection.execute(
+        "SELECT userId, SUM(delta) FROM bit_ledger "
+        "WHERE createdAt > ? AND createdAt <= ? AND kind != 'reset' GROUP BY userId",
+        (start, at),
+    ):
+        balances[user_id] = balances.get(user_id, 0) + delta
+
+    return balances
+
+
+def get_user_balance_at(user_id, at):
+    # get_balances_at for one user, through the primary key of
+    # bit_checkpoint_balances and the (userId, createdAt) ledger index.
+    connection = get_connection()
+    at = to_timestamp(at)
+
+    checkpoint = connection.execute(
+        "SELECT id, createdAt FROM bit_checkpoints WHERE createdAt <= ? "
+        "ORDER BY createdAt DESC LIMIT 1",
+        (at,),
+    ).fetchone()
+    start = checkpoint["createdAt"] if checkpoint else to_timestamp(datetime.min)
+    balance = (
+        connection.execute(
+            "SELECT bits FROM bit_checkpoint_balances "
+            "WHERE checkpointId = ? AND userId = ?",
+            (checkpoint["id"], user_id),
+        ).fetchone()
+        if checkpoint
+        else None
+    )
+    bits = balance["bits"] if balance else 0
+
+    reset = connection.execute(
+        "SELECT createdAt FROM bit_ledger WHERE kind = 'reset' "
+        "AND createdAt > ? AND createdAt <= ? ORDER BY createdAt DESC LIMIT 1",
+        (start, at),
+    ).fetchone()
+    if reset:
+        start = reset["createdAt"]
+        bits = 0
+
+    (delta,) = connection.execute(
+        "SELECT COALESCE(SUM(delta), 0) FROM bit_ledger "
+        "WHERE userId = ? AND createdAt > ? AND createdAt <= ?",
+        (user_id, start, at),
+    ).fetchone()
+
+    return bits + delta
+
+
+def get_leaderboard_at(at, limit=10):
+    return build_leaderboard(get_balances_at(at), limit)
+
+
+def get_ledger_entries(user_id, limit=50):
+    # Resets apply to everyone, so they belong in every user's trail.
+    rows = get_connection().execute(
+        "SELECT userId, delta, kind, actor, source, createdAt FROM bit_ledger "
+        "WHERE userId = ? OR kind = 'reset' ORDER BY createdAt DESC, id DESC LIMIT ?",
+        (user_id, limit),
+    )
+    return [
+        {**row, "createdAt": from_timestamp(row["createdAt"])}
+        for row in map(dict, rows)
+    ]
+
+
+def insert_bit_checkpoint(connection, created_at, balances, bootstrap=False):
+    checkpoint_id = connection.execute(
+        "INSERT INTO bit_checkpoints (createdAt, bootstrap) VALUES (?, ?)",
+        (to_timestamp(created_at), int(bootstrap)),
+    ).lastrowid
+    connection.executemany(
+        "INSERT INTO bit_checkpoint_balances (checkpointId, userId, bits) "
+        "VALUES (?, ?, ?)",
+        [(checkpoint_id, user_id, bits) for user_id, bits in balances],
+    )
+
+
+def has_bit_ledger_bootstrap():
+    # Balances from before the ledger only exist in the bootstrap checkpoint;
+    # without it every balance the ledger reports is missing them.
+    row = (
+        get_connection()
+        .execute("SELECT 1 FROM bit_checkpoints WHERE bootstrap LIMIT 1")
+        .fetchone()
+    )
+    return row is not None
+
+
+def create_bit_checkpoint(cutoff=None):
+    # Checkpoints are built from the ledger rather than users.bits, so they
+    # agree with get_balances_at. The cutoff trails the clock a little so
+    # writes still in flight are not skipped over.
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(seconds=LEDGER_CHECKPOINT_LAG_SECONDS)
+
+    with transaction() as connection:
+        if not has_bit_ledger_bootstrap():
+            # A checkpoint from the ledger alone would drop every pre-ledger
+            # balance, so the first one is seeded from users.bits instead.
+            return bootstrap_bit_ledger()
+
+        if not connection.execute(
+            "SELECT 1 FROM bit_checkpoints WHERE createdAt <= ? LIMIT 1",
+            (to_timestamp(cutoff),),
+        ).fetchone():
+            # The cutoff is before the bootstrap; there is nothing to add.
+            return 0
+
+        balances = [
+            (user_id, bits)
+            for user_id, bits in sorted(get_balances_at(cutoff).items())
+            if bits
+        ]
+        insert_bit_checkpoint(connection, cutoff, balances)
+
+    return len(balances)
+
+
+def bootstrap_bit_ledger():
+    # Balances from before the ledger existed only live in users.bits; seed
+    # the first checkpoint from them so the ledger tail can build on top.
+    with transaction() as connection:
+        if has_bit_ledger_bootstrap():
+            raise Exception("The bit ledger has already been bootstrapped")
+
+        balances = list(
+            connection.execute("SELECT userId, bits FROM users WHERE bits != 0")
+        )
+        insert_bit_checkpoint(connection, datetime.utcnow(), balances, bootstrap=True)
+
+    return len(balances)
+
+
+def rebuild_bits_from_ledger(apply=False):
+    with transaction() as connection:
+        if not has_bit_ledger_bootstrap():
+            raise Exception(
+                "Run bootstrap-ledger before rebuilding bits from the ledger"
+            )
+
+        balances = get_balances_at(datetime.utcnow())
+
+        drift = {}
+        for user_id, bits in connection.execute("SELECT userId, bits FROM users"):
+            actual = balances.pop(user_id, 0)
+            if bits != actual:
+                drift[user_id] = {"stored": bits, "actual": actual}
+        for user_id, actual in balances.items():
+            if actual:
+                drift[user_id] = {"stored": None, "actual": actual}
+
+        if apply and drift:
+            connection.executemany(
+                "INSERT INTO users (userId, bits) VALUES (?, ?) "
+                "ON CONFLICT (userId) DO UPDATE SET bits = excluded.bits",
+                [(user_id, counts["actual"]) for user_id, counts in drift.items()],
+            )
+            rebuild_team_leaderboard()
+
+    return drift
+
+
+def claim_message_id(message_id):
+    now = datetime.utcnow()
+    expired = now - timedelta(seconds=MESSAGE_ID_TTL_SECONDS)
+    with transaction() as connection:
+        # Stands in for the Mongo TTL index.
+        connection.execute(
+            "DELETE FROM messages WHERE createdAt < ?", (to_timestamp(expired),)
+        )
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO messages (messageId, createdAt) VALUES (?, ?)",
+            (message_id, to_timestamp(now)),
+        )
+
+    return cursor.rowcount == 1
+
+
+def get_directory_profiles(user_ids):
+    user_ids = list(user_ids)
+    rows = get_connection().execute(
+        f"SELECT userId, profile FROM workspace_users WHERE userId IN ({placeholders(user_ids)})",
+        user_ids,
+    )
+    return {user_id: json.loads(profile) for user_id, profile in rows}
+
+
+def save_directory_profiles(profiles):
+    if not profiles:
+        return 0
+
+    user_ids = [profile["id"] for profile in profiles]
+    with transaction() as connection:
+        # Only profiles Slack has edited since they were stored are written.
+        stored = dict(
+            connection.execute(
+                "SELECT userId, updated FROM workspace_users "
+                f"WHERE userId IN ({placeholders(user_ids)})",
+                user_ids,
+            )
+        )
+        changed = [
+            profile
+            for profile in profiles
+            if profile["id"] not in stored
+            or profile.get("updated", 0) > stored[profile["id"]]
+        ]
+        synced_at = to_timestamp(datetime.utcnow())
+        connection.executemany(
+            "INSERT INTO workspace_users (userId, profile, updated, syncedAt) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (userId) DO UPDATE SET "
+            "profile = excluded.profile, updated = excluded.updated, "
+            "syncedAt = excluded.syncedAt WHERE excluded.updated > updated",
+            [
+                (
+                    profile["id"],
+                    json.dumps(profile),
+                    profile.get("updated", 0),
+                    synced_at,
+                )
+                for profile in changed
+            ],
+        )
+
+    return len(changed)
+
+
+def get_directory_sync_state():
+    row = (
+        get_connection()
+        .execute(
+            "SELECT cursor, startedAt, completedAt FROM workspace_directory_state "
+            "WHERE id = 'users.list'"
+        )
+        .fetchone()
+    )
+    if not row:
+        return {}
+
+    return {
+        "_id": "users.list",
+        "cursor": row["cursor"],
+        "startedAt": from_timestamp(row["startedAt"]),
+        "completedAt": from_timestamp(row["completedAt"]),
+    }
+
+
+def save_directory_sync_state(state):
+    with transaction() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO workspace_directory_state "
+            "(id, cursor, startedAt, completedAt) VALUES ('users.list', ?, ?, ?)",
+            (
+                state.get("cursor"),
+                to_timestamp(state.get("startedAt")),
+                to_timestamp(state.get("completedAt")),
+            ),
+        )
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+# Helpers shared by every storage backend, so they build identical results.
+
+
+def build_ledger_entry(user_id, delta, kind, actor, source, created_at):
+    return {
+        "userId": user_id,
+        "delta": delta,
+        "kind": kind,
+        "actor": actor,
+        "source": source,
+        "createdAt": created_at,
+    }
+
+
+def build_bit_history_matrix(rows):
+    tag_dates = {}
+    for row in rows:
+        created_at = row.get("createdAt") or datetime.max
+        tag_dates[row["tag"]] = min(tag_dates.get(row["tag"], created_at), created_at)
+
+    tags = sorted(tag_dates, key=lambda tag: (tag_dates[tag], tag))
+    columns = {tag: index for index, tag in enumerate(tags)}
+
+    users = {}
+    for row in rows:
+        user = users.setdefault(
+            row["userId"],
+            {
+                "userId": row["userId"],
+                "bits": [None] * len(tags),
+                "teams": [None] * len(tags),
+            },
+        )
+        user["bits"][columns[row["tag"]]] = row["bits"]
+        user["teams"][columns[row["tag"]]] = row["team"]
+
+    return {"tags": tags, "users": [users[user_id] for user_id in sorted(users)]}
+
+
+def build_leaderboard(balances, limit):
+    leaders = sorted(balances.items(), key=lambda item: (-item[1], item[0]))
+
+    return [{"userId": user_id, "bits": bits} for user_id, bits in leaders[:limit]]
+
+
+def build_rank(user_id, bits, ahead, total):
+    # Competition ranking: members with the same bits share a rank.
+    return {
+        "userId": user_id,
+        "bits": bits,
+        "rank": ahead + 1,
+        "total": total,
+        "percentile": round(100 * (total - ahead) / total, 1),
+    }
+
+
+def rank_page(entries, after, limit):
+    # `after` carries the position and rank of the previous page's last entry,
+    # so ranks continue across pages without counting anything.
+    position = after["position"] if after else 0
+    previous = after
+    page = []
+    for entry in entries[:limit]:
+        position += 1
+        if previous and entry["bits"] == previous["bits"]:
+            rank = previous["rank"]
+        else:
+            rank = position
+        previous = {
+            "userId": entry["userId"],
+            "bits": entry["bits"],
+            "rank": rank,
+            "position": position,
+        }
+        page.append({"userId": entry["userId"], "bits": entry["bits"], "rank": rank})
+
+    next_after = previous if len(entries) > limit else None
+    return page, next_after
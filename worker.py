@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+
+
+class CommandWorker:
+    def __init__(self, num_workers, max_queue_size):
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = []
+        self._busy = 0
+        self._rejected = 0
+        self._command_stats = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for index in range(self.num_workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"command-worker-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, name, function, *args):
+        self.start()
+        try:
+            self._queue.put_nowait((name, function, args))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    def execute(self, name, function, *args):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return function(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, failed)
+
+    def record(self, name, seconds, failed=False):
+        with self._lock:
+            stats = self._command_stats.setdefault(
+                name,
+                {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            stats["count"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if failed:
+                stats["errors"] += 1
+
+    def stats(self):
+        with self._lock:
+            commands = {}
+            for name, stats in self._command_stats.items():
+                commands[name] = dict(
+                    stats, avg_seconds=stats["total_seconds"] / stats["count"]
+                )
+
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "workers": len(self._threads),
+                "busy_workers": self._busy,
+                "rejected": self._rejected,
+                "commands": commands,
+            }
+
+    def _run(self):
+        while True:
+            name, function, args = self._queue.get()
+            with self._lock:
+                self._busy += 1
+            try:
+                self.execute(name, function, *args)
+            except Exception:
+                # Commands report their own failures to Slack; keep the worker alive.
+                pass
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                self._queue.task_done()
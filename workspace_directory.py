@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta
+
+from config import WORKSPACE_DIRECTORY_PAGE_SIZE, WORKSPACE_DIRECTORY_REFRESH_SECONDS
+from database import (
+    get_directory_sync_state,
+    save_directory_profiles,
+    save_directory_sync_state,
+)
+from profiles import profile_cache, to_directory_profile
+from slack_scheduler import PRIORITY_BACKGROUND, slack_priority
+
+
+def is_sync_due(state, now):
+    if state.get("cursor"):
+        # A pass is part way through.
+        return True
+
+    completed_at = state.get("completedAt")
+    return completed_at is None or now - completed_at >= timedelta(
+        seconds=WORKSPACE_DIRECTORY_REFRESH_SECONDS
+    )
+
+
+def sync_workspace_directory(client, max_pages=None, force=False, time_budget=None):
+    # users.list can't filter by last change, so a pass pages through the whole
+    # workspace and only users edited since they were stored are written. The
+    # cursor is saved after every page so one pass can span several runs.
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    now = datetime.utcnow()
+    state = get_directory_sync_state()
+    result = {"pages": 0, "users": 0, "changed": 0, "complete": False}
+    if not force and not is_sync_due(state, now):
+        result["skipped"] = True
+        return result
+
+    cursor = state.get("cursor")
+    started_at = state.get("startedAt") if cursor else now
+    slowest_page = 0
+    with slack_priority(PRIORITY_BACKGROUND):
+        while max_pages is None or result["pages"] < max_pages:
+            # Always make progress, then only start a page that should finish
+            # in time.
+            page_start = time.monotonic()
+            if result["pages"] and deadline is not None:
+                if page_start + slowest_page > deadline:
+                    break
+
+            response = client.users_list(
+                limit=WORKSPACE_DIRECTORY_PAGE_SIZE, cursor=cursor
+            )
+            members = response["members"]
+            result["pages"] += 1
+            result["users"] += len(members)
+            result["changed"] += save_directory_profiles(
+                [to_directory_profile(member) for member in members]
+            )
+
+            cursor = response.get("response_metadata", {}).get("next_cursor") or None
+            completed_at = state.get("completedAt")
+            if cursor is None:
+                completed_at = datetime.utcnow()
+                result["complete"] = True
+            save_directory_sync_state(
+                {
+                    "cursor": cursor,
+                    "startedAt": started_at,
+                    "completedAt": completed_at,
+                }
+            )
+            if cursor is None:
+                break
+            slowest_page = max(slowest_page, time.monotonic() - page_start)
+
+    return result
+
+
+def save_workspace_user(user):
+    # user_change and team_join events carry the full user object.
+    profile = to_directory_profile(user)
+    profile_cache.set(profile["id"], profile)
+    return save_directory_profiles([profile])